@@ -0,0 +1,292 @@
+"""Benchmarks del bot: búsqueda, capa de datos y handlers de punta a punta.
+
+Corre sin conexión a Discord: los handlers reciben interacciones falsas y la DB es un
+SQLite temporal (o un Postgres local y desechable con --db postgres).
+
+    python benchmarks/bench.py                     # todo, contra SQLite
+    python benchmarks/bench.py --areas busqueda    # sólo una área
+    python benchmarks/bench.py --guardar           # guarda la línea base
+    python benchmarks/bench.py --comparar          # falla (código 1) si algo empeora
+    python benchmarks/bench.py --db postgres --database-url postgresql://localhost/banco_bench
+
+La línea base se guarda por motor en benchmarks/linea_base_<motor>.json. Los tiempos
+dependen de la máquina: regenerarla con --guardar antes de comparar en otra.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+GUILD_BENCH = 990000000000000001
+SEMILLA = 42
+
+def preparar_entorno(args):
+    """Configura la DB antes de importar el bot (lee DATABASE_URL/DB_FILE al importarse)."""
+    if args.db == "postgres":
+        if not args.database_url:
+            sys.exit("--db postgres necesita --database-url (una base de datos local y desechable)")
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="banco_bench_"), "bench.db")
+    # Sin ruido de consultas lentas ni resúmenes por interacción durante las mediciones
+    os.environ.setdefault("CONSULTA_LENTA_MS", "1000000")
+    os.environ.setdefault("INTERACCION_CONSULTAS_AVISO", "1000000")
+    os.environ.setdefault("INTERACCION_DB_AVISO_MS", "1000000")
+    os.chdir(RAIZ)
+    sys.path.insert(0, RAIZ)
+
+# -----------------
+# MEDICIÓN
+# -----------------
+def resumen(tiempos):
+    ordenados = sorted(tiempos)
+    p99 = ordenados[min(len(ordenados) - 1, int(0.99 * len(ordenados)))]
+    return {
+        "n": len(ordenados),
+        "p50_ms": round(statistics.median(ordenados) * 1000, 4),
+        "p99_ms": round(p99 * 1000, 4),
+        "ops_s": round(len(ordenados) / sum(ordenados), 1) if sum(ordenados) else None,
+    }
+
+def medir(funcion, argumentos, calentamiento=3, rondas=3):
+    """Llama a funcion(*a) para cada tupla de argumentos, en varias rondas.
+
+    Devuelve el resumen de la ronda con mejor p50: como timeit, el mínimo es lo menos
+    sensible al ruido de la máquina.
+    """
+    for a in argumentos[:calentamiento]:
+        funcion(*a)
+    mejor = None
+    for _ in range(rondas):
+        tiempos = []
+        for a in argumentos:
+            inicio = time.perf_counter()
+            funcion(*a)
+            tiempos.append(time.perf_counter() - inicio)
+        ronda = resumen(tiempos)
+        if mejor is None or ronda["p50_ms"] < mejor["p50_ms"]:
+            mejor = ronda
+    return mejor
+
+# -----------------
+# DATOS DE PRUEBA
+# -----------------
+def sembrar(bot, usuarios=40, objetos_por_usuario=15):
+    """Inventario y registros deterministas en GUILD_BENCH."""
+    conn = bot.get_db_connection()
+    cursor = conn.cursor()
+    for tabla in ("inventario", "registro_usuarios", "historial", "reputacion"):
+        cursor.execute(bot.adapt_placeholders(f"DELETE FROM {tabla} WHERE guild_id = ?"), (GUILD_BENCH,))
+    conn.commit()
+    conn.close()
+    bot.vaciar_caches()
+
+    azar = random.Random(SEMILLA)
+    catalogo = sorted(bot.asegurar_catalogo().values(), key=lambda o: o["nombre_original"])
+    for user_id in range(1, usuarios + 1):
+        entradas = [({"nombre": o["nombre_original"], "categoria": o["categoria"]}, azar.randint(1, 5))
+                    for o in azar.sample(catalogo, objetos_por_usuario)]
+        bot.aplicar_depositos_lote(GUILD_BENCH, user_id, entradas)
+    return catalogo
+
+def leer_consultas():
+    with open(os.path.join(DIRECTORIO, "consultas_busqueda.txt"), encoding="utf-8") as f:
+        return [linea.strip() for linea in f if linea.strip() and not linea.startswith("#")]
+
+# -----------------
+# INTERACCIONES FALSAS
+# -----------------
+class RespuestaFalsa:
+    def __init__(self):
+        self._hecha = False
+
+    def is_done(self):
+        return self._hecha
+
+    async def defer(self, **kwargs):
+        self._hecha = True
+
+    async def send_message(self, *args, **kwargs):
+        self._hecha = True
+
+    async def send_modal(self, modal):
+        self._hecha = True
+
+class InteraccionFalsa:
+    """Lo que usan los handlers de una discord.Interaction."""
+
+    def __init__(self, user_id):
+        self.user = SimpleNamespace(id=user_id, name=f"socio{user_id}", mention=f"<@{user_id}>")
+        self.guild = SimpleNamespace(id=GUILD_BENCH)
+        self.created_at = datetime.now().astimezone()
+        self.response = RespuestaFalsa()
+        self.contenido = None
+        self.vista = None
+
+    async def edit_original_response(self, content=None, view=None):
+        self.contenido = content
+        self.vista = view
+
+def rellenar(campo, valor):
+    # Lo que Discord rellena al enviar el modal
+    campo._value = valor
+
+# -----------------
+# ÁREAS
+# -----------------
+def bench_busqueda(bot, repeticiones):
+    consultas = leer_consultas()
+    mezcla = [(consulta,) for consulta in consultas] * repeticiones
+    resultados = {"busqueda.buscar_objetos": medir(lambda c: bot.buscar_objetos(c, 25), mezcla)}
+    mezcla_usuario = [(consulta, GUILD_BENCH, 1 + i % 40) for i, (consulta,) in enumerate(mezcla)]
+    resultados["busqueda.buscar_objetos_inventario"] = medir(lambda c, g, u: bot.buscar_objetos_inventario(c, g, u, 25), mezcla_usuario)
+    return resultados
+
+def bench_datos(bot, catalogo, repeticiones):
+    n = 40 * repeticiones
+    azar = random.Random(SEMILLA)
+    usuarios = [(GUILD_BENCH, 1 + i % 40) for i in range(n)]
+    objetos = [o["nombre_original"] for o in catalogo[:500]]
+    resultados = {
+        "datos.get_inventario (caché)": medir(bot.get_inventario, [(GUILD_BENCH,)] * n),
+        "datos.get_inventario (DB)": medir(bot._get_inventario_db, [(GUILD_BENCH,)] * n),
+        "datos.get_registro_usuario": medir(bot.get_registro_usuario, usuarios),
+        "datos.get_historial_usuario": medir(bot.get_historial_usuario, usuarios),
+        "datos.get_all_reputacion (DB)": medir(bot._get_all_reputacion_db, [(GUILD_BENCH,)] * n),
+        "datos.get_categoria": medir(bot.get_categoria, [(azar.choice(objetos),) for _ in range(n)]),
+        "datos.aplicar_depositos_lote (3 objetos)": medir(
+            bot.aplicar_depositos_lote,
+            [(GUILD_BENCH, 1 + i % 40, [({"nombre": o, "categoria": None}, 1) for o in azar.sample(objetos, 3)]) for i in range(n)],
+        ),
+    }
+    return resultados
+
+async def _buscar_y_elegir(bot, tipo, user_id, termino):
+    """Flujo de añadir/retirar: modal de búsqueda y clic en el primer resultado."""
+    interaccion = InteraccionFalsa(user_id)
+    modal = bot.BusquedaObjetoModal(tipo=tipo)
+    rellenar(modal.cantidad_input, "1")
+    rellenar(modal.busqueda_input, termino)
+    await modal.on_submit(interaccion)
+    if isinstance(interaccion.vista, bot.SeleccionObjetoView):
+        vista = interaccion.vista
+        await vista.seleccionar_objeto(InteraccionFalsa(user_id), vista.resultados[0])
+
+async def _inventario(bot):
+    vista = bot.BotoneraView()
+    boton = next(item for item in vista.children if getattr(item, "custom_id", None) == "banco:inventario")
+    await boton.callback(InteraccionFalsa(1))
+
+def bench_handlers(bot, repeticiones):
+    async def usuario_falso(user_id):
+        return SimpleNamespace(id=user_id, name=f"socio{user_id}")
+    # inventario_btn pide los nombres a Discord; aquí no hay red
+    bot.bot.fetch_user = usuario_falso
+
+    terminos = ["agricium", "medpen", "p8-ar", "laranite", "arclight", "scu iron", "hadanite", "gallant"]
+    bucle = asyncio.new_event_loop()
+    ejecutar = bucle.run_until_complete
+    try:
+        # Añadir y retirar se alternan para que el inventario no crezca hasta los límites
+        tiempos_añadir, tiempos_retirar = [], []
+        for i in range(10 * repeticiones):
+            user_id, termino = 1 + i % 40, terminos[i % len(terminos)]
+            inicio = time.perf_counter()
+            ejecutar(_buscar_y_elegir(bot, "añadir", user_id, termino))
+            tiempos_añadir.append(time.perf_counter() - inicio)
+            inicio = time.perf_counter()
+            ejecutar(_buscar_y_elegir(bot, "retirar", user_id, termino))
+            tiempos_retirar.append(time.perf_counter() - inicio)
+        resultados = {
+            "handlers.añadir (modal + selección)": resumen(tiempos_añadir),
+            "handlers.retirar (modal + selección)": resumen(tiempos_retirar),
+            "handlers.inventario_btn": medir(lambda: ejecutar(_inventario(bot)), [()] * (2 * repeticiones), calentamiento=1),
+        }
+    finally:
+        bucle.close()
+    return resultados
+
+# -----------------
+# LÍNEA BASE
+# -----------------
+def ruta_linea_base(motor):
+    return os.path.join(DIRECTORIO, f"linea_base_{motor}.json")
+
+def comparar(resultados, linea_base, tolerancia, holgura_ms):
+    """Lista de regresiones frente a la línea base.
+
+    Cuenta como regresión un p50 por encima de base × (1 + tolerancia) + holgura, o un p99
+    por encima del doble de ese margen (las colas son más ruidosas).
+    """
+    regresiones = []
+    for nombre, actual in resultados.items():
+        base = linea_base.get(nombre)
+        if not base:
+            continue
+        for medida, factor in (("p50_ms", 1), ("p99_ms", 2)):
+            if actual[medida] > base[medida] * (1 + tolerancia * factor) + holgura_ms * factor:
+                regresiones.append(f"{nombre}: {medida} {base[medida]} → {actual[medida]} (+{(actual[medida] / base[medida] - 1) * 100:.0f}%)")
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--areas", default="busqueda,datos,handlers")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--database-url")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--guardar", action="store_true", help="guarda los resultados como línea base")
+    parser.add_argument("--comparar", action="store_true", help="compara con la línea base y falla si hay regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.5, help="empeoramiento relativo admitido (0.5 = 50%%)")
+    parser.add_argument("--holgura-ms", type=float, default=0.2, help="empeoramiento absoluto admitido, para las operaciones de décimas de ms")
+    args = parser.parse_args()
+
+    preparar_entorno(args)
+    import bot
+    bot.init_database()
+    catalogo = sembrar(bot)
+
+    areas = args.areas.split(",")
+    resultados = {}
+    if "busqueda" in areas:
+        resultados.update(bench_busqueda(bot, args.repeticiones))
+    if "datos" in areas:
+        resultados.update(bench_datos(bot, catalogo, args.repeticiones))
+    if "handlers" in areas:
+        resultados.update(bench_handlers(bot, args.repeticiones))
+
+    print(f"\n{'benchmark':<46} {'n':>6} {'p50 ms':>10} {'p99 ms':>10} {'ops/s':>10}")
+    for nombre, r in resultados.items():
+        print(f"{nombre:<46} {r['n']:>6} {r['p50_ms']:>10.3f} {r['p99_ms']:>10.3f} {r['ops_s'] or 0:>10.1f}")
+
+    ruta = ruta_linea_base(args.db)
+    if args.guardar:
+        with open(ruta, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "maquina": platform.machine(), "fecha": datetime.now().isoformat(timespec="seconds"),
+                       "resultados": resultados}, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Línea base guardada en {os.path.relpath(ruta, RAIZ)}")
+    if args.comparar:
+        if not os.path.exists(ruta):
+            sys.exit(f"No hay línea base en {os.path.relpath(ruta, RAIZ)}; créala con --guardar")
+        with open(ruta, encoding="utf-8") as f:
+            linea_base = json.load(f)["resultados"]
+        regresiones = comparar(resultados, linea_base, args.tolerancia, args.holgura_ms)
+        if regresiones:
+            print(f"\n❌ {len(regresiones)} regresiones (tolerancia {args.tolerancia:.0%}):")
+            for r in regresiones:
+                print(f"  • {r}")
+            sys.exit(1)
+        print(f"\n✅ Sin regresiones frente a la línea base (tolerancia {args.tolerancia:.0%})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""Generador de carga: simula un evento del clan con muchos socios operando a la vez.
+
+Lanza operaciones con llegadas de Poisson (bucle abierto: no espera a que terminen las
+anteriores) contra los handlers del bot y el endpoint de webhooks, con un cliente de
+Discord falso y una DB local (SQLite temporal o un Postgres desechable).
+
+    python benchmarks/carga.py                                   # 30 socios, 10 op/s, 60 s
+    python benchmarks/carga.py --socios 40 --tasa 25 --duracion 180
+    python benchmarks/carga.py --mezcla anadir=60,retirar=20,webhook=20
+    python benchmarks/carga.py --db postgres --database-url postgresql://localhost/banco_carga
+
+Al final informa de rendimiento, latencias por operación, incumplimientos del plazo de
+3 s de Discord para la primera respuesta y actualizaciones perdidas (saldos que no
+cuadran con el historial y webhooks aceptados que no llegan a aplicarse). Sale con
+código 1 si hay actualizaciones perdidas o incumplimientos.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from bench import GUILD_BENCH, SEMILLA, InteraccionFalsa, RespuestaFalsa, preparar_entorno, rellenar, resumen, sembrar
+
+MEZCLA_POR_DEFECTO = "anadir=45,retirar=15,multiple=15,webhook=15,inventario=5,historial=5"
+
+# -----------------
+# INTERACCIONES CON RELOJ
+# -----------------
+class RespuestaCronometrada(RespuestaFalsa):
+    """Anota cuándo llega la primera respuesta (lo que Discord exige en 3 s)."""
+
+    def __init__(self):
+        super().__init__()
+        self.respondida_en = None
+
+    def _anotar(self):
+        if self.respondida_en is None:
+            self.respondida_en = time.perf_counter()
+        self._hecha = True
+
+    async def defer(self, **kwargs):
+        self._anotar()
+
+    async def send_message(self, *args, **kwargs):
+        self._anotar()
+
+    async def send_modal(self, modal):
+        self._anotar()
+
+class InteraccionCarga(InteraccionFalsa):
+    """Interacción creada en el instante en que el socio pulsa (o envía el modal).
+
+    `creada_en` es la llegada programada si se indica: si el bucle va atrasado, ese retraso
+    cuenta contra el plazo igual que en Discord.
+    """
+
+    def __init__(self, user_id, creada_en=None):
+        super().__init__(user_id)
+        self.response = RespuestaCronometrada()
+        self.creada_en = creada_en or time.perf_counter()
+        atraso = time.perf_counter() - self.creada_en
+        self.created_at = datetime.now().astimezone() - timedelta(seconds=atraso)
+
+    def primera_respuesta(self):
+        if self.response.respondida_en is None:
+            return None
+        return self.response.respondida_en - self.creada_en
+
+def clasificar(contenido):
+    """ok, rechazada (regla de negocio), timeout o error, según el mensaje final."""
+    contenido = contenido or ""
+    if contenido.startswith("⏳"):
+        return "timeout"
+    if contenido.startswith("❌ Ha ocurrido un error") or contenido.startswith("🔌"):
+        return "error"
+    if "✅" in contenido:
+        return "ok"
+    if "❌" in contenido or contenido.startswith("No "):
+        return "rechazada"
+    return "ok"
+
+# -----------------
+# SOCIOS SIMULADOS
+# -----------------
+class Simulacion:
+    def __init__(self, bot, args, catalogo):
+        self.bot = bot
+        self.args = args
+        self.azar = random.Random(SEMILLA)
+        self.nombres = [o["nombre_original"] for o in catalogo]
+        self.socios = list(range(1, args.socios + 1))
+        # Lo que cada socio sabe que tiene, para que sus retiros sean realistas
+        self.pertenencias = {user_id: list(bot.get_registro_usuario(GUILD_BENCH, user_id)) for user_id in self.socios}
+        self.latencias = defaultdict(list)
+        self.primeras_respuestas = defaultdict(list)
+        self.resultados = defaultdict(Counter)
+        self.incumplimientos = Counter()
+        self.webhooks_aceptados = set()
+        self.cliente_http = None
+        self._eventos = 0
+
+    def _anotar_primera(self, operacion, interaccion):
+        segundos = interaccion.primera_respuesta()
+        if segundos is None or segundos > self.args.plazo:
+            self.incumplimientos[operacion] += 1
+        if segundos is not None:
+            self.primeras_respuestas[operacion].append(segundos)
+
+    async def _pulsar(self, operacion, user_id, custom_id, llegada):
+        """Clic en un botón del menú principal; devuelve la interacción."""
+        vista = self.bot.BotoneraView()
+        boton = next(item for item in vista.children if getattr(item, "custom_id", None) == custom_id)
+        interaccion = InteraccionCarga(user_id, llegada)
+        await boton.callback(interaccion)
+        self._anotar_primera(operacion, interaccion)
+        return interaccion
+
+    async def _buscar_y_elegir(self, operacion, tipo, user_id, termino, cantidad, llegada):
+        await self._pulsar(operacion, user_id, "banco:anadir" if tipo == "añadir" else "banco:retirar", llegada)
+        modal = self.bot.BusquedaObjetoModal(tipo=tipo)
+        rellenar(modal.cantidad_input, str(cantidad))
+        rellenar(modal.busqueda_input, termino)
+        interaccion = InteraccionCarga(user_id)
+        await modal.on_submit(interaccion)
+        self._anotar_primera(operacion, interaccion)
+        if not isinstance(interaccion.vista, self.bot.SeleccionObjetoView):
+            return interaccion.contenido
+        vista = interaccion.vista
+        eleccion = InteraccionCarga(user_id)
+        await vista.seleccionar_objeto(eleccion, vista.resultados[0])
+        self._anotar_primera(operacion, eleccion)
+        return eleccion.contenido
+
+    async def anadir(self, user_id, llegada):
+        nombre = self.azar.choice(self.nombres)
+        contenido = await self._buscar_y_elegir("anadir", "añadir", user_id, nombre, self.azar.randint(1, 20), llegada)
+        if clasificar(contenido) == "ok":
+            self.pertenencias[user_id].append(nombre)
+        return contenido
+
+    async def retirar(self, user_id, llegada):
+        if not self.pertenencias[user_id]:
+            return await self.anadir(user_id, llegada)
+        nombre = self.azar.choice(self.pertenencias[user_id])
+        return await self._buscar_y_elegir("retirar", "retirar", user_id, nombre, self.azar.randint(1, 3), llegada)
+
+    async def multiple(self, user_id, llegada):
+        await self._pulsar("multiple", user_id, "banco:deposito_multiple", llegada)
+        lineas = [f"{nombre}, {self.azar.randint(1, 30)}" for nombre in self.azar.sample(self.nombres, self.azar.randint(3, 8))]
+        modal = self.bot.DepositoMultipleModal()
+        rellenar(modal.lineas_input, "\n".join(lineas))
+        interaccion = InteraccionCarga(user_id)
+        await modal.on_submit(interaccion)
+        self._anotar_primera("multiple", interaccion)
+        return interaccion.contenido
+
+    async def inventario(self, user_id, llegada):
+        return (await self._pulsar("inventario", user_id, "banco:inventario", llegada)).contenido
+
+    async def historial(self, user_id, llegada):
+        return (await self._pulsar("historial", user_id, "banco:historial", llegada)).contenido
+
+    async def webhook(self, user_id, llegada):
+        """Contrato completado con recompensas, como lo enviaría la web del clan."""
+        self._eventos += 1
+        event_id = f"carga-{SEMILLA}-{self._eventos}"
+        payload = {
+            "event_id": event_id,
+            "type": "contract.completed",
+            "guild_id": GUILD_BENCH,
+            "data": {"user": {"discord_id": str(user_id)},
+                     "rewards": {"reputation": self.azar.randint(1, 10),
+                                 "items": [{"name": nombre, "quantity": self.azar.randint(1, 10)}
+                                           for nombre in self.azar.sample(self.nombres, self.azar.randint(1, 3))]}},
+        }
+        cabeceras = {"X-Webhook-Token": self.bot.WEBHOOK_SECRET} if self.bot.WEBHOOK_SECRET else {}
+        respuesta = await self.cliente_http.post("/webhook/contratos", data=json.dumps(payload), headers=cabeceras)
+        if respuesta.status == 202:
+            self.webhooks_aceptados.add(event_id)
+            return "✅ aceptado"
+        if respuesta.status >= 500:
+            return "❌ Ha ocurrido un error" if respuesta.status != 503 else "rechazada (503)"
+        return f"rechazada ({respuesta.status})"
+
+    async def operar(self, operacion, user_id, llegada):
+        """Una operación completa; la latencia se mide desde la llegada programada."""
+        try:
+            contenido = await getattr(self, operacion)(user_id, llegada)
+            estado = "ok" if operacion == "webhook" and contenido == "✅ aceptado" else clasificar(contenido)
+        except Exception as e:
+            print(f"❌ {operacion} del socio {user_id} lanzó {type(e).__name__}: {e}")
+            estado = "error"
+        self.latencias[operacion].append(time.perf_counter() - llegada)
+        self.resultados[operacion][estado] += 1
+
+    async def lanzar(self, mezcla):
+        """Llegadas de Poisson a `tasa` op/s durante `duracion` segundos; devuelve las tareas."""
+        operaciones, pesos = zip(*mezcla.items())
+        tareas = []
+        fin = time.perf_counter() + self.args.duracion
+        siguiente = time.perf_counter()
+        while True:
+            siguiente += self.azar.expovariate(self.args.tasa)
+            if siguiente >= fin:
+                break
+            await asyncio.sleep(max(0.0, siguiente - time.perf_counter()))
+            operacion = self.azar.choices(operaciones, pesos)[0]
+            tareas.append(asyncio.create_task(self.operar(operacion, self.azar.choice(self.socios), siguiente)))
+        return tareas
+
+# -----------------
+# COMPROBACIONES
+# -----------------
+async def esperar_bandeja(bot, limite):
+    """Espera a que el trabajador aplique lo encolado; devuelve los segundos que tardó (o None)."""
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < limite:
+        pendientes, _ = await asyncio.to_thread(bot._contar_pendientes_inbox)
+        if not pendientes:
+            return time.perf_counter() - inicio
+        bot.trabajador_inbox.avisar(0)
+        await asyncio.sleep(0.2)
+    return None
+
+def webhooks_aplicados(bot, event_ids):
+    conn = bot.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT event_id, estado FROM webhook_inbox WHERE event_id LIKE 'carga-%'")
+    estados = {event_id: estado for event_id, estado in cursor.fetchall() if event_id in event_ids}
+    conn.close()
+    return Counter(estados.values()), len(event_ids) - len(estados)
+
+def parsear_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(","):
+        operacion, _, peso = parte.partition("=")
+        operacion = operacion.strip()
+        if operacion not in ("anadir", "retirar", "multiple", "webhook", "inventario", "historial"):
+            sys.exit(f"Operación desconocida en --mezcla: {operacion}")
+        mezcla[operacion] = float(peso or 1)
+    return mezcla
+
+async def simular(bot, args, catalogo):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    async def usuario_falso(user_id):
+        return type("Usuario", (), {"id": user_id, "name": f"socio{user_id}"})()
+    # Sin red: inventario_btn pide nombres a Discord
+    bot.bot.fetch_user = usuario_falso
+
+    metricas = bot.metricas
+    metricas.monitor_bucle.iniciar()
+    await asyncio.to_thread(bot.deduplicador_eventos.reconstruir)
+    bot.trabajador_inbox.iniciar()
+    simulacion = Simulacion(bot, args, catalogo)
+    async with TestClient(TestServer(bot.app)) as cliente:
+        simulacion.cliente_http = cliente
+        print(f"🚀 {args.socios} socios, {args.tasa:g} op/s durante {args.duracion:g} s (mezcla: {args.mezcla})")
+        inicio = time.perf_counter()
+        tareas = await simulacion.lanzar(parsear_mezcla(args.mezcla))
+        await asyncio.gather(*tareas)
+        segundos = time.perf_counter() - inicio
+        drenaje = await esperar_bandeja(bot, args.espera_bandeja)
+    return simulacion, len(tareas), segundos, drenaje
+
+def informar(bot, simulacion, lanzadas, segundos, drenaje, args):
+    metricas = bot.metricas
+    print(f"\n{'operación':<12} {'n':>6} {'ok':>6} {'rech.':>6} {'error':>6} {'tmout':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'>plazo':>7}")
+    todas = []
+    for operacion, tiempos in sorted(simulacion.latencias.items()):
+        todas += tiempos
+        r = resumen(tiempos)
+        ordenados = sorted(tiempos)
+        p95 = ordenados[min(len(ordenados) - 1, int(0.95 * len(ordenados)))] * 1000
+        c = simulacion.resultados[operacion]
+        print(f"{operacion:<12} {r['n']:>6} {c['ok']:>6} {c['rechazada']:>6} {c['error']:>6} {c['timeout']:>6} "
+              f"{r['p50_ms']:>9.1f} {p95:>9.1f} {r['p99_ms']:>9.1f} {ordenados[-1] * 1000:>9.1f} {simulacion.incumplimientos[operacion]:>7}")
+
+    total = resumen(todas) if todas else {"p50_ms": 0, "p99_ms": 0}
+    print(f"\n📈 {lanzadas} operaciones en {segundos:.1f} s → {lanzadas / segundos:.1f} op/s completadas "
+          f"(objetivo {args.tasa:g} op/s); latencia total p50 {total['p50_ms']:.1f} ms, p99 {total['p99_ms']:.1f} ms")
+    primeras = [s for muestras in simulacion.primeras_respuestas.values() for s in muestras]
+    if primeras:
+        primeras.sort()
+        p99 = primeras[min(len(primeras) - 1, int(0.99 * len(primeras)))]
+        print(f"⏱️ Primera respuesta: p99 {p99 * 1000:.1f} ms, máx {primeras[-1] * 1000:.1f} ms; "
+              f"{sum(simulacion.incumplimientos.values())} superaron el plazo de {args.plazo:g} s")
+    lag = metricas.monitor_bucle.percentiles()
+    print(f"🔁 Lag del bucle de eventos: p50 {lag[0.5] * 1000:.1f} ms, p99 {lag[0.99] * 1000:.1f} ms, "
+          f"{metricas.monitor_bucle.bloqueos} bloqueos ≥{metricas.monitor_bucle.umbral:g} s")
+
+    estados, sin_fila = webhooks_aplicados(bot, simulacion.webhooks_aceptados)
+    no_aplicados = sin_fila + sum(n for estado, n in estados.items() if estado != "procesado")
+    if simulacion.webhooks_aceptados:
+        espera = f"bandeja vaciada en {drenaje:.1f} s" if drenaje is not None else f"bandeja sin vaciar tras {args.espera_bandeja:g} s"
+        print(f"📥 Webhooks: {len(simulacion.webhooks_aceptados)} aceptados, {estados.get('procesado', 0)} aplicados, "
+              f"{no_aplicados} sin aplicar ({espera})")
+
+    diferencias = bot.verificar_saldos(GUILD_BENCH)
+    if diferencias:
+        print(f"⚖️ {len(diferencias)} saldos no cuadran con el historial:")
+        for tabla, clave, esperado, actual in diferencias[:10]:
+            print(f"  • {tabla} {clave}: historial {esperado}, tabla {actual}")
+    else:
+        print("⚖️ Saldos de inventario, registro y reputación cuadran con el historial")
+
+    perdidas = len(diferencias) + no_aplicados
+    incumplidas = sum(simulacion.incumplimientos.values())
+    if perdidas or incumplidas:
+        print(f"\n❌ {perdidas} actualizaciones perdidas, {incumplidas} respuestas fuera de plazo")
+        return 1
+    print("\n✅ Sin actualizaciones perdidas ni respuestas fuera de plazo")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socios", type=int, default=30)
+    parser.add_argument("--tasa", type=float, default=10, help="llegadas por segundo (media)")
+    parser.add_argument("--duracion", type=float, default=60, help="segundos lanzando operaciones")
+    parser.add_argument("--mezcla", default=MEZCLA_POR_DEFECTO, help="pesos por operación: anadir, retirar, multiple, webhook, inventario, historial")
+    parser.add_argument("--plazo", type=float, default=3.0, help="plazo de la primera respuesta (Discord: 3 s)")
+    parser.add_argument("--espera-bandeja", type=float, default=60, help="segundos máximos esperando a que se apliquen los webhooks")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+
+    preparar_entorno(args)
+    import bot
+    bot.init_database()
+    catalogo = sembrar(bot, usuarios=args.socios)
+    simulacion, lanzadas, segundos, drenaje = asyncio.run(simular(bot, args, catalogo))
+    sys.exit(informar(bot, simulacion, lanzadas, segundos, drenaje, args))
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,27 @@
 import os
-try:
-    # psycopg v3
-    import psycopg  # type: ignore
-except Exception:
-    psycopg = None
+from time import perf_counter
+# Origen del desglose del arranque (antes de las importaciones pesadas)
+_inicio_proceso = perf_counter()
 import discord
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 from datetime import datetime, time
+from collections import deque
 import re
 import sqlite3
 import json
+import zlib
+import math
 import asyncio
+import functools
+import hashlib
+import io
+import itertools
+import threading
+import signal
 from typing import Optional, Dict, Any
-from flask import request, jsonify  # only used if Flask app is running
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from aiohttp import web
 
 load_dotenv()
 TOKEN = os.getenv("TOKEN") or os.getenv("DISCORD_TOKEN")
@@ -21,20 +29,52 @@ TOKEN = os.getenv("TOKEN") or os.getenv("DISCORD_TOKEN")
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix="//", intents=intents)
-from keep_alive import keep_alive, app  # reuse Flask app for webhooks
+# Sharding: SHARD_COUNT y SHARD_IDS (ej. "0,1") permiten repartir shards entre procesos;
+# sin ellos discord.py elige el número recomendado y los gestiona todos en este proceso.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS", "").split(",") if shard.strip()] or None
+bot = commands.AutoShardedBot(command_prefix="//", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+from keep_alive import keep_alive, app  # reuse aiohttp app for webhooks
+import metricas
+metricas.montar(app)
+metricas.arranque.empezar(_inicio_proceso)
+metricas.arranque.marcar("importar dependencias")
 
 # =========================
 # CONFIGURACIÓN DE BASE DE DATOS
 # =========================
 # Configuración para Oracle Cloud con Postgres
 DATABASE_URL = os.getenv("DATABASE_URL")
+# El driver de Postgres (psycopg v3) sólo se importa si se va a usar
+psycopg = None
+if DATABASE_URL:
+    try:
+        with metricas.arranque.subfase("importar psycopg"):
+            import psycopg  # type: ignore
+    except Exception:
+        psycopg = None
 USE_POSTGRES = DATABASE_URL is not None and psycopg is not None
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 # Fallback a SQLite si no hay Postgres
 DB_FILE = os.getenv("DB_FILE", "inventario.db")
 
+# Servidor (guild) al que pertenecen los datos anteriores a la partición por servidor,
+# y el usado cuando no hay servidor (webhooks sin guild_id, mensajes directos).
+# Si no se configura y el bot está en un solo servidor, se adopta ese al arrancar.
+GUILD_ID_PRINCIPAL = int(os.getenv("GUILD_ID", "0"))
+_guild_por_defecto = GUILD_ID_PRINCIPAL
+# Con GUILD_ID ya se sabe; si no, on_ready decide (0 = el bot está en varios servidores)
+_guild_por_defecto_decidido = bool(GUILD_ID_PRINCIPAL)
+
+def guild_por_defecto() -> int:
+    return _guild_por_defecto
+
+def guild_de(origen) -> int:
+    """guild_id de una Interaction o Context; el servidor por defecto si no hay (p. ej. DMs)."""
+    guild = getattr(origen, "guild", None)
+    return guild.id if guild is not None else guild_por_defecto()
+
 # Inicializar base de datos
 print("🔄 Inicializando base de datos...")
 
@@ -42,18 +82,192 @@ DB_DIR = os.path.dirname(DB_FILE)
 if DB_DIR and not os.path.exists(DB_DIR):
     os.makedirs(DB_DIR, exist_ok=True)
 
-def get_db_connection():
-    """Obtiene conexión a la base de datos (Postgres o SQLite)"""
-    if USE_POSTGRES:
+# Cursores que miden sus consultas para las métricas y el perfilador de consultas lentas
+class _CursorPerfilado:
+    """Mide cada execute/executemany: duración, filas y manejador que la lanzó.
+
+    En SQLite un SELECT hace casi todo el trabajo al leer las filas, así que la medición
+    se cierra en fetchone/fetchall (o en la siguiente consulta, o al cerrar el cursor);
+    en Postgres el cursor ya trae todas las filas en execute.
+    """
+    _medicion = None
+    _filas_en_execute = False
+    # {guild_id: {item: cantidad}} escrito en inventario durante la transacción;
+    # confirmar_cambios lo vuelca al inventario en memoria tras el commit
+    inventario_escrito = None
+
+    def execute(self, sql, *args, **kwargs):
+        return self._medido(super().execute, sql, args, kwargs, args[0] if args else None)
+
+    def executemany(self, sql, *args, **kwargs):
+        return self._medido(super().executemany, sql, args, kwargs, None)
+
+    def _medido(self, metodo, sql, args, kwargs, parametros):
+        self._cerrar_medicion()
+        inicio = metricas.reloj()
         try:
-            conn = psycopg.connect(DATABASE_URL)
-            return conn
+            resultado = metodo(sql, *args, **kwargs)
+        except Exception:
+            metricas.contar_consulta(sql, metricas.reloj() - inicio)
+            raise
+        self._medicion = (sql, parametros, inicio)
+        if self.description is None or self._filas_en_execute:
+            self._cerrar_medicion(self.rowcount)
+        return resultado
+
+    def _cerrar_medicion(self, filas=-1):
+        if self._medicion is None:
+            return
+        sql, parametros, inicio = self._medicion
+        self._medicion = None
+        if metricas.contar_consulta(sql, metricas.reloj() - inicio, filas) and parametros is not None:
+            metricas.anotar_plan(sql, self._explicar(sql, parametros))
+
+    def fetchone(self):
+        fila = super().fetchone()
+        self._cerrar_medicion(0 if fila is None else 1)
+        return fila
+
+    def fetchall(self):
+        filas = super().fetchall()
+        self._cerrar_medicion(len(filas))
+        return filas
+
+    def close(self):
+        self._cerrar_medicion()
+        return super().close()
+
+    def _explicar(self, sql, parametros):
+        return []
+
+class CursorSQLiteMedido(_CursorPerfilado, sqlite3.Cursor):
+    def _explicar(self, sql, parametros):
+        if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+            return []
+        try:
+            cursor = sqlite3.Cursor(self.connection)
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parametros)
+            return [fila[-1] for fila in cursor.fetchall()]
         except Exception as e:
-            print(f"⚠️ Error conectando a Postgres: {e}")
-            print("🔄 Fallback a SQLite...")
-    
-    # Fallback a SQLite
-    return sqlite3.connect(DB_FILE)
+            return [f"(sin plan: {e})"]
+
+class ConexionSQLiteMedida(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # SQLite no tiene zonas horarias: el día y el mes locales los calcula Python (ver _expr_dia)
+        self.create_function("dia_local", 1, _dia_local, deterministic=True)
+        self.create_function("mes_local", 1, _mes_local, deterministic=True)
+
+    def cursor(self, factory=CursorSQLiteMedido):
+        return super().cursor(factory)
+
+if psycopg is not None:
+    class CursorPostgresMedido(_CursorPerfilado, psycopg.Cursor):
+        _filas_en_execute = True
+
+        def _explicar(self, sql, parametros):
+            if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+                return []
+            if self.connection.info.transaction_status == psycopg.pq.TransactionStatus.INERROR:
+                return []
+            try:
+                # En un savepoint: si EXPLAIN falla no tumba la transacción en curso
+                with self.connection.transaction():
+                    cursor = psycopg.Cursor(self.connection)
+                    cursor.execute(f"EXPLAIN {sql}", parametros)
+                    return [fila[0] for fila in cursor.fetchall()]
+            except Exception as e:
+                return [f"(sin plan: {e})"]
+
+# -----------------
+# INTERRUPTOR DE POSTGRES
+# -----------------
+# Si Postgres no responde no se cae a SQLite: cada llamada esperaba el timeout de conexión
+# y luego escribía en el fichero local, repartiendo los datos entre dos almacenes. Tras
+# POSTGRES_FALLOS_MAX fallos seguidos el interruptor se abre, get_db_connection falla al
+# instante con BaseDatosNoDisponible y un hilo sondea Postgres con espera creciente hasta
+# que vuelve. SQLite sólo se usa cuando no hay DATABASE_URL.
+POSTGRES_FALLOS_MAX = int(os.getenv("POSTGRES_FALLOS_MAX", "3"))
+POSTGRES_TIMEOUT_CONEXION = int(os.getenv("POSTGRES_TIMEOUT_CONEXION", "5"))
+POSTGRES_ESPERA_MAX = 60
+
+class BaseDatosNoDisponible(Exception):
+    """Postgres no responde (conexión fallida o interruptor abierto)."""
+
+class InterruptorPostgres:
+    """Circuit breaker de las conexiones a Postgres."""
+
+    def __init__(self):
+        self.abierto = False
+        self.fallos = 0
+        self.ultimo_error = None
+        self.abierto_desde = None
+        self.aperturas = 0
+        self.rechazadas = 0
+        self._bloqueo = threading.Lock()
+        self._pausa = threading.Event()
+
+    def conectar(self):
+        if self.abierto:
+            self.rechazadas += 1
+            raise BaseDatosNoDisponible(f"Postgres no disponible: {self.ultimo_error}")
+        try:
+            conn = psycopg.connect(DATABASE_URL, cursor_factory=CursorPostgresMedido, connect_timeout=POSTGRES_TIMEOUT_CONEXION)
+        except Exception as e:
+            self._fallo(e)
+            raise BaseDatosNoDisponible(f"Error conectando a Postgres: {e}") from e
+        self.fallos = 0
+        return conn
+
+    def _fallo(self, error):
+        with self._bloqueo:
+            self.fallos += 1
+            self.ultimo_error = str(error)
+            if self.abierto or self.fallos < POSTGRES_FALLOS_MAX:
+                print(f"⚠️ Error conectando a Postgres ({self.fallos}/{POSTGRES_FALLOS_MAX}): {error}")
+                return
+            self.abierto = True
+            self.abierto_desde = ahora_ts()
+            self.aperturas += 1
+        print(f"🔌 Interruptor de Postgres abierto tras {self.fallos} fallos: {error}")
+        threading.Thread(target=self._sondear, name="sonda-postgres", daemon=True).start()
+
+    def _sondear(self):
+        """Reintenta conectar con espera creciente y cierra el interruptor cuando lo consigue."""
+        espera = 1
+        while True:
+            self._pausa.wait(espera)
+            try:
+                psycopg.connect(DATABASE_URL, connect_timeout=POSTGRES_TIMEOUT_CONEXION).close()
+            except Exception as e:
+                self.ultimo_error = str(e)
+                espera = min(espera * 2, POSTGRES_ESPERA_MAX)
+                continue
+            with self._bloqueo:
+                self.abierto = False
+                self.fallos = 0
+            # Durante el corte otros procesos pueden haber escrito: lo cacheado ya no vale
+            vaciar_caches()
+            print(f"✅ Postgres ha vuelto tras {ahora_ts() - self.abierto_desde:.0f} s; interruptor cerrado")
+            return
+
+    def estadisticas(self):
+        return {
+            "abierto": self.abierto,
+            "fallos": self.fallos,
+            "abierto_desde": self.abierto_desde if self.abierto else None,
+            "aperturas": self.aperturas,
+            "rechazadas": self.rechazadas,
+            "ultimo_error": self.ultimo_error,
+        }
+
+interruptor_postgres = InterruptorPostgres()
+
+def get_db_connection():
+    """Obtiene conexión a la base de datos (Postgres, o SQLite si no hay DATABASE_URL)"""
+    if USE_POSTGRES:
+        return interruptor_postgres.conectar()
+    return sqlite3.connect(DB_FILE, factory=ConexionSQLiteMedida)
 
 def adapt_placeholders(query: str) -> str:
     """Adapta los placeholders SQLite ('?') a Postgres ('%s') cuando aplique."""
@@ -61,6 +275,333 @@ def adapt_placeholders(query: str) -> str:
         return query.replace("?", "%s")
     return query
 
+# =========================
+# CACHÉS E INVALIDACIÓN ENTRE PROCESOS
+# =========================
+# Las lecturas frecuentes (inventario, categorías, contratos, ranking) se cachean en memoria.
+# Cada escritura invalida sus claves aquí y, con Postgres, avisa al resto de procesos que
+# comparten DATABASE_URL mediante NOTIFY; cada proceso hace LISTEN y borra sólo esas claves.
+# Con SQLite no hay otros procesos que avisar y el bus se queda en local.
+CACHES: Dict[str, "CacheLocal"] = {}
+
+class CacheLocal:
+    """Caché en memoria por clave, vaciada por el bus de invalidación."""
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self._datos = {}
+        # Cambia con cada invalidación: una carga que empezó antes no guarda datos viejos
+        self._generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+        CACHES[nombre] = self
+
+    def obtener(self, clave, cargar):
+        try:
+            valor = self._datos[clave]
+            self.aciertos += 1
+            return valor
+        except KeyError:
+            pass
+        self.fallos += 1
+        generacion = self._generacion
+        valor = cargar()
+        if generacion == self._generacion:
+            self._datos[clave] = valor
+        return valor
+
+    def invalidar(self, clave=None):
+        """Borra una clave, o todo si clave es None."""
+        self._generacion += 1
+        self.invalidaciones += 1
+        if clave is None:
+            self._datos.clear()
+        else:
+            self._datos.pop(clave, None)
+
+    def restaurar(self, entradas, generacion) -> int:
+        """Añade entradas [(clave, valor)] ya validadas si no hubo invalidaciones desde `generacion`."""
+        if generacion != self._generacion:
+            return 0
+        for clave, valor in entradas:
+            self._datos.setdefault(clave, valor)
+        return len(entradas)
+
+class InventarioBanco(CacheLocal):
+    """Inventario en memoria guild_id -> {item: cantidad}, espejo exacto de la tabla inventario.
+
+    Cada servidor se carga entero una vez; después lo mantiene al día la ruta de escritura
+    (confirmar_cambios vuelca las cantidades que la transacción dejó en la tabla). Las
+    escrituras de otros procesos llegan por el bus y descartan el servidor, que se vuelve
+    a cargar. reconciliar() lo compara con la DB de vez en cuando.
+    """
+
+    def __init__(self, nombre):
+        super().__init__(nombre)
+        self.divergencias = 0
+
+    def _mapa(self, guild_id):
+        return self.obtener(guild_id, lambda: _get_inventario_db(guild_id))
+
+    def cantidad(self, guild_id, item):
+        """Cantidad de un objeto, o None si el banco no tiene fila para él."""
+        return self._mapa(guild_id).get(item)
+
+    def copia(self, guild_id):
+        return dict(self._mapa(guild_id))
+
+    def escribir(self, escrito):
+        """Aplica {guild_id: {item: cantidad}} ya confirmado en la DB."""
+        # Una carga que empezó antes del commit traería cantidades viejas: que no se guarde
+        self._generacion += 1
+        for guild_id, cantidades in escrito.items():
+            mapa = self._datos.get(guild_id)
+            if mapa is not None:
+                mapa.update(cantidades)
+
+    def reconciliar(self) -> int:
+        """Compara los servidores cargados con la DB y corrige el mapa. Devuelve cuántas cantidades diferían."""
+        diferencias = 0
+        for guild_id in list(self._datos):
+            # Con el banco bloqueado no hay escrituras de este proceso a medio volcar
+            with bloqueo_banco:
+                mapa = self._datos.get(guild_id)
+                if mapa is None:
+                    continue
+                en_db = _get_inventario_db(guild_id)
+                distintas = [item for item in set(mapa) | set(en_db) if mapa.get(item) != en_db.get(item)]
+                if distintas:
+                    self._generacion += 1
+                    self._datos[guild_id] = en_db
+            if distintas:
+                diferencias += len(distintas)
+                print(f"⚖️ Inventario en memoria del servidor {guild_id} corregido: {len(distintas)} objetos no cuadraban con la DB (p. ej. {distintas[0]})")
+        self.divergencias += diferencias
+        return diferencias
+
+inventario_banco = InventarioBanco("inventario")
+cache_categorias = CacheLocal("categorias")   # item en minúsculas -> categoría
+cache_contratos = CacheLocal("contratos")     # guild_id -> [(nombre, enlace)]
+cache_ranking = CacheLocal("ranking")         # guild_id -> {user_id: puntos}
+
+class BusInvalidacion:
+    """Reparte invalidaciones de caché: NOTIFY/LISTEN en Postgres, sólo local en SQLite."""
+
+    CANAL = "banco_invalidacion"
+
+    def __init__(self):
+        # Identifica los avisos de este proceso para no contarlos como remotos
+        self.origen = f"{os.getpid()}-{id(self):x}"
+        self.publicados = 0
+        self.recibidos = 0
+        self._hilo = None
+        # Se activa al empezar a escuchar: desde ahí no se pierde ningún aviso
+        self.escuchando = threading.Event()
+
+    def notificar(self, conn, cursor, cambios):
+        """Encola los avisos en la transacción de `conn`; Postgres los entrega al hacer commit."""
+        if isinstance(conn, sqlite3.Connection):
+            return
+        for cache, clave in cambios:
+            carga = json.dumps({"o": self.origen, "c": cache, "k": clave})
+            cursor.execute("SELECT pg_notify(%s, %s)", (self.CANAL, carga))
+            self.publicados += 1
+
+    def invalidar_local(self, cambios):
+        for cache, clave in cambios:
+            if cache in CACHES:
+                CACHES[cache].invalidar(clave)
+
+    def iniciar(self):
+        """Arranca el hilo que escucha avisos de otros procesos (sólo con Postgres)."""
+        if not USE_POSTGRES or (self._hilo and self._hilo.is_alive()):
+            return
+        self._hilo = threading.Thread(target=self._escuchar, name="bus-invalidacion", daemon=True)
+        self._hilo.start()
+
+    def _escuchar(self):
+        espera = 1
+        while True:
+            try:
+                with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {self.CANAL}")
+                    # Mientras no escuchábamos se han podido perder avisos
+                    vaciar_caches()
+                    self.escuchando.set()
+                    print("📡 Bus de invalidación escuchando en Postgres")
+                    espera = 1
+                    for aviso in conn.notifies():
+                        self._recibir(aviso.payload)
+            except Exception as e:
+                print(f"⚠️ Bus de invalidación desconectado: {e}. Reintentando en {espera}s")
+                threading.Event().wait(espera)
+                espera = min(espera * 2, 60)
+
+    def _recibir(self, carga):
+        try:
+            datos = json.loads(carga)
+        except ValueError:
+            return
+        if datos.get("o") == self.origen:
+            return
+        self.recibidos += 1
+        if datos.get("c") == "inbox":
+            trabajador_inbox.avisar_desde_hilo()
+            return
+        self.invalidar_local([(datos.get("c"), datos.get("k"))])
+
+bus_invalidacion = BusInvalidacion()
+
+def vaciar_caches():
+    for cache in CACHES.values():
+        cache.invalidar()
+
+def confirmar_cambios(conn, cursor, cambios):
+    """Hace commit e invalida las claves afectadas en este proceso y en los demás.
+
+    En la misma transacción sube la versión de cada clave en cache_versiones, con la que
+    se valida la instantánea de cachés al arrancar.
+    """
+    _subir_versiones_en_cursor(cursor, cambios)
+    bus_invalidacion.notificar(conn, cursor, cambios)
+    conn.commit()
+    # Lo escrito en inventario se vuelca al mapa en memoria en vez de descartar el servidor
+    escrito = getattr(cursor, "inventario_escrito", None)
+    if escrito:
+        cursor.inventario_escrito = None
+        inventario_banco.escribir(escrito)
+        cambios = [(cache, clave) for cache, clave in cambios if not (cache == "inventario" and clave in escrito)]
+    bus_invalidacion.invalidar_local(cambios)
+
+def _clave_version(clave) -> str:
+    return "*" if clave is None else str(clave)
+
+def _subir_versiones_en_cursor(cursor, cambios):
+    cursor.executemany(adapt_placeholders("""
+        INSERT INTO cache_versiones (cache, clave, version) VALUES (?, ?, 1)
+        ON CONFLICT (cache, clave) DO UPDATE SET version = cache_versiones.version + 1
+    """), [(cache, _clave_version(clave)) for cache, clave in dict.fromkeys(cambios)])
+
+# -----------------
+# INSTANTÁNEA DE CACHÉS (ARRANQUE EN CALIENTE)
+# -----------------
+# Al cerrar de forma ordenada se guardan las cachés calientes con la versión que tenía
+# cada clave en cache_versiones; al arrancar sólo se restauran las claves cuya versión
+# no ha cambiado (nadie las escribió mientras el bot estaba parado). Los nombres de
+# usuario no salen de la DB y caducan por tiempo.
+INSTANTANEA_CACHES = os.getenv("INSTANTANEA_CACHES", os.path.join(DB_DIR or ".", "cache_instantanea.json.z"))
+NOMBRES_TTL_SEGUNDOS = float(os.getenv("NOMBRES_TTL_SEGUNDOS", str(24 * 3600)))
+FORMATO_INSTANTANEA = 1
+
+# cache -> (a JSON, desde JSON); en JSON las claves de un dict serían siempre texto
+_CODIFICACION_CACHES = {
+    "inventario": (lambda valor: list(valor.items()), dict),
+    "ranking": (lambda valor: list(valor.items()), dict),
+    "contratos": (lambda valor: [list(fila) for fila in valor], lambda valor: [tuple(fila) for fila in valor]),
+    "categorias": (lambda valor: valor, lambda valor: valor),
+}
+
+# user_id -> (nombre, marca de tiempo en que se obtuvo)
+nombres_usuarios: Dict[int, tuple] = {}
+
+async def nombre_usuario(user_id: int) -> str:
+    """Nombre de un usuario: caché de discord.py, luego la caché propia y, si no, la API de Discord."""
+    user = bot.get_user(user_id)
+    if user is None:
+        guardado = nombres_usuarios.get(user_id)
+        if guardado and ahora_ts() - guardado[1] < NOMBRES_TTL_SEGUNDOS:
+            return guardado[0]
+        user = await bot.fetch_user(user_id)
+    nombres_usuarios[user_id] = (user.name, ahora_ts())
+    return user.name
+
+def _origen_db() -> str:
+    """Identifica la base de datos, para no restaurar una instantánea de otra."""
+    origen = DATABASE_URL if USE_POSTGRES else os.path.abspath(DB_FILE)
+    return hashlib.sha1(origen.encode("utf-8")).hexdigest()
+
+def _versiones_y_esquema():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT cache, clave, version FROM cache_versiones")
+    versiones = {(cache, clave): version for cache, clave, version in cursor.fetchall()}
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    esquema = cursor.fetchone()[0]
+    conn.close()
+    return versiones, esquema
+
+def guardar_instantanea(ruta: Optional[str] = None) -> int:
+    """Guarda las cachés con la versión actual de cada clave. Devuelve cuántas entradas guardó."""
+    ruta = ruta or INSTANTANEA_CACHES
+    if not ruta:
+        return 0
+    # Con Postgres, un aviso de otro proceso aún en camino podría dejar aquí una clave vieja
+    # con la versión nueva; el margen es el retraso del NOTIFY en el momento del cierre.
+    entradas = {nombre: list(CACHES[nombre]._datos.items()) for nombre in _CODIFICACION_CACHES if nombre in CACHES}
+    versiones, esquema = _versiones_y_esquema()
+    caches = {}
+    for nombre, filas in entradas.items():
+        codificar = _CODIFICACION_CACHES[nombre][0]
+        caches[nombre] = [[clave, codificar(valor), versiones.get((nombre, _clave_version(clave)), 0)] for clave, valor in filas]
+    datos = {
+        "formato": FORMATO_INSTANTANEA,
+        "origen": _origen_db(),
+        "esquema": esquema,
+        "creada_en": ahora_ts(),
+        "globales": {nombre: versiones.get((nombre, "*"), 0) for nombre in caches},
+        "caches": caches,
+        "nombres": [[user_id, nombre, ts] for user_id, (nombre, ts) in list(nombres_usuarios.items())],
+    }
+    temporal = ruta + ".tmp"
+    with open(temporal, "wb") as f:
+        f.write(zlib.compress(json.dumps(datos, separators=(",", ":")).encode("utf-8")))
+    os.replace(temporal, ruta)
+    total = sum(len(filas) for filas in caches.values())
+    print(f"♨️ Instantánea de cachés guardada: {total} entradas y {len(datos['nombres'])} nombres en {ruta}")
+    return total
+
+def cargar_instantanea(ruta: Optional[str] = None) -> int:
+    """Restaura las entradas de la instantánea que siguen al día en la DB. Devuelve cuántas restauró."""
+    ruta = ruta or INSTANTANEA_CACHES
+    if not ruta or not os.path.exists(ruta):
+        return 0
+    try:
+        with open(ruta, "rb") as f:
+            datos = json.loads(zlib.decompress(f.read()))
+    except Exception as e:
+        print(f"⚠️ Instantánea de cachés ilegible ({e}); se arranca en frío")
+        return 0
+    # Una invalidación mientras se valida gana: restaurar() no pisa nada posterior
+    generaciones = {nombre: cache._generacion for nombre, cache in CACHES.items()}
+    versiones, esquema = _versiones_y_esquema()
+    if datos.get("formato") != FORMATO_INSTANTANEA or datos.get("origen") != _origen_db() or datos.get("esquema") != esquema:
+        print("⚠️ Instantánea de cachés de otra base de datos o de otro esquema; se arranca en frío")
+        return 0
+
+    restauradas = descartadas = 0
+    for nombre, filas in datos.get("caches", {}).items():
+        if nombre not in CACHES or nombre not in _CODIFICACION_CACHES:
+            continue
+        if versiones.get((nombre, "*"), 0) != datos["globales"].get(nombre, 0):
+            descartadas += len(filas)
+            continue
+        decodificar = _CODIFICACION_CACHES[nombre][1]
+        validas = [(clave, decodificar(valor)) for clave, valor, version in filas
+                   if versiones.get((nombre, _clave_version(clave)), 0) == version]
+        descartadas += len(filas) - len(validas)
+        restauradas += CACHES[nombre].restaurar(validas, generaciones[nombre])
+
+    limite = ahora_ts() - NOMBRES_TTL_SEGUNDOS
+    nombres = 0
+    for user_id, nombre, ts in datos.get("nombres", []):
+        if ts >= limite and user_id not in nombres_usuarios:
+            nombres_usuarios[user_id] = (nombre, ts)
+            nombres += 1
+    print(f"♨️ Instantánea de cachés: {restauradas} entradas restauradas, {descartadas} descartadas "
+          f"por cambios en la DB, {nombres} nombres de usuario")
+    return restauradas
+
 def init_database():
     """Inicializa la base de datos y crea las tablas si no existen"""
     conn = get_db_connection()
@@ -176,105 +717,1131 @@ def init_database():
         ''')
     
     conn.commit()
+    aplicar_migraciones(conn)
     conn.close()
 
-def get_inventario():
-    """Obtiene el inventario completo desde la base de datos"""
+# =========================
+# MIGRACIONES DE ESQUEMA
+# =========================
+# init_database crea el esquema original; cada migración lo evoluciona a partir de ahí.
+# La versión aplicada se guarda en schema_version.
+def _migracion_guild_id(cursor):
+    """Añade guild_id a las tablas de datos del clan para separar cada servidor."""
+    if USE_POSTGRES:
+        for tabla in ("inventario", "registro_usuarios", "historial", "reputacion", "contratos"):
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN guild_id BIGINT NOT NULL DEFAULT {GUILD_ID_PRINCIPAL}")
+            cursor.execute(f"ALTER TABLE {tabla} ALTER COLUMN guild_id DROP DEFAULT")
+        cursor.execute("ALTER TABLE inventario DROP CONSTRAINT inventario_pkey, ADD PRIMARY KEY (guild_id, item)")
+        cursor.execute("ALTER TABLE registro_usuarios DROP CONSTRAINT registro_usuarios_pkey, ADD PRIMARY KEY (guild_id, user_id, item)")
+        cursor.execute("ALTER TABLE reputacion DROP CONSTRAINT reputacion_pkey, ADD PRIMARY KEY (guild_id, user_id)")
+    else:
+        # SQLite no permite cambiar la clave primaria: reconstruir las tablas
+        nuevas = {
+            "inventario": '''
+                CREATE TABLE inventario (
+                    guild_id INTEGER NOT NULL,
+                    item TEXT NOT NULL,
+                    cantidad INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (guild_id, item)
+                )''',
+            "registro_usuarios": '''
+                CREATE TABLE registro_usuarios (
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    item TEXT,
+                    cantidad INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (guild_id, user_id, item)
+                )''',
+            "historial": '''
+                CREATE TABLE historial (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    timestamp TEXT,
+                    accion TEXT,
+                    item TEXT,
+                    cantidad REAL,
+                    ubicacion TEXT,
+                    usuario_relacionado TEXT
+                )''',
+            "reputacion": '''
+                CREATE TABLE reputacion (
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    puntos REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (guild_id, user_id)
+                )''',
+            "contratos": '''
+                CREATE TABLE contratos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER NOT NULL,
+                    nombre TEXT NOT NULL,
+                    enlace TEXT NOT NULL,
+                    fecha_creacion TEXT NOT NULL
+                )''',
+        }
+        for tabla, crear in nuevas.items():
+            cursor.execute(f"PRAGMA table_info({tabla})")
+            columnas = [fila[1] for fila in cursor.fetchall()]
+            cursor.execute(f"ALTER TABLE {tabla} RENAME TO {tabla}_sin_guild")
+            cursor.execute(crear)
+            lista = ", ".join(columnas)
+            cursor.execute(f"INSERT INTO {tabla} (guild_id, {lista}) SELECT ?, {lista} FROM {tabla}_sin_guild", (GUILD_ID_PRINCIPAL,))
+            cursor.execute(f"DROP TABLE {tabla}_sin_guild")
+    # Índices para que cada consulta recorra sólo la partición de su servidor
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_registro_guild_item ON registro_usuarios (guild_id, item)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_guild_user ON historial (guild_id, user_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_contratos_guild ON contratos (guild_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_contratos_guild_nombre ON contratos (guild_id, nombre)")
+
+def _migracion_webhook_inbox(cursor):
+    """Crea la bandeja de entrada durable de webhooks."""
+    if USE_POSTGRES:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_inbox (
+                id BIGSERIAL PRIMARY KEY,
+                event_id VARCHAR(64) NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                estado VARCHAR(16) NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                proximo_intento DOUBLE PRECISION NOT NULL,
+                ultimo_error TEXT,
+                recibido_en DOUBLE PRECISION NOT NULL,
+                procesado_en DOUBLE PRECISION
+            )
+        ''')
+    else:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_inbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_id TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                proximo_intento REAL NOT NULL,
+                ultimo_error TEXT,
+                recibido_en REAL NOT NULL,
+                procesado_en REAL
+            )
+        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_inbox_estado ON webhook_inbox (estado, id)")
+
+def _migracion_webhook_events_ts(cursor):
+    """Añade a webhook_events una marca de tiempo numérica e indexada para purgar por antigüedad."""
+    tipo = "DOUBLE PRECISION" if USE_POSTGRES else "REAL"
+    cursor.execute(f"ALTER TABLE webhook_events ADD COLUMN recibido_en {tipo}")
+    cursor.execute("SELECT event_id, received_at FROM webhook_events")
+    filas = []
+    for event_id, received_at in cursor.fetchall():
+        try:
+            ts = datetime.strptime(received_at, "%Y-%m-%d %H:%M:%S").timestamp()
+        except (TypeError, ValueError):
+            ts = datetime.now().timestamp()
+        filas.append((ts, event_id))
+    if filas:
+        cursor.executemany(adapt_placeholders("UPDATE webhook_events SET recibido_en = ? WHERE event_id = ?"), filas)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_recibido ON webhook_events (recibido_en)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_inbox_recibido ON webhook_inbox (estado, recibido_en)")
+
+def _migracion_historial_marca_tiempo(cursor):
+    """Añade a historial una marca de tiempo numérica (epoch) indexada por servidor."""
+    tipo = "BIGINT" if USE_POSTGRES else "INTEGER"
+    cursor.execute(f"ALTER TABLE historial ADD COLUMN marca_tiempo {tipo}")
+    cursor.execute("SELECT id, timestamp FROM historial")
+    filas = []
+    for id_fila, texto in cursor.fetchall():
+        try:
+            filas.append((int(datetime.strptime(texto, "%d/%m/%Y %H:%M:%S").timestamp()), id_fila))
+        except (TypeError, ValueError):
+            # Filas sin fecha legible: se quedan a NULL y no entran en las consultas por rango
+            pass
+    if filas:
+        cursor.executemany(adapt_placeholders("UPDATE historial SET marca_tiempo = ? WHERE id = ?"), filas)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_guild_marca ON historial (guild_id, marca_tiempo)")
+
+def _migracion_historial_archivo(cursor):
+    """Crea el archivo comprimido del historial y los resúmenes mensuales."""
+    if USE_POSTGRES:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS historial_archivo (
+                id BIGSERIAL PRIMARY KEY,
+                guild_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                mes VARCHAR(7) NOT NULL,
+                desde_id BIGINT NOT NULL,
+                hasta_id BIGINT NOT NULL,
+                filas INTEGER NOT NULL,
+                datos BYTEA NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS historial_mensual (
+                guild_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                mes VARCHAR(7) NOT NULL,
+                accion VARCHAR(64) NOT NULL,
+                item VARCHAR(255) NOT NULL,
+                total DOUBLE PRECISION NOT NULL DEFAULT 0,
+                movimientos INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (guild_id, user_id, mes, accion, item)
+            )
+        ''')
+    else:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS historial_archivo (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                mes TEXT NOT NULL,
+                desde_id INTEGER NOT NULL,
+                hasta_id INTEGER NOT NULL,
+                filas INTEGER NOT NULL,
+                datos BLOB NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS historial_mensual (
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                mes TEXT NOT NULL,
+                accion TEXT NOT NULL,
+                item TEXT NOT NULL,
+                total REAL NOT NULL DEFAULT 0,
+                movimientos INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (guild_id, user_id, mes, accion, item)
+            )
+        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_archivo_usuario ON historial_archivo (guild_id, user_id, hasta_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_marca ON historial (marca_tiempo)")
+
+def _migracion_items(cursor):
+    """Sustituye los nombres de objeto por ids de la tabla items en las tablas de datos."""
+    if USE_POSTGRES:
+        cursor.execute("CREATE TABLE IF NOT EXISTS items (id SERIAL PRIMARY KEY, nombre VARCHAR(255) NOT NULL UNIQUE)")
+    else:
+        cursor.execute("CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, nombre TEXT NOT NULL UNIQUE)")
+    tablas = ("inventario", "registro_usuarios", "historial", "item_categoria", "historial_mensual")
+    union = " UNION ".join(f"SELECT item FROM {tabla}" for tabla in tablas)
+    cursor.execute(f"INSERT INTO items (nombre) SELECT item FROM ({union}) t WHERE item IS NOT NULL AND item <> '' ORDER BY item")
+
+    if USE_POSTGRES:
+        for tabla in tablas:
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN item_id INTEGER")
+            cursor.execute(f"UPDATE {tabla} t SET item_id = i.id FROM items i WHERE i.nombre = t.item")
+        cursor.execute("UPDATE historial_mensual SET item_id = 0 WHERE item_id IS NULL")
+        claves = {
+            "inventario": "guild_id, item_id",
+            "registro_usuarios": "guild_id, user_id, item_id",
+            "item_categoria": "item_id",
+            "historial_mensual": "guild_id, user_id, mes, accion, item_id",
+        }
+        for tabla, clave in claves.items():
+            cursor.execute(f"ALTER TABLE {tabla} DROP CONSTRAINT {tabla}_pkey")
+            cursor.execute(f"ALTER TABLE {tabla} DROP COLUMN item")
+            cursor.execute(f"ALTER TABLE {tabla} ALTER COLUMN item_id SET NOT NULL, ADD PRIMARY KEY ({clave})")
+        cursor.execute("ALTER TABLE historial DROP COLUMN item")
+    else:
+        # SQLite: reconstruir las tablas con item_id en lugar de item
+        nuevas = {
+            "inventario": '''
+                CREATE TABLE inventario (
+                    guild_id INTEGER NOT NULL,
+                    item_id INTEGER NOT NULL,
+                    cantidad INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (guild_id, item_id)
+                )''',
+            "registro_usuarios": '''
+                CREATE TABLE registro_usuarios (
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    item_id INTEGER NOT NULL,
+                    cantidad INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (guild_id, user_id, item_id)
+                )''',
+            "historial": '''
+                CREATE TABLE historial (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    timestamp TEXT,
+                    marca_tiempo INTEGER,
+                    accion TEXT,
+                    item_id INTEGER,
+                    cantidad REAL,
+                    ubicacion TEXT,
+                    usuario_relacionado TEXT
+                )''',
+            "item_categoria": '''
+                CREATE TABLE item_categoria (
+                    item_id INTEGER PRIMARY KEY,
+                    categoria TEXT NOT NULL
+                )''',
+            "historial_mensual": '''
+                CREATE TABLE historial_mensual (
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    mes TEXT NOT NULL,
+                    accion TEXT NOT NULL,
+                    item_id INTEGER NOT NULL,
+                    total REAL NOT NULL DEFAULT 0,
+                    movimientos INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (guild_id, user_id, mes, accion, item_id)
+                )''',
+        }
+        for tabla, crear in nuevas.items():
+            cursor.execute(f"PRAGMA table_info({tabla})")
+            columnas = [fila[1] for fila in cursor.fetchall() if fila[1] != "item"]
+            cursor.execute(f"ALTER TABLE {tabla} RENAME TO {tabla}_por_nombre")
+            cursor.execute(crear)
+            lista = ", ".join(columnas)
+            origen = ", ".join(f"t.{columna}" for columna in columnas)
+            cursor.execute(f'''
+                INSERT INTO {tabla} ({lista}, item_id)
+                SELECT {origen}, COALESCE(i.id, {0 if tabla == "historial_mensual" else "NULL"})
+                FROM {tabla}_por_nombre t LEFT JOIN items i ON i.nombre = t.item
+            ''')
+            cursor.execute(f"DROP TABLE {tabla}_por_nombre")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_guild_user ON historial (guild_id, user_id, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_guild_marca ON historial (guild_id, marca_tiempo)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_marca ON historial (marca_tiempo)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_registro_guild_item ON registro_usuarios (guild_id, item_id)")
+
+def _migracion_checkpoints_saldos(cursor):
+    """Crea las tablas de checkpoints de saldos para reproducir el historial."""
+    if USE_POSTGRES:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS saldos_checkpoint (
+                id BIGSERIAL PRIMARY KEY,
+                guild_id BIGINT NOT NULL,
+                hasta_id BIGINT NOT NULL,
+                marca_tiempo BIGINT NOT NULL,
+                creado_en DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS saldos_checkpoint_filas (
+                checkpoint_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                item_id INTEGER NOT NULL,
+                cantidad DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (checkpoint_id, user_id, item_id)
+            )
+        ''')
+    else:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS saldos_checkpoint (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild_id INTEGER NOT NULL,
+                hasta_id INTEGER NOT NULL,
+                marca_tiempo INTEGER NOT NULL,
+                creado_en REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS saldos_checkpoint_filas (
+                checkpoint_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                item_id INTEGER NOT NULL,
+                cantidad REAL NOT NULL,
+                PRIMARY KEY (checkpoint_id, user_id, item_id)
+            )
+        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_saldos_checkpoint_guild ON saldos_checkpoint (guild_id, hasta_id)")
+
+def _migracion_versiones_cache(cursor):
+    """Crea la tabla de versiones por clave de caché que valida la instantánea al arrancar."""
+    tipo_version = "BIGINT" if USE_POSTGRES else "INTEGER"
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS cache_versiones (
+            cache VARCHAR(32) NOT NULL,
+            clave VARCHAR(255) NOT NULL,
+            version {tipo_version} NOT NULL,
+            PRIMARY KEY (cache, clave)
+        )
+    ''')
+
+def _migracion_lider_inbox(cursor):
+    """Crea el turno (lease) que reparte entre procesos quién vacía la bandeja de webhooks."""
+    tipo_hasta = "DOUBLE PRECISION" if USE_POSTGRES else "REAL"
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS webhook_inbox_lider (
+            id INTEGER PRIMARY KEY,
+            duenio VARCHAR(64),
+            hasta {tipo_hasta} NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT INTO webhook_inbox_lider (id, duenio, hasta) VALUES (1, NULL, 0)")
+
+def _migracion_categorias_canonicas(cursor):
+    """Pasa las categorías del id del nombre en minúsculas al id del nombre canónico."""
+    # Las filas de items en minúsculas que quedan sin uso no se borran: otros procesos
+    # pueden tener su id en memoria
+    cursor.execute("SELECT id, nombre FROM items")
+    items = cursor.fetchall()
+    canonico = {}
+    for item_id, nombre in items:
+        if nombre != nombre.lower():
+            canonico.setdefault(nombre.lower(), item_id)
+    nombre_de = dict(items)
+    cursor.execute("SELECT item_id, categoria FROM item_categoria")
+    categorias_por_id = dict(cursor.fetchall())
+    for item_id, categoria in list(categorias_por_id.items()):
+        destino = canonico.get(nombre_de.get(item_id))
+        if destino is None:
+            continue
+        cursor.execute(adapt_placeholders("DELETE FROM item_categoria WHERE item_id = ?"), (item_id,))
+        # Si el canónico ya tenía categoría propia, se queda la suya
+        if destino not in categorias_por_id:
+            cursor.execute(adapt_placeholders("INSERT INTO item_categoria (item_id, categoria) VALUES (?, ?)"), (destino, categoria))
+            categorias_por_id[destino] = categoria
+
+MIGRACIONES = [
+    (2, _migracion_guild_id),
+    (3, _migracion_webhook_inbox),
+    (4, _migracion_webhook_events_ts),
+    (5, _migracion_historial_marca_tiempo),
+    (6, _migracion_historial_archivo),
+    (7, _migracion_items),
+    (8, _migracion_checkpoints_saldos),
+    (9, _migracion_versiones_cache),
+    (10, _migracion_lider_inbox),
+    (11, _migracion_categorias_canonicas),
+]
+
+def aplicar_migraciones(conn):
+    """Aplica en orden las migraciones pendientes, cada una en su propia transacción."""
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    fila = cursor.fetchone()
+    version = fila[0] if fila and fila[0] is not None else 1
+    conn.commit()
+    for numero, migracion in MIGRACIONES:
+        if numero <= version:
+            continue
+        print(f"🛠️ Aplicando migración {numero}: {migracion.__doc__.strip()}")
+        try:
+            migracion(cursor)
+            cursor.execute(adapt_placeholders("INSERT INTO schema_version (version) VALUES (?)"), (numero,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def adoptar_datos_sin_servidor(guild_id: int) -> int:
+    """Asigna al servidor indicado los datos migrados sin servidor (guild_id = 0). Devuelve filas movidas."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    movidas = 0
+    try:
+        for tabla in ("inventario", "registro_usuarios", "historial", "reputacion", "contratos"):
+            cursor.execute(adapt_placeholders(f"UPDATE {tabla} SET guild_id = ? WHERE guild_id = 0"), (guild_id,))
+            movidas += max(cursor.rowcount, 0)
+        confirmar_cambios(conn, cursor, [("inventario", guild_id), ("ranking", guild_id), ("contratos", guild_id)])
+        vaciar_caches()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return movidas
+
+# Segundos que MapaItems da por buena una búsqueda sin resultado antes de repetirla
+MAPA_ITEMS_FALLO_TTL = 60
+
+class MapaItems:
+    """Traducción nombre ↔ id de la tabla items, en memoria.
+
+    Los ids no cambian ni se borran, así que el mapa sólo crece y no hay que invalidarlo
+    entre procesos: lo que no conoce lo busca en la DB. Sólo guarda ids ya confirmados.
+    Los nombres que no existen se recuerdan MAPA_ITEMS_FALLO_TTL segundos (otro proceso
+    puede crearlos); los que crea este proceso se olvidan al momento.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._nombres: Dict[int, str] = {}
+        self._por_norma: Dict[str, int] = {}   # nombre en minúsculas -> id del nombre canónico
+        self._fallos: Dict[str, float] = {}
+        self._cargado = False
+        self._bloqueo = threading.Lock()
+
+    def _consultar(self, columna=None, valores=()):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if columna is None:
+            cursor.execute("SELECT id, nombre FROM items")
+        else:
+            cursor.execute(adapt_placeholders(f"SELECT id, nombre FROM items WHERE {columna} IN ({_marcadores(len(valores))})"), list(valores))
+        filas = cursor.fetchall()
+        conn.close()
+        with self._bloqueo:
+            for item_id, nombre in filas:
+                self._ids[nombre] = item_id
+                self._nombres[item_id] = nombre
+                self._fallos.pop(nombre, None)
+                norma = nombre.lower()
+                # Si hay variantes que sólo difieren en mayúsculas, manda la que no está en minúsculas
+                if norma not in self._por_norma or nombre != norma:
+                    self._por_norma[norma] = item_id
+                    self._fallos.pop(norma, None)
+            if columna is None:
+                self._cargado = True
+
+    def _pendientes(self, nombres, conocidos, confiar_en_fallos: bool):
+        ahora = perf_counter()
+        return [n for n in set(nombres) if n not in conocidos
+                and not (confiar_en_fallos and ahora - self._fallos.get(n, float("-inf")) < MAPA_ITEMS_FALLO_TTL)]
+
+    def _apuntar_fallos(self, nombres, conocidos):
+        ahora = perf_counter()
+        with self._bloqueo:
+            for n in nombres:
+                if n not in conocidos:
+                    self._fallos[n] = ahora
+
+    def ids(self, nombres, confiar_en_fallos: bool = True) -> Dict[str, int]:
+        """Ids de los nombres que existen (los que no existen no aparecen)."""
+        faltan = self._pendientes(nombres, self._ids, confiar_en_fallos)
+        if faltan and not self._cargado:
+            self._consultar()
+        elif faltan:
+            self._consultar("nombre", faltan)
+        self._apuntar_fallos(faltan, self._ids)
+        return {n: self._ids[n] for n in nombres if n in self._ids}
+
+    def id(self, nombre: str, confiar_en_fallos: bool = True) -> Optional[int]:
+        return self.ids([nombre], confiar_en_fallos).get(nombre)
+
+    def id_normalizado(self, nombre: str) -> Optional[int]:
+        """Id del nombre canónico que coincide con `nombre` sin distinguir mayúsculas."""
+        norma = nombre.lower()
+        faltan = self._pendientes([norma], self._por_norma, True)
+        if faltan and not self._cargado:
+            self._consultar()
+        elif faltan:
+            self._consultar("lower(nombre)", faltan)
+        self._apuntar_fallos(faltan, self._por_norma)
+        return self._por_norma.get(norma)
+
+    def nombres(self, ids) -> Dict[int, str]:
+        faltan = [i for i in set(ids) if i not in self._nombres]
+        if faltan and not self._cargado:
+            self._consultar()
+        elif faltan:
+            self._consultar("id", faltan)
+        return {i: self._nombres.get(i) for i in ids}
+
+    def asegurar(self, nombres) -> Dict[str, int]:
+        """Como ids(), pero crea y confirma los que falten.
+
+        Usa su propia conexión: llamarla antes de abrir la transacción de escritura.
+        """
+        ids = self.ids(nombres)
+        faltan = [n for n in set(nombres) if n not in ids]
+        if faltan:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.executemany(adapt_placeholders("INSERT INTO items (nombre) VALUES (?) ON CONFLICT (nombre) DO NOTHING"), [(n,) for n in faltan])
+            conn.commit()
+            conn.close()
+            self._consultar("nombre", faltan)
+            ids = self.ids(nombres)
+        return ids
+
+    def ids_en_cursor(self, cursor, nombres) -> Dict[str, int]:
+        """Ids para escribir dentro de una transacción abierta.
+
+        Los que no estén en el mapa se crean en la misma transacción y no se guardan
+        en el mapa (podría deshacerse); una lectura posterior ya confirmada los añadirá.
+        """
+        resultado = {n: self._ids[n] for n in nombres if n in self._ids}
+        faltan = [n for n in set(nombres) if n not in resultado]
+        if faltan:
+            with self._bloqueo:
+                for n in faltan:
+                    self._fallos.pop(n, None)
+                    self._fallos.pop(n.lower(), None)
+            cursor.executemany(adapt_placeholders("INSERT INTO items (nombre) VALUES (?) ON CONFLICT (nombre) DO NOTHING"), [(n,) for n in faltan])
+            cursor.execute(adapt_placeholders(f"SELECT id, nombre FROM items WHERE nombre IN ({_marcadores(len(faltan))})"), faltan)
+            resultado.update({nombre: item_id for item_id, nombre in cursor.fetchall()})
+        return resultado
+
+mapa_items = MapaItems()
+
+def _con_nombres(filas, posicion: int):
+    """Sustituye el item_id de la columna `posicion` de cada fila por el nombre del objeto."""
+    nombres = mapa_items.nombres([fila[posicion] for fila in filas if fila[posicion] is not None])
+    return [tuple(fila[:posicion]) + (nombres.get(fila[posicion]),) + tuple(fila[posicion + 1:]) for fila in filas]
+
+def get_inventario(guild_id):
+    """Obtiene el inventario completo de un servidor (en memoria; devuelve una copia)"""
+    return inventario_banco.copia(guild_id)
+
+def get_cantidad_banco(guild_id, item):
+    """Cantidad de un objeto en el banco del servidor, o None si no tiene fila (sin copiar el inventario)"""
+    return inventario_banco.cantidad(guild_id, item)
+
+def _get_inventario_db(guild_id):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT item, cantidad FROM inventario")
-    inventario = dict(cursor.fetchall())
+    cursor.execute(adapt_placeholders("SELECT item_id, cantidad FROM inventario WHERE guild_id = ?"), (guild_id,))
+    inventario = dict(_con_nombres(cursor.fetchall(), 0))
     conn.close()
     return inventario
 
-def get_registro_usuario(user_id):
+def get_registro_usuario(guild_id, user_id):
     """Obtiene el registro de un usuario específico"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(adapt_placeholders("SELECT item, cantidad FROM registro_usuarios WHERE user_id = ?"), (user_id,))
-    registro = dict(cursor.fetchall())
+    cursor.execute(adapt_placeholders("SELECT item_id, cantidad FROM registro_usuarios WHERE guild_id = ? AND user_id = ?"), (guild_id, user_id))
+    registro = dict(_con_nombres(cursor.fetchall(), 0))
     conn.close()
     return registro
 
-def get_historial_usuario(user_id):
-    """Obtiene el historial de un usuario específico"""
+def get_reparto_inventario(guild_id):
+    """Quién ha aportado cada objeto del banco: {item: [(user_id, cantidad), ...]} en una sola consulta"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(adapt_placeholders("SELECT item_id, user_id, cantidad FROM registro_usuarios WHERE guild_id = ? AND cantidad > 0"), (guild_id,))
+    reparto = {}
+    for item, uid, cantidad in _con_nombres(cursor.fetchall(), 0):
+        reparto.setdefault(item, []).append((uid, cantidad))
+    conn.close()
+    return reparto
+
+def get_historial_usuario(guild_id, user_id, incluir_archivo=False):
+    """Obtiene el historial de un usuario específico (sólo lo reciente salvo que se pida el archivo)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    historial = []
+    if incluir_archivo:
+        cursor.execute(adapt_placeholders("SELECT datos FROM historial_archivo WHERE guild_id = ? AND user_id = ? ORDER BY hasta_id"), (guild_id, user_id))
+        for (datos,) in cursor.fetchall():
+            historial += [tuple(fila[1:2] + fila[3:]) for fila in json.loads(zlib.decompress(bytes(datos)))]
+    cursor.execute(adapt_placeholders("SELECT timestamp, accion, item_id, cantidad, ubicacion, usuario_relacionado FROM historial WHERE guild_id = ? AND user_id = ? ORDER BY id"), (guild_id, user_id))
+    historial += _con_nombres(cursor.fetchall(), 2)
+    conn.close()
+    return historial
+
+def _desde_hace_dias(dias: float) -> int:
+    return int(datetime.now().timestamp() - dias * 86400)
+
+# Zona horaria de los días y meses de las estadísticas y del archivo. Es la misma con
+# SQLite y con Postgres, y no depende de la del servidor ni de la sesión de la DB.
+try:
+    ZONA_HORARIA = ZoneInfo(os.getenv("ZONA_HORARIA", "Europe/Madrid"))
+except (ZoneInfoNotFoundError, ValueError) as e:
+    print(f"⚠️ ZONA_HORARIA no válida ({e}); se usa UTC")
+    ZONA_HORARIA = ZoneInfo("UTC")
+
+def _fecha_local(marca_tiempo) -> datetime:
+    return datetime.fromtimestamp(marca_tiempo, ZONA_HORARIA)
+
+def _dia_local(marca_tiempo):
+    return None if marca_tiempo is None else _fecha_local(marca_tiempo).strftime("%Y-%m-%d")
+
+def _mes_local(marca_tiempo):
+    return None if marca_tiempo is None else _fecha_local(marca_tiempo).strftime("%Y-%m")
+
+def _expr_dia(columna: str) -> str:
+    """Expresión SQL que convierte una marca epoch en el día 'AAAA-MM-DD' de ZONA_HORARIA."""
+    if USE_POSTGRES:
+        return f"to_char(to_timestamp({columna}) AT TIME ZONE '{ZONA_HORARIA.key}', 'YYYY-MM-DD')"
+    return f"dia_local({columna})"
+
+def _expr_mes(columna: str) -> str:
+    """Expresión SQL que convierte una marca epoch en el mes 'AAAA-MM' de ZONA_HORARIA."""
+    if USE_POSTGRES:
+        return f"to_char(to_timestamp({columna}) AT TIME ZONE '{ZONA_HORARIA.key}', 'YYYY-MM')"
+    return f"mes_local({columna})"
+
+def get_resumen_mensual(guild_id, user_id):
+    """Totales por mes, acción y objeto de un usuario, sumando los resúmenes archivados y el historial reciente"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    mes = _expr_mes("marca_tiempo")
+    cursor.execute(adapt_placeholders(f'''
+        SELECT mes, accion, item_id, SUM(total), SUM(movimientos)
+        FROM (
+            SELECT mes, accion, item_id, total, movimientos
+            FROM historial_mensual WHERE guild_id = ? AND user_id = ?
+            UNION ALL
+            SELECT {mes} AS mes, accion, COALESCE(item_id, 0) AS item_id, SUM(cantidad) AS total, COUNT(*) AS movimientos
+            FROM historial WHERE guild_id = ? AND user_id = ? AND marca_tiempo IS NOT NULL
+            GROUP BY {mes}, accion, COALESCE(item_id, 0)
+        ) t
+        GROUP BY mes, accion, item_id
+        ORDER BY mes DESC, accion, item_id
+    '''), (guild_id, user_id, guild_id, user_id))
+    filas = _con_nombres(cursor.fetchall(), 2)
+    conn.close()
+    return filas
+
+def get_historial_rango(guild_id, desde: datetime, hasta: Optional[datetime] = None, user_id=None):
+    """Movimientos de un servidor (o de un usuario) entre dos fechas, usando el índice por marca de tiempo"""
+    condiciones = "guild_id = ? AND marca_tiempo >= ? AND marca_tiempo < ?"
+    parametros = [guild_id, int(desde.timestamp()), int((hasta or datetime.now()).timestamp()) + 1]
+    if user_id is not None:
+        condiciones += " AND user_id = ?"
+        parametros.append(user_id)
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(adapt_placeholders("SELECT timestamp, accion, item, cantidad, ubicacion, usuario_relacionado FROM historial WHERE user_id = ? ORDER BY id"), (user_id,))
-    historial = cursor.fetchall()
+    cursor.execute(adapt_placeholders(f"SELECT user_id, timestamp, accion, item_id, cantidad, ubicacion, usuario_relacionado FROM historial WHERE {condiciones} ORDER BY marca_tiempo, id"), parametros)
+    historial = _con_nombres(cursor.fetchall(), 3)
     conn.close()
     return historial
 
-def get_reputacion_usuario(user_id):
+def get_depositos_por_dia(guild_id, dias: float = 7):
+    """Cantidad depositada por objeto y día en los últimos `dias` días: [(día, item, total)]"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    dia = _expr_dia("marca_tiempo")
+    cursor.execute(adapt_placeholders(f'''
+        SELECT {dia} AS dia, item_id, SUM(cantidad) AS total
+        FROM historial
+        WHERE guild_id = ? AND marca_tiempo >= ? AND accion = 'Añadido'
+        GROUP BY {dia}, item_id
+        ORDER BY dia, total DESC
+    '''), (guild_id, _desde_hace_dias(dias)))
+    filas = _con_nombres(cursor.fetchall(), 1)
+    conn.close()
+    return filas
+
+def get_top_contribuyentes(guild_id, dias: float = 7, limite: int = 10):
+    """Usuarios que más han aportado en los últimos `dias` días: [(user_id, reputación ganada, objetos añadidos)]"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(adapt_placeholders('''
+        SELECT user_id,
+               SUM(CASE WHEN accion = 'Ganó Reputación' THEN cantidad ELSE 0 END) AS reputacion,
+               SUM(CASE WHEN accion = 'Añadido' THEN cantidad ELSE 0 END) AS objetos
+        FROM historial
+        WHERE guild_id = ? AND marca_tiempo >= ? AND accion IN ('Añadido', 'Ganó Reputación')
+        GROUP BY user_id
+        ORDER BY reputacion DESC, objetos DESC
+        LIMIT ?
+    '''), (guild_id, _desde_hace_dias(dias), limite))
+    filas = cursor.fetchall()
+    conn.close()
+    return filas
+
+# -----------------
+# ARCHIVO DEL HISTORIAL
+# -----------------
+# Los movimientos más antiguos que esto salen de la tabla caliente al archivo comprimido
+HISTORIAL_ARCHIVO_DIAS = float(os.getenv("HISTORIAL_ARCHIVO_DIAS", "90"))
+HISTORIAL_ARCHIVO_LOTE = 2000
+
+def archivar_historial(dias: float = HISTORIAL_ARCHIVO_DIAS) -> int:
+    """Mueve al archivo los movimientos con más de `dias` días y acumula sus resúmenes mensuales.
+
+    Sólo archiva lo que ya cubre el último checkpoint de saldos de cada servidor. Cada tanda
+    se archiva, resume y borra en una misma transacción. Devuelve cuántas filas movió.
+    """
+    limite = _desde_hace_dias(dias)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    archivadas = 0
+    try:
+        while True:
+            cursor.execute(adapt_placeholders('''
+                SELECT id, guild_id, user_id, timestamp, marca_tiempo, accion, item_id, cantidad, ubicacion, usuario_relacionado
+                FROM historial
+                WHERE marca_tiempo < ?
+                  AND id <= COALESCE((SELECT MAX(c.hasta_id) FROM saldos_checkpoint c WHERE c.guild_id = historial.guild_id), 0)
+                ORDER BY marca_tiempo, id LIMIT ?
+            '''), (limite, HISTORIAL_ARCHIVO_LOTE))
+            filas = cursor.fetchall()
+            if not filas:
+                break
+            # El archivo guarda los nombres para poder leerse por sí solo
+            nombres = mapa_items.nombres([fila[6] for fila in filas if fila[6] is not None])
+            grupos: Dict[tuple, list] = {}
+            resumen: Dict[tuple, list] = {}
+            for id_fila, guild_id, user_id, timestamp, marca_tiempo, accion, item_id, cantidad, ubicacion, usuario_rel in filas:
+                mes = _mes_local(marca_tiempo)
+                grupos.setdefault((guild_id, user_id, mes), []).append(
+                    [id_fila, timestamp, marca_tiempo, accion, nombres.get(item_id), cantidad, ubicacion, usuario_rel])
+                acumulado = resumen.setdefault((guild_id, user_id, mes, accion or "", item_id or 0), [0, 0])
+                acumulado[0] += cantidad or 0
+                acumulado[1] += 1
+            cursor.executemany(adapt_placeholders(
+                "INSERT INTO historial_archivo (guild_id, user_id, mes, desde_id, hasta_id, filas, datos) VALUES (?, ?, ?, ?, ?, ?, ?)"
+            ), [(guild_id, user_id, mes, filas_grupo[0][0], filas_grupo[-1][0], len(filas_grupo),
+                 zlib.compress(json.dumps(filas_grupo, ensure_ascii=False).encode("utf-8"), 9))
+                for (guild_id, user_id, mes), filas_grupo in grupos.items()])
+            cursor.executemany(adapt_placeholders('''
+                INSERT INTO historial_mensual (guild_id, user_id, mes, accion, item_id, total, movimientos) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (guild_id, user_id, mes, accion, item_id) DO UPDATE
+                SET total = historial_mensual.total + excluded.total, movimientos = historial_mensual.movimientos + excluded.movimientos
+            '''), [clave + tuple(valores) for clave, valores in resumen.items()])
+            ids = [fila[0] for fila in filas]
+            cursor.execute(adapt_placeholders(f"DELETE FROM historial WHERE id IN ({_marcadores(len(ids))})"), ids)
+            conn.commit()
+            archivadas += len(filas)
+            if len(filas) < HISTORIAL_ARCHIVO_LOTE:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if archivadas:
+        print(f"🗄️ Historial archivado: {archivadas} movimientos con más de {dias:g} días")
+    return archivadas
+
+# -----------------
+# REPLAY DE SALDOS Y CHECKPOINTS
+# -----------------
+# Movimientos del historial que cambian saldos; la reputación es el saldo del objeto "Reputación"
+ACCIONES_SALDO = ("Añadido", "Retirado", "Transferido", "Recibido", "Ganó Reputación")
+CHECKPOINTS_CONSERVAR = int(os.getenv("CHECKPOINTS_CONSERVAR", "30"))
+# Un checkpoint sólo cubre movimientos con al menos este margen, para no dejarse
+# ninguna transacción que aún no hubiera hecho commit
+CHECKPOINT_MARGEN_SEGUNDOS = 60
+REPLAY_TANDA = 5000
+# Los traspasos antiguos guardaban "objeto → usuario" (o "objeto ← usuario") como nombre
+PATRON_TRASPASO = re.compile(r" [→←] ")
+
+def _cursor_en_streaming(conn, nombre: str):
+    """Cursor que trae las filas por tandas (server-side en Postgres; SQLite ya lee fila a fila)."""
+    if isinstance(conn, sqlite3.Connection):
+        return conn.cursor()
+    cursor = conn.cursor(name=nombre)
+    cursor.itersize = REPLAY_TANDA
+    return cursor
+
+def _checkpoint_base(cursor, guild_id, hasta_ts=None):
+    """Último checkpoint del servidor (o el último válido en `hasta_ts`): (id, hasta_id) o None."""
+    condicion = " AND marca_tiempo <= ?" if hasta_ts is not None else ""
+    parametros = [guild_id] + ([hasta_ts] if hasta_ts is not None else [])
+    cursor.execute(adapt_placeholders(f"SELECT id, hasta_id FROM saldos_checkpoint WHERE guild_id = ?{condicion} ORDER BY hasta_id DESC LIMIT 1"), parametros)
+    return cursor.fetchone()
+
+def _cargar_checkpoint(cursor, checkpoint_id) -> Dict[tuple, float]:
+    cursor.execute(adapt_placeholders("SELECT user_id, item_id, cantidad FROM saldos_checkpoint_filas WHERE checkpoint_id = ?"), (checkpoint_id,))
+    return {(user_id, item_id): cantidad for user_id, item_id, cantidad in cursor.fetchall()}
+
+def _sumar_movimientos(conn, guild_id, saldos, desde_id, hasta_id=None, hasta_ts=None):
+    """Suma a `saldos` {(user_id, item_id): cantidad} los movimientos posteriores a `desde_id`.
+
+    Lee el historial (y los tramos ya archivados) en streaming, así que la memoria depende
+    del número de saldos y no de la longitud del historial.
+    """
+    def _objeto(nombre):
+        return PATRON_TRASPASO.split(nombre)[0] if nombre else nombre
+
+    cursor = _cursor_en_streaming(conn, "replay_archivo")
+    cursor.execute(adapt_placeholders("SELECT user_id, datos FROM historial_archivo WHERE guild_id = ? AND hasta_id > ?"), (guild_id, desde_id))
+    for user_id, datos in cursor:
+        filas = json.loads(zlib.decompress(bytes(datos)))
+        ids = mapa_items.ids({_objeto(fila[4]) for fila in filas if fila[4]} | {fila[4] for fila in filas if fila[4]})
+        for id_fila, _, marca_tiempo, accion, nombre, cantidad, _, _ in filas:
+            if (id_fila <= desde_id or accion not in ACCIONES_SALDO or nombre not in ids
+                    or (hasta_id is not None and id_fila > hasta_id)
+                    or (hasta_ts is not None and marca_tiempo > hasta_ts)):
+                continue
+            clave = (user_id, ids.get(_objeto(nombre), ids[nombre]))
+            saldos[clave] = saldos.get(clave, 0) + (cantidad or 0)
+    cursor.close()
+
+    traspasos: Dict[int, int] = {}
+    def _id_objeto(item_id):
+        if item_id not in traspasos:
+            nombre = mapa_items.nombres([item_id])[item_id]
+            traspasos[item_id] = mapa_items.id(_objeto(nombre)) or item_id
+        return traspasos[item_id]
+
+    condiciones = f"guild_id = ? AND id > ? AND item_id IS NOT NULL AND accion IN ({_marcadores(len(ACCIONES_SALDO))})"
+    parametros = [guild_id, desde_id] + list(ACCIONES_SALDO)
+    if hasta_id is not None:
+        condiciones += " AND id <= ?"
+        parametros.append(hasta_id)
+    if hasta_ts is not None:
+        condiciones += " AND marca_tiempo <= ?"
+        parametros.append(hasta_ts)
+    cursor = _cursor_en_streaming(conn, "replay_historial")
+    cursor.execute(adapt_placeholders(f"SELECT user_id, item_id, accion, cantidad FROM historial WHERE {condiciones}"), parametros)
+    for user_id, item_id, accion, cantidad in cursor:
+        clave = (user_id, _id_objeto(item_id) if accion in ("Transferido", "Recibido") else item_id)
+        saldos[clave] = saldos.get(clave, 0) + (cantidad or 0)
+    cursor.close()
+    return saldos
+
+def crear_checkpoint(guild_id) -> Optional[int]:
+    """Guarda los saldos del servidor reproduciendo el historial desde el checkpoint anterior.
+
+    Devuelve el id del checkpoint, o None si no había movimientos nuevos.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        corte = int(ahora_ts() - CHECKPOINT_MARGEN_SEGUNDOS)
+        cursor.execute(adapt_placeholders("SELECT MAX(id) FROM historial WHERE guild_id = ? AND marca_tiempo < ?"), (guild_id, corte))
+        hasta_id = cursor.fetchone()[0]
+        base = _checkpoint_base(cursor, guild_id)
+        if hasta_id is None or (base and hasta_id <= base[1]):
+            return None
+        saldos = _cargar_checkpoint(cursor, base[0]) if base else {}
+        _sumar_movimientos(conn, guild_id, saldos, base[1] if base else 0, hasta_id=hasta_id)
+
+        cursor.execute(adapt_placeholders("INSERT INTO saldos_checkpoint (guild_id, hasta_id, marca_tiempo, creado_en) VALUES (?, ?, ?, ?) RETURNING id"),
+                       (guild_id, hasta_id, corte, ahora_ts()))
+        checkpoint_id = cursor.fetchone()[0]
+        cursor.executemany(adapt_placeholders("INSERT INTO saldos_checkpoint_filas (checkpoint_id, user_id, item_id, cantidad) VALUES (?, ?, ?, ?)"),
+                           [(checkpoint_id, user_id, item_id, cantidad) for (user_id, item_id), cantidad in saldos.items() if abs(cantidad) > 1e-9])
+        # Conservar sólo los más recientes; los anteriores se pueden rehacer desde el historial y el archivo
+        cursor.execute(adapt_placeholders("SELECT id FROM saldos_checkpoint WHERE guild_id = ? ORDER BY hasta_id DESC"), (guild_id,))
+        viejos = [fila[0] for fila in cursor.fetchall()][CHECKPOINTS_CONSERVAR:]
+        if viejos:
+            marcas = _marcadores(len(viejos))
+            cursor.execute(adapt_placeholders(f"DELETE FROM saldos_checkpoint_filas WHERE checkpoint_id IN ({marcas})"), viejos)
+            cursor.execute(adapt_placeholders(f"DELETE FROM saldos_checkpoint WHERE id IN ({marcas})"), viejos)
+        conn.commit()
+        return checkpoint_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def reconstruir_saldos(guild_id, hasta: Optional[datetime] = None) -> Dict[tuple, float]:
+    """Saldos {(user_id, item_id): cantidad} a partir del checkpoint más cercano y del historial posterior.
+
+    Una fecha `hasta` sin zona se entiende en ZONA_HORARIA, no en la del servidor.
+    """
+    if hasta and hasta.tzinfo is None:
+        hasta = hasta.replace(tzinfo=ZONA_HORARIA)
+    hasta_ts = int(hasta.timestamp()) if hasta else None
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        base = _checkpoint_base(cursor, guild_id, hasta_ts)
+        saldos = _cargar_checkpoint(cursor, base[0]) if base else {}
+        return _sumar_movimientos(conn, guild_id, saldos, base[1] if base else 0, hasta_ts=hasta_ts)
+    finally:
+        conn.close()
+
+def saldos_en_fecha(guild_id, fecha: datetime):
+    """Lo que había en el banco en una fecha: {"inventario": {item: cantidad}, "registro": {user_id: {item: cantidad}}, "reputacion": {user_id: puntos}}"""
+    return _agrupar_saldos(reconstruir_saldos(guild_id, fecha))
+
+def _agrupar_saldos(saldos):
+    """Pasa {(user_id, item_id): cantidad} a inventario, registro por usuario y reputación."""
+    id_reputacion = mapa_items.id("Reputación")
+    nombres = mapa_items.nombres([item_id for _, item_id in saldos])
+    inventario: Dict[str, float] = {}
+    registro: Dict[int, Dict[str, float]] = {}
+    reputacion: Dict[int, float] = {}
+    for (user_id, item_id), cantidad in saldos.items():
+        if abs(cantidad) < 1e-9:
+            continue
+        if item_id == id_reputacion:
+            reputacion[user_id] = cantidad
+            continue
+        nombre = nombres[item_id]
+        inventario[nombre] = inventario.get(nombre, 0) + cantidad
+        registro.setdefault(user_id, {})[nombre] = cantidad
+    return {"inventario": inventario, "registro": registro, "reputacion": reputacion}
+
+def _empezar_lectura_consistente(conn, cursor):
+    """Abre una transacción de lectura en la que todas las consultas ven la misma foto de la DB."""
+    if isinstance(conn, sqlite3.Connection):
+        cursor.execute("BEGIN")
+    else:
+        # Snapshot de Postgres: no bloquea a quien escribe mientras tanto
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+
+def verificar_saldos(guild_id):
+    """Compara las tablas de saldos con lo que resulta de reproducir el historial.
+
+    Devuelve las diferencias como [(tabla, clave, según historial, en la tabla)].
+    """
+    # Tablas e historial se leen en una sola transacción (cada escritura del banco cambia
+    # ambos a la vez), así que no hace falta bloqueo_banco mientras se reproduce el historial
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        _empezar_lectura_consistente(conn, cursor)
+        # Las tablas, no el inventario en memoria ni la caché del ranking
+        cursor.execute(adapt_placeholders("SELECT item_id, cantidad FROM inventario WHERE guild_id = ?"), (guild_id,))
+        inventario = dict(_con_nombres(cursor.fetchall(), 0))
+        cursor.execute(adapt_placeholders("SELECT user_id, puntos FROM reputacion WHERE guild_id = ?"), (guild_id,))
+        reputacion = dict(cursor.fetchall())
+        cursor.execute(adapt_placeholders("SELECT user_id, item_id, cantidad FROM registro_usuarios WHERE guild_id = ?"), (guild_id,))
+        filas_registro = _con_nombres(cursor.fetchall(), 1)
+        base = _checkpoint_base(cursor, guild_id)
+        saldos = _cargar_checkpoint(cursor, base[0]) if base else {}
+        saldos = _agrupar_saldos(_sumar_movimientos(conn, guild_id, saldos, base[1] if base else 0))
+    finally:
+        conn.rollback()
+        conn.close()
+
+    registro = {(user_id, item): cantidad for user_id, item, cantidad in filas_registro}
+    esperado_registro = {(user_id, item): cantidad for user_id, items in saldos["registro"].items() for item, cantidad in items.items()}
+    diferencias = []
+    for tabla, esperado, actual in (("inventario", saldos["inventario"], inventario),
+                                    ("registro_usuarios", esperado_registro, registro),
+                                    ("reputacion", saldos["reputacion"], reputacion)):
+        for clave in set(esperado) | set(actual):
+            if abs(esperado.get(clave, 0) - (actual.get(clave) or 0)) > 1e-6:
+                diferencias.append((tabla, clave, esperado.get(clave, 0), actual.get(clave, 0)))
+    return diferencias
+
+def crear_checkpoints() -> int:
+    """Crea un checkpoint por servidor con historial y comprueba sus saldos. Devuelve cuántos creó."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT guild_id FROM historial")
+    guilds = [fila[0] for fila in cursor.fetchall()]
+    conn.close()
+    creados = 0
+    for guild_id in guilds:
+        if crear_checkpoint(guild_id) is not None:
+            creados += 1
+        diferencias = verificar_saldos(guild_id)
+        if diferencias:
+            print(f"⚖️ Servidor {guild_id}: {len(diferencias)} saldos no cuadran con el historial (p. ej. {diferencias[0]})")
+    return creados
+
+def get_reputacion_usuario(guild_id, user_id):
     """Obtiene la reputación de un usuario específico"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(adapt_placeholders("SELECT puntos FROM reputacion WHERE user_id = ?"), (user_id,))
+    cursor.execute(adapt_placeholders("SELECT puntos FROM reputacion WHERE guild_id = ? AND user_id = ?"), (guild_id, user_id))
     result = cursor.fetchone()
     conn.close()
     return result[0] if result else 0
 
-def get_all_reputacion():
-    """Obtiene toda la reputación de todos los usuarios"""
+def get_all_reputacion(guild_id):
+    """Obtiene toda la reputación de todos los usuarios de un servidor (cacheado; devuelve una copia)"""
+    return dict(cache_ranking.obtener(guild_id, lambda: _get_all_reputacion_db(guild_id)))
+
+def _get_all_reputacion_db(guild_id):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT user_id, puntos FROM reputacion")
+    cursor.execute(adapt_placeholders("SELECT user_id, puntos FROM reputacion WHERE guild_id = ?"), (guild_id,))
     reputacion = dict(cursor.fetchall())
     conn.close()
     return reputacion
 
-def update_inventario(item, cantidad):
-    """Actualiza la cantidad de un item en el inventario"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Las variantes _en_cursor escriben sobre un cursor ya abierto sin hacer commit,
+# para poder agrupar varias escrituras en una sola transacción. Reciben nombres de
+# objeto y los traducen a item_id con mapa_items.
+def _anotar_inventario_en_cursor(cursor, guild_id, cantidades):
+    """Apunta en el cursor las cantidades que quedan en inventario al confirmar la transacción."""
+    if cursor.inventario_escrito is None:
+        cursor.inventario_escrito = {}
+    cursor.inventario_escrito.setdefault(guild_id, {}).update(cantidades)
+
+def _update_inventario_en_cursor(cursor, guild_id, item, cantidad):
+    item_id = mapa_items.ids_en_cursor(cursor, [item])[item]
     # Upsert compatible: intentar update, si no, insert
-    cursor.execute(adapt_placeholders("UPDATE inventario SET cantidad = ? WHERE item = ?"), (cantidad, item))
+    cursor.execute(adapt_placeholders("UPDATE inventario SET cantidad = ? WHERE guild_id = ? AND item_id = ?"), (cantidad, guild_id, item_id))
     if cursor.rowcount == 0:
-        cursor.execute(adapt_placeholders("INSERT INTO inventario (item, cantidad) VALUES (?, ?)"), (item, cantidad))
-    conn.commit()
-    conn.close()
+        cursor.execute(adapt_placeholders("INSERT INTO inventario (guild_id, item_id, cantidad) VALUES (?, ?, ?)"), (guild_id, item_id, cantidad))
+    _anotar_inventario_en_cursor(cursor, guild_id, {item: cantidad})
 
-def update_registro_usuario(user_id, item, cantidad):
-    """Actualiza el registro de un usuario para un item específico"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def _update_registro_usuario_en_cursor(cursor, guild_id, user_id, item, cantidad):
+    item_id = mapa_items.ids_en_cursor(cursor, [item])[item]
     # Prevenir cantidades negativas
     cantidad_final = max(0, cantidad)
     
     # Si la cantidad es 0, eliminar el registro en lugar de guardarlo
     if cantidad_final == 0:
-        cursor.execute(adapt_placeholders("DELETE FROM registro_usuarios WHERE user_id = ? AND item = ?"), (user_id, item))
+        cursor.execute(adapt_placeholders("DELETE FROM registro_usuarios WHERE guild_id = ? AND user_id = ? AND item_id = ?"), (guild_id, user_id, item_id))
     else:
         # Upsert manual: update, si no existe insert
-        cursor.execute(adapt_placeholders("UPDATE registro_usuarios SET cantidad = ? WHERE user_id = ? AND item = ?"), (cantidad_final, user_id, item))
+        cursor.execute(adapt_placeholders("UPDATE registro_usuarios SET cantidad = ? WHERE guild_id = ? AND user_id = ? AND item_id = ?"), (cantidad_final, guild_id, user_id, item_id))
         if cursor.rowcount == 0:
-            cursor.execute(adapt_placeholders("INSERT INTO registro_usuarios (user_id, item, cantidad) VALUES (?, ?, ?)"), (user_id, item, cantidad_final))
-    
+            cursor.execute(adapt_placeholders("INSERT INTO registro_usuarios (guild_id, user_id, item_id, cantidad) VALUES (?, ?, ?, ?)"), (guild_id, user_id, item_id, cantidad_final))
+
+def _add_historial_en_cursor(cursor, guild_id, filas):
+    """Inserta varias filas (user_id, accion, item, cantidad, ubicacion, usuario_relacionado) en el historial."""
+    ahora = datetime.now()
+    timestamp = ahora.strftime("%d/%m/%Y %H:%M:%S")
+    marca_tiempo = int(ahora.timestamp())
+    ids = mapa_items.ids_en_cursor(cursor, [fila[2] for fila in filas if fila[2]])
+    cursor.executemany(adapt_placeholders("INSERT INTO historial (guild_id, user_id, timestamp, marca_tiempo, accion, item_id, cantidad, ubicacion, usuario_relacionado) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"),
+                       [(guild_id, user_id, timestamp, marca_tiempo, accion, ids.get(item), cantidad, ubicacion, usuario_relacionado)
+                        for user_id, accion, item, cantidad, ubicacion, usuario_relacionado in filas])
+
+def _update_reputacion_en_cursor(cursor, guild_id, user_id, puntos):
+    # Upsert manual
+    cursor.execute(adapt_placeholders("UPDATE reputacion SET puntos = ? WHERE guild_id = ? AND user_id = ?"), (puntos, guild_id, user_id))
+    if cursor.rowcount == 0:
+        cursor.execute(adapt_placeholders("INSERT INTO reputacion (guild_id, user_id, puntos) VALUES (?, ?, ?)"), (guild_id, user_id, puntos))
+
+# Las variantes _sumar_ incrementan varias filas con un único upsert (ON CONFLICT ... DO UPDATE)
+def _sumar_inventario_en_cursor(cursor, guild_id, cantidades):
+    """Suma {item: cantidad} al inventario del servidor."""
+    if not cantidades:
+        return
+    ids = mapa_items.ids_en_cursor(cursor, list(cantidades))
+    cursor.execute(adapt_placeholders(f'''
+        INSERT INTO inventario (guild_id, item_id, cantidad) VALUES {_filas_valores(len(cantidades), 3)}
+        ON CONFLICT (guild_id, item_id) DO UPDATE SET cantidad = inventario.cantidad + excluded.cantidad
+        RETURNING item_id, cantidad
+    '''), [valor for item, cantidad in cantidades.items() for valor in (guild_id, ids[item], cantidad)])
+    # Las cantidades resultantes, tal como quedan en la tabla
+    nombre_de = {item_id: item for item, item_id in ids.items()}
+    _anotar_inventario_en_cursor(cursor, guild_id, {nombre_de[item_id]: cantidad for item_id, cantidad in cursor.fetchall()})
+
+def _sumar_registro_usuario_en_cursor(cursor, guild_id, user_id, cantidades):
+    """Suma {item: cantidad} al registro de un usuario. Devuelve {item: cantidad resultante}."""
+    if not cantidades:
+        return {}
+    ids = mapa_items.ids_en_cursor(cursor, list(cantidades))
+    cursor.execute(adapt_placeholders(f'''
+        INSERT INTO registro_usuarios (guild_id, user_id, item_id, cantidad) VALUES {_filas_valores(len(cantidades), 4)}
+        ON CONFLICT (guild_id, user_id, item_id) DO UPDATE SET cantidad = registro_usuarios.cantidad + excluded.cantidad
+        RETURNING item_id, cantidad
+    '''), [valor for item, cantidad in cantidades.items() for valor in (guild_id, user_id, ids[item], cantidad)])
+    nombre_de = {item_id: item for item, item_id in ids.items()}
+    return {nombre_de[item_id]: cantidad for item_id, cantidad in cursor.fetchall()}
+
+def _sumar_reputacion_en_cursor(cursor, guild_id, user_id, puntos):
+    cursor.execute(adapt_placeholders('''
+        INSERT INTO reputacion (guild_id, user_id, puntos) VALUES (?, ?, ?)
+        ON CONFLICT (guild_id, user_id) DO UPDATE SET puntos = reputacion.puntos + excluded.puntos
+    '''), (guild_id, user_id, puntos))
+
+def update_inventario(guild_id, item, cantidad):
+    """Actualiza la cantidad de un item en el inventario"""
+    mapa_items.asegurar([item])
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    _update_inventario_en_cursor(cursor, guild_id, item, cantidad)
+    confirmar_cambios(conn, cursor, [("inventario", guild_id)])
+    conn.close()
+
+def update_registro_usuario(guild_id, user_id, item, cantidad):
+    """Actualiza el registro de un usuario para un item específico"""
+    mapa_items.asegurar([item])
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    _update_registro_usuario_en_cursor(cursor, guild_id, user_id, item, cantidad)
     conn.commit()
     conn.close()
 
-def add_historial(user_id, accion, item, cantidad, ubicacion=None, usuario_relacionado=None):
+def add_historial(guild_id, user_id, accion, item, cantidad, ubicacion=None, usuario_relacionado=None):
     """Añade una entrada al historial"""
+    mapa_items.asegurar([item])
     conn = get_db_connection()
     cursor = conn.cursor()
-    timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    cursor.execute(adapt_placeholders("INSERT INTO historial (user_id, timestamp, accion, item, cantidad, ubicacion, usuario_relacionado) VALUES (?, ?, ?, ?, ?, ?, ?)"), 
-                   (user_id, timestamp, accion, item, cantidad, ubicacion, usuario_relacionado))
+    _add_historial_en_cursor(cursor, guild_id, [(user_id, accion, item, cantidad, ubicacion, usuario_relacionado)])
     conn.commit()
     conn.close()
     
     # Los datos se guardan automáticamente en Postgres
 
-def update_reputacion(user_id, puntos):
+def update_reputacion(guild_id, user_id, puntos):
     """Actualiza la reputación de un usuario"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    # Upsert manual
-    cursor.execute(adapt_placeholders("UPDATE reputacion SET puntos = ? WHERE user_id = ?"), (puntos, user_id))
-    if cursor.rowcount == 0:
-        cursor.execute(adapt_placeholders("INSERT INTO reputacion (user_id, puntos) VALUES (?, ?)"), (user_id, puntos))
-    conn.commit()
+    _update_reputacion_en_cursor(cursor, guild_id, user_id, puntos)
+    confirmar_cambios(conn, cursor, [("ranking", guild_id)])
     conn.close()
     
     # Los datos se guardan automáticamente en Postgres
@@ -282,13 +1849,23 @@ def update_reputacion(user_id, puntos):
 def get_categoria(item: str):
     """Obtiene la categoría de un item desde DB; si no existe, intenta con categorias estáticas; si no, None."""
     item_norm = item.lower()
+    return cache_categorias.obtener(item_norm, lambda: _get_categoria_db(item_norm))
+
+def _get_categoria_db(item_norm: str):
+    item_id = mapa_items.id_normalizado(item_norm)
+    if item_id is None:
+        return _categoria_estatica(item_norm)
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(adapt_placeholders("SELECT categoria FROM item_categoria WHERE item = ?"), (item_norm,))
+    cursor.execute(adapt_placeholders("SELECT categoria FROM item_categoria WHERE item_id = ?"), (item_id,))
     row = cursor.fetchone()
     conn.close()
     if row:
         return row[0]
+    return _categoria_estatica(item_norm)
+
+def _categoria_estatica(item_norm: str):
+    """Categoría según las categorias estáticas y heurísticas (sin consultar la DB)."""
     # Fallback a categorias estáticas
     for cat, items in categorias.items():
         if item_norm in items:
@@ -298,108 +1875,341 @@ def get_categoria(item: str):
         return "Armas"
     return None
 
+def _set_categoria_en_cursor(cursor, item_id: int, categoria: str):
+    # Las categorías van por el id del nombre canónico, el mismo que usan inventario y registro
+    # Upsert manual
+    cursor.execute(adapt_placeholders("UPDATE item_categoria SET categoria = ? WHERE item_id = ?"), (categoria, item_id))
+    if cursor.rowcount == 0:
+        cursor.execute(adapt_placeholders("INSERT INTO item_categoria (item_id, categoria) VALUES (?, ?)"), (item_id, categoria))
+
 def set_categoria(item: str, categoria: str):
     """Guarda/actualiza la categoría de un item en DB."""
+    item_id = mapa_items.id_normalizado(item) or mapa_items.asegurar([item])[item]
     conn = get_db_connection()
     cursor = conn.cursor()
-    # Upsert manual
-    cursor.execute(adapt_placeholders("UPDATE item_categoria SET categoria = ? WHERE item = ?"), (categoria, item.lower()))
-    if cursor.rowcount == 0:
-        cursor.execute(adapt_placeholders("INSERT INTO item_categoria (item, categoria) VALUES (?, ?)"), (item.lower(), categoria))
-    conn.commit()
+    _set_categoria_en_cursor(cursor, item_id, categoria)
+    confirmar_cambios(conn, cursor, [("categorias", item.lower())])
     conn.close()
 
-def get_contratos():
-    """Obtiene todos los contratos almacenados"""
+def get_contratos(guild_id):
+    """Obtiene todos los contratos almacenados de un servidor (cacheado)"""
+    return list(cache_contratos.obtener(guild_id, lambda: _get_contratos_db(guild_id)))
+
+def _get_contratos_db(guild_id):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT nombre, enlace FROM contratos ORDER BY id")
+    cursor.execute(adapt_placeholders("SELECT nombre, enlace FROM contratos WHERE guild_id = ? ORDER BY id"), (guild_id,))
     contratos = cursor.fetchall()
     conn.close()
     return contratos
 
-def add_contrato(nombre: str, enlace: str):
+def add_contrato(guild_id, nombre: str, enlace: str):
     """Añade un nuevo contrato a la base de datos"""
     conn = get_db_connection()
     cursor = conn.cursor()
     fecha = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    cursor.execute(adapt_placeholders("INSERT INTO contratos (nombre, enlace, fecha_creacion) VALUES (?, ?, ?)"), (nombre, enlace, fecha))
-    conn.commit()
+    cursor.execute(adapt_placeholders("INSERT INTO contratos (guild_id, nombre, enlace, fecha_creacion) VALUES (?, ?, ?, ?)"), (guild_id, nombre, enlace, fecha))
+    confirmar_cambios(conn, cursor, [("contratos", guild_id)])
     conn.close()
     
     # Los datos se guardan automáticamente en Postgres
 
-def delete_contrato(nombre: str):
+def delete_contrato(guild_id, nombre: str):
     """Elimina un contrato específico de la base de datos"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(adapt_placeholders("DELETE FROM contratos WHERE nombre = ?"), (nombre,))
+    cursor.execute(adapt_placeholders("DELETE FROM contratos WHERE guild_id = ? AND nombre = ?"), (guild_id, nombre))
     deleted_rows = cursor.rowcount
-    conn.commit()
+    confirmar_cambios(conn, cursor, [("contratos", guild_id)])
     conn.close()
     return deleted_rows > 0
 
-def delete_all_contratos():
-    """Elimina todos los contratos de la base de datos"""
+def delete_all_contratos(guild_id):
+    """Elimina todos los contratos de un servidor"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM contratos")
+    cursor.execute(adapt_placeholders("DELETE FROM contratos WHERE guild_id = ?"), (guild_id,))
     deleted_rows = cursor.rowcount
-    conn.commit()
+    confirmar_cambios(conn, cursor, [("contratos", guild_id)])
     conn.close()
     return deleted_rows
 
 # =========================
-# WEBHOOKS (Flask)
+# WEBHOOKS (aiohttp)
 # =========================
-async def limpiar_y_anunciar():
+async def limpiar_y_anunciar(guilds=None):
+    """Limpia y vuelve a anunciar el canal de contratos de esos servidores (de todos si no se indican)."""
     try:
-        await limpiar_canal_diario()
+        await limpiar_canal_diario(guilds)
     except Exception:
         pass
     try:
-        await anunciar_contratos_diario()
+        await anunciar_contratos_diario(guilds)
     except Exception:
         pass
-def _event_already_processed(event_id: str) -> bool:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(adapt_placeholders("SELECT 1 FROM webhook_events WHERE event_id = ?"), (event_id,))
-    exists = cursor.fetchone() is not None
-    conn.close()
-    return exists
 
-def _mark_event_processed(event_id: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute(adapt_placeholders("INSERT INTO webhook_events (event_id, received_at) VALUES (?, ?)"), (event_id, ts))
-    conn.commit()
-    conn.close()
+# Ventana de silencio (segundos) antes de purgar/anunciar tras un webhook
+ANUNCIO_DEBOUNCE_SEGUNDOS = float(os.getenv("ANUNCIO_DEBOUNCE_SEGUNDOS", "5"))
+# Espera máxima desde el primer disparo aunque sigan llegando eventos
+ANUNCIO_ESPERA_MAXIMA_SEGUNDOS = float(os.getenv("ANUNCIO_ESPERA_MAXIMA_SEGUNDOS", "30"))
 
-def upsert_contrato(nombre: str, enlace: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+class DisparadorCoalescente:
+    """Agrupa ráfagas de disparos en una sola ejecución de una corrutina.
+
+    - Espera a que pasen `ventana` segundos sin disparos nuevos (como mucho `espera_maxima`).
+    - Nunca hay más de una ejecución en curso.
+    - Si llegan disparos durante la ejecución, se ejecuta otra vez al terminar (flanco final),
+      así el último estado siempre queda publicado.
+    - Cada disparo puede llevar una clave (p. ej. el servidor); la corrutina recibe el
+      conjunto de claves acumuladas desde la ejecución anterior.
+    """
+
+    def __init__(self, nombre, fabrica_corrutina, ventana, espera_maxima):
+        self.nombre = nombre
+        self._fabrica = fabrica_corrutina
+        self.ventana = ventana
+        self.espera_maxima = max(espera_maxima, ventana)
+        self._pendiente = False
+        self._claves = set()
+        self._ultimo_disparo = 0.0
+        self._tarea = None
+        self.disparos = 0
+        self.colapsados = 0
+        self.ejecuciones = 0
+
+    def disparar(self, clave=None):
+        """Registra un disparo. Debe llamarse desde el loop del bot."""
+        loop = asyncio.get_running_loop()
+        self.disparos += 1
+        if clave is not None:
+            self._claves.add(clave)
+        self._ultimo_disparo = loop.time()
+        if self._pendiente:
+            self.colapsados += 1
+            return
+        self._pendiente = True
+        if self._tarea is None or self._tarea.done():
+            self._tarea = loop.create_task(self._bucle())
+
+    async def _bucle(self):
+        loop = asyncio.get_running_loop()
+        while self._pendiente:
+            inicio = loop.time()
+            while True:
+                limite = min(self._ultimo_disparo + self.ventana, inicio + self.espera_maxima)
+                restante = limite - loop.time()
+                if restante <= 0:
+                    break
+                await asyncio.sleep(restante)
+            # A partir de aquí los disparos nuevos programan otra pasada
+            self._pendiente = False
+            claves, self._claves = self._claves, set()
+            self.ejecuciones += 1
+            try:
+                await self._fabrica(claves)
+            except Exception as e:
+                print(f"❌ Error en {self.nombre}: {e}")
+            print(f"📢 {self.nombre}: {self.ejecuciones} ejecuciones, {self.disparos} disparos ({self.colapsados} colapsados)")
+
+    def estadisticas(self):
+        return {
+            "disparos": self.disparos,
+            "colapsados": self.colapsados,
+            "ejecuciones": self.ejecuciones,
+            "pendiente": self._pendiente,
+            "en_curso": self._tarea is not None and not self._tarea.done(),
+        }
+
+disparador_anuncio = DisparadorCoalescente(
+    "Anuncio de contratos",
+    limpiar_y_anunciar,
+    ANUNCIO_DEBOUNCE_SEGUNDOS,
+    ANUNCIO_ESPERA_MAXIMA_SEGUNDOS,
+)
+
+def _eventos_ya_procesados_en_cursor(cursor, event_ids):
+    """Devuelve cuáles de los event_id ya están en webhook_events (una sola consulta)."""
+    if not event_ids:
+        return set()
+    cursor.execute(adapt_placeholders(f"SELECT event_id FROM webhook_events WHERE event_id IN ({_marcadores(len(event_ids))})"), list(event_ids))
+    return {fila[0] for fila in cursor.fetchall()}
+
+def _marcar_evento_procesado_en_cursor(cursor, event_id: str):
+    ahora = datetime.now()
+    cursor.execute(adapt_placeholders("INSERT INTO webhook_events (event_id, received_at, recibido_en) VALUES (?, ?, ?)"),
+                   (event_id, ahora.strftime("%Y-%m-%d %H:%M:%S"), ahora.timestamp()))
+
+def _upsert_contrato_en_cursor(cursor, guild_id, nombre: str, enlace: str):
     # intentar update por nombre, si no existe insert
-    cursor.execute(adapt_placeholders("UPDATE contratos SET enlace = ? WHERE nombre = ?"), (enlace, nombre))
+    cursor.execute(adapt_placeholders("UPDATE contratos SET enlace = ? WHERE guild_id = ? AND nombre = ?"), (enlace, guild_id, nombre))
     if cursor.rowcount == 0:
         fecha = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        cursor.execute(adapt_placeholders("INSERT INTO contratos (nombre, enlace, fecha_creacion) VALUES (?, ?, ?)"), (nombre, enlace, fecha))
-    conn.commit()
+        cursor.execute(adapt_placeholders("INSERT INTO contratos (guild_id, nombre, enlace, fecha_creacion) VALUES (?, ?, ?, ?)"), (guild_id, nombre, enlace, fecha))
+
+def upsert_contrato(guild_id, nombre: str, enlace: str):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    _upsert_contrato_en_cursor(cursor, guild_id, nombre, enlace)
+    confirmar_cambios(conn, cursor, [("contratos", guild_id)])
     conn.close()
 
-@app.post("/webhook/contratos")
-def webhook_contratos():
-    if WEBHOOK_SECRET:
-        token = request.headers.get("X-Webhook-Token")
-        if token != WEBHOOK_SECRET:
-            return jsonify({"error": "unauthorized"}), 401
+def _guild_del_evento(payload) -> Optional[int]:
+    """Servidor al que va dirigido un evento: su guild_id o, si no trae, el principal.
+
+    Devuelve None si no trae y no hay servidor principal (bot en varios servidores sin
+    GUILD_ID). Lanza ValueError/TypeError si el guild_id no es un número.
+    """
+    data = payload.get("data")
+    valor = payload.get("guild_id") or (data.get("guild_id") if isinstance(data, dict) else None)
+    if valor:
+        return int(valor)
+    return guild_por_defecto() or None
+
+def _error_guild_evento(payload) -> Optional[str]:
+    """Motivo para rechazar el evento al recibirlo por no saber a qué servidor va, o None."""
+    try:
+        guild_id = _guild_del_evento(payload)
+    except (TypeError, ValueError):
+        return "invalid_guild_id"
+    # Antes de on_ready aún puede adoptarse el único servidor: lo decide el trabajador
+    if guild_id is None and _guild_por_defecto_decidido:
+        return "missing_guild_id"
+    return None
+
+def _autorizado(request: web.Request) -> bool:
+    return not WEBHOOK_SECRET or request.headers.get("X-Webhook-Token") == WEBHOOK_SECRET
+
+async def webhook_contratos(request: web.Request):
+    if not _autorizado(request):
+        return web.json_response({"error": "unauthorized"}, status=401)
+    try:
+        payload_crudo = await request.text()
+        payload = json.loads(payload_crudo)
+    except Exception:
+        return web.json_response({"error": "invalid_json"}, status=400)
+    if not isinstance(payload, dict):
+        return web.json_response({"error": "invalid_payload"}, status=400)
+    event_id = payload.get("event_id")
+    if not event_id or not payload.get("type"):
+        return web.json_response({"error": "missing_fields"}, status=400)
+    error_guild = _error_guild_evento(payload)
+    if error_guild:
+        return web.json_response({"error": error_guild}, status=400)
+    # Contrapresión: si el trabajador va muy atrasado, que el emisor reintente más tarde
+    if trabajador_inbox.saturado():
+        return web.json_response({"error": "busy"}, status=503, headers={"Retry-After": "30"})
+
+    # Sólo se guarda el evento; el trabajador lo aplica después
+    await esperar_preparacion()
+    if not await asyncio.to_thread(encolar_evento_inbox, str(event_id), payload_crudo):
+        return web.json_response({"status": "duplicate"}, status=409)
+    trabajador_inbox.avisar()
+    return web.json_response({"status": "accepted"}, status=202)
+
+# Máximo de eventos por petición al endpoint por lotes
+WEBHOOK_LOTE_MAX = int(os.getenv("WEBHOOK_LOTE_MAX", "500"))
+
+async def webhook_contratos_lote(request: web.Request):
+    """Recibe una lista de eventos (o {"events": [...]}) y los encola en una sola transacción.
+
+    Responde 202 con el estado de cada evento, en el mismo orden: accepted, duplicate o invalid.
+    """
+    if not _autorizado(request):
+        return web.json_response({"error": "unauthorized"}, status=401)
     try:
-        payload = request.get_json(force=True)
+        eventos = json.loads(await request.text())
     except Exception:
-        return jsonify({"error": "invalid_json"}), 400
+        return web.json_response({"error": "invalid_json"}, status=400)
+    if isinstance(eventos, dict):
+        eventos = eventos.get("events")
+    if not isinstance(eventos, list):
+        return web.json_response({"error": "invalid_payload"}, status=400)
+    if len(eventos) > WEBHOOK_LOTE_MAX:
+        return web.json_response({"error": "batch_too_large", "max": WEBHOOK_LOTE_MAX}, status=413)
+    if trabajador_inbox.saturado():
+        return web.json_response({"error": "busy"}, status=503, headers={"Retry-After": "30"})
+
+    resultados = []
+    validos = []
+    for evento in eventos:
+        if not isinstance(evento, dict):
+            resultados.append({"status": "invalid", "error": "invalid_payload"})
+            continue
+        event_id = evento.get("event_id")
+        resultados.append({"event_id": event_id})
+        if not event_id or not evento.get("type"):
+            resultados[-1].update(status="invalid", error="missing_fields")
+        elif _error_guild_evento(evento):
+            resultados[-1].update(status="invalid", error=_error_guild_evento(evento))
+        else:
+            validos.append((len(resultados) - 1, str(event_id), json.dumps(evento)))
+
+    encolados = []
+    if validos:
+        await esperar_preparacion()
+        encolados = await asyncio.to_thread(encolar_eventos_inbox, [(event_id, crudo) for _, event_id, crudo in validos])
+    for (posicion, _, _), encolado in zip(validos, encolados):
+        resultados[posicion]["status"] = "accepted" if encolado else "duplicate"
+    aceptados = sum(encolados)
+    if aceptados:
+        trabajador_inbox.avisar(aceptados)
+    return web.json_response({"accepted": aceptados, "results": resultados}, status=202)
+
+@web.middleware
+async def middleware_bd_no_disponible(request, handler):
+    """Con Postgres caído, 503 con Retry-After para que el emisor reintente más tarde."""
+    try:
+        return await handler(request)
+    except BaseDatosNoDisponible:
+        return web.json_response({"error": "database_unavailable"}, status=503, headers={"Retry-After": "30"})
+
+app.middlewares.append(middleware_bd_no_disponible)
+app.router.add_post("/webhook/contratos", webhook_contratos)
+app.router.add_post("/webhook/contratos/lote", webhook_contratos_lote)
+
+def procesar_evento_webhook(payload):
+    """Valida y aplica un evento del webhook de contratos. Devuelve (cuerpo, estado HTTP)."""
+    return procesar_eventos_webhook([payload])[0]
+
+def procesar_eventos_webhook(payloads):
+    """Valida y aplica varios eventos en una sola transacción; devuelve [(cuerpo, estado HTTP)] en orden.
+
+    Los duplicados se detectan con una sola consulta. Si un evento lanza una excepción no se aplica ninguno.
+    """
+    event_ids = [str(p["event_id"]) for p in payloads if isinstance(p, dict) and p.get("event_id")]
+    with bloqueo_banco:
+        mapa_items.asegurar(_nombres_recompensas(payloads))
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            ya_procesados = _eventos_ya_procesados_en_cursor(cursor, set(event_ids))
+            cambios = []
+            resultados = [_aplicar_evento_en_cursor(cursor, payload, ya_procesados, cambios) for payload in payloads]
+            confirmar_cambios(conn, cursor, list(dict.fromkeys(cambios)))
+            return resultados
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+def _nombres_recompensas(payloads):
+    """Nombres de objeto que aparecen en las recompensas de los eventos (para crear sus ids antes)."""
+    nombres = ["Reputación"]
+    for payload in payloads:
+        data = payload.get("data") if isinstance(payload, dict) else None
+        recompensas = data.get("rewards") if isinstance(data, dict) else None
+        items = recompensas.get("items") if isinstance(recompensas, dict) else None
+        if isinstance(items, list):
+            nombres += [it["name"] for it in items if isinstance(it, dict) and isinstance(it.get("name"), str) and it["name"]]
+    # Se guardan con el nombre del catálogo cuando lo hay
+    catalogo = resolver_objetos_catalogo(nombres[1:])
+    return nombres[:1] + [catalogo[nombre]['nombre'] if nombre in catalogo else nombre for nombre in nombres[1:]]
+
+def _aplicar_evento_en_cursor(cursor, payload, ya_procesados, cambios):
+    """Aplica un evento sobre el cursor. Añade a `cambios` las cachés que hay que invalidar."""
     if not isinstance(payload, dict):
-        return jsonify({"error": "invalid_payload"}), 400
+        return {"error": "invalid_payload"}, 400
 
     event_id = payload.get("event_id")
     event_type = payload.get("type")
@@ -407,73 +2217,557 @@ def webhook_contratos():
     data = payload.get("data", {})
 
     if not event_id or not event_type:
-        return jsonify({"error": "missing_fields"}), 400
-    if _event_already_processed(event_id):
-        return jsonify({"status": "duplicate"}), 409
+        return {"error": "missing_fields"}, 400
+    event_id = str(event_id)
+    # Servidor del clan al que va dirigido el evento (por defecto, el principal)
+    try:
+        guild_id = _guild_del_evento(payload)
+    except (TypeError, ValueError):
+        return {"error": "invalid_guild_id"}, 400
+    if guild_id is None:
+        if not _guild_por_defecto_decidido:
+            # Excepción: la bandeja lo reintenta cuando on_ready haya decidido el servidor
+            raise RuntimeError("servidor por defecto aún sin decidir")
+        return {"error": "missing_guild_id"}, 400
+    if event_id in ya_procesados:
+        return {"status": "duplicate"}, 409
+    ya_procesados.add(event_id)
+    _marcar_evento_procesado_en_cursor(cursor, event_id)
     if visibility != "public":
-        _mark_event_processed(event_id)
-        return jsonify({"status": "ignored_private"}), 200
+        return {"status": "ignored_private"}, 200
 
     # Procesar tipos básicos
     if event_type in ("contract.created", "contract.updated"):
         nombre = data.get("title") or data.get("name") or "Contrato"
         enlace = data.get("url") or ""
-        upsert_contrato(nombre, enlace)
+        _upsert_contrato_en_cursor(cursor, guild_id, nombre, enlace)
+        cambios.append(("contratos", guild_id))
     elif event_type == "contract.completed":
         # registrar en historial si hay usuario y recompensas
         user = data.get("user", {})
         user_id = user.get("discord_id")
         recompensas = data.get("rewards", {})
         if user_id and isinstance(recompensas, dict):
-            # reputación
-            rep = float(recompensas.get("reputation", 0) or 0)
-            if rep:
-                actual = get_reputacion_usuario(int(user_id))
-                update_reputacion(int(user_id), actual + rep)
-                add_historial(int(user_id), "Ganó Reputación", "Reputación", rep)
-            # items
-            items = recompensas.get("items", [])
-            if isinstance(items, list):
-                for it in items:
-                    nombre = it.get("name")
-                    cant = int(it.get("quantity", 0) or 0)
-                    if nombre and cant > 0:
-                        inv = get_inventario()
-                        actual = inv.get(nombre, 0)
-                        update_inventario(nombre, actual + cant)
-                        reg = get_registro_usuario(int(user_id))
-                        user_actual = reg.get(nombre, 0)
-                        update_registro_usuario(int(user_id), nombre, user_actual + cant)
-                        add_historial(int(user_id), "Añadido", nombre, cant)
+            objetos = _aplicar_recompensas_en_cursor(cursor, guild_id, int(user_id), recompensas)
+            cambios += [("inventario", guild_id), ("ranking", guild_id)]
+            cambios += [("categorias", nombre.lower()) for nombre in objetos]
     elif event_type in ("event.created", "event.updated", "event.completed"):
         # por ahora no persistimos eventos en tabla, sólo marcamos recibido
         pass
     else:
-        _mark_event_processed(event_id)
-        return jsonify({"status": "ignored_unknown_type"}), 200
+        return {"status": "ignored_unknown_type"}, 200
 
-    _mark_event_processed(event_id)
-    # lanzar anuncio auto: limpiar canal y publicar lista
-    try:
-        asyncio.run_coroutine_threadsafe(limpiar_y_anunciar(), bot.loop)
-    except Exception:
-        pass
-    return jsonify({"status": "ok"}), 200
+    return {"status": "ok", "guild_id": guild_id}, 200
+
+def _aplicar_recompensas_en_cursor(cursor, guild_id, user_id, recompensas):
+    """Suma al banco y al registro del usuario las recompensas de un contrato completado.
+
+    Los objetos se ingresan como un depósito (mismos límites por categoría) y la reputación
+    con un único incremento. Devuelve los nombres de los objetos recibidos.
+    """
+    filas_historial = []
+    # reputación
+    rep = float(recompensas.get("reputation", 0) or 0)
+    if rep:
+        _sumar_reputacion_en_cursor(cursor, guild_id, user_id, rep)
+        filas_historial.append((user_id, "Ganó Reputación", "Reputación", rep, None, None))
+    # items (sumando repetidos), con el nombre del catálogo como en el depósito manual:
+    # "medpen" en un webhook y "MedPen" desde la botonera son el mismo objeto
+    cantidades = {}
+    categorias_items = {}
+    items = recompensas.get("items", [])
+    if isinstance(items, list):
+        validos = [(it.get("name"), int(it.get("quantity", 0) or 0)) for it in items]
+        catalogo = resolver_objetos_catalogo([nombre for nombre, _ in validos if nombre])
+        for nombre, cant in validos:
+            if nombre and cant > 0:
+                objeto = catalogo.get(nombre, {'nombre': nombre, 'categoria': None})
+                cantidades[objeto['nombre']] = cantidades.get(objeto['nombre'], 0) + cant
+                categorias_items[objeto['nombre']] = objeto['categoria']
+    if cantidades:
+        entradas = [({'nombre': nombre, 'categoria': categorias_items[nombre]}, cant)
+                    for nombre, cant in cantidades.items()]
+        for r in _depositar_en_cursor(cursor, guild_id, user_id, entradas):
+            if r['añadido'] > 0:
+                filas_historial.append((user_id, "Añadido", r['nombre'], r['añadido'], None, None))
+            if r['añadido'] < r['solicitado']:
+                print(f"⚠️ Recompensa de {r['nombre']} recortada a {r['añadido']} de {r['solicitado']} por el límite de almacenamiento")
+    if filas_historial:
+        _add_historial_en_cursor(cursor, guild_id, filas_historial)
+    return list(cantidades)
+
+# -----------------
+# BANDEJA DE ENTRADA DURABLE (INBOX)
+# -----------------
+# El endpoint sólo guarda el evento y responde 202; un trabajador lo aplica después, en orden.
+# Con varios procesos sobre la misma DB sólo uno vacía la bandeja (para mantener el orden):
+# el que tiene el turno, que renueva mientras trabaja y caduca si el proceso muere
+INBOX_MAX_PENDIENTES = int(os.getenv("INBOX_MAX_PENDIENTES", "1000"))
+INBOX_TURNO_SEGUNDOS = 60
+INBOX_MAX_INTENTOS = int(os.getenv("INBOX_MAX_INTENTOS", "5"))
+INBOX_LOTE = 50
+# El resumen de la bandeja se escribe como mucho una vez por intervalo; un lag por encima
+# del umbral se avisa en cuanto se detecta (y otra vez cuando se recupera)
+INBOX_INFORME_SEGUNDOS = 60
+INBOX_LAG_AVISO = float(os.getenv("INBOX_LAG_AVISO", "30"))
+
+def ahora_ts() -> float:
+    return datetime.now().timestamp()
+
+def encolar_evento_inbox(event_id: str, payload_crudo: str) -> bool:
+    """Guarda el evento en la bandeja. Devuelve False si ya estaba (en la bandeja o ya procesado)."""
+    return encolar_eventos_inbox([(event_id, payload_crudo)])[0]
+
+def encolar_eventos_inbox(eventos):
+    """Guarda varios eventos [(event_id, payload_crudo)] en la bandeja en una sola transacción.
+
+    Devuelve, en el mismo orden, True si el evento quedó encolado o False si ya estaba.
+    """
+    # Sólo se consulta la DB por los que el filtro en memoria no descarta
+    candidatos = deduplicador_eventos.candidatos({event_id for event_id, _ in eventos})
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    vistos = set()
+    if candidatos:
+        marcas = _marcadores(len(candidatos))
+        cursor.execute(adapt_placeholders(f'''
+            SELECT event_id FROM webhook_events WHERE event_id IN ({marcas})
+            UNION
+            SELECT event_id FROM webhook_inbox WHERE event_id IN ({marcas})
+        '''), candidatos + candidatos)
+        vistos = {fila[0] for fila in cursor.fetchall()}
+        deduplicador_eventos.registrar_consulta(len(candidatos), len(vistos))
+    filas = []
+    ahora = ahora_ts()
+    for event_id, payload_crudo in eventos:
+        if event_id not in vistos:
+            vistos.add(event_id)
+            filas.append((event_id, payload_crudo, "pendiente", 0, ahora, ahora))
+    insertados = set()
+    if filas:
+        # El filtro es de este proceso: otro puede haber encolado el mismo event_id sin que
+        # lo sepamos, así que cuenta lo que de verdad se insertó, no lo que se intentó
+        cursor.execute(adapt_placeholders(f'''
+            INSERT INTO webhook_inbox (event_id, payload, estado, intentos, proximo_intento, recibido_en)
+            VALUES {_filas_valores(len(filas), 6)}
+            ON CONFLICT (event_id) DO NOTHING
+            RETURNING event_id
+        '''), [valor for fila in filas for valor in fila])
+        insertados = {fila[0] for fila in cursor.fetchall()}
+        if insertados:
+            # Despierta al proceso que tenga el turno de la bandeja, si no es este
+            bus_invalidacion.notificar(conn, cursor, [("inbox", None)])
+    conn.commit()
+    conn.close()
+    deduplicador_eventos.anadir(insertados)
+    # Un event_id repetido dentro del mismo lote sólo cuenta como encolado la primera vez
+    encolados = []
+    for event_id, _ in eventos:
+        encolados.append(event_id in insertados)
+        insertados.discard(event_id)
+    return encolados
+
+def _renovar_turno_inbox(origen: str) -> bool:
+    """Toma el turno de vaciar la bandeja si está libre o caducado, o lo renueva si ya es de `origen`."""
+    ahora = ahora_ts()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(adapt_placeholders("UPDATE webhook_inbox_lider SET duenio = ?, hasta = ? WHERE id = 1 AND (duenio = ? OR hasta < ?)"),
+                   (origen, ahora + INBOX_TURNO_SEGUNDOS, origen, ahora))
+    tiene_turno = cursor.rowcount == 1
+    conn.commit()
+    conn.close()
+    return tiene_turno
+
+def _soltar_turno_inbox(origen: str):
+    """Libera el turno al cerrar, para que otro proceso (o el próximo arranque) no espere a que caduque."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(adapt_placeholders("UPDATE webhook_inbox_lider SET duenio = NULL, hasta = 0 WHERE id = 1 AND duenio = ?"), (origen,))
+    conn.commit()
+    conn.close()
+
+def _leer_pendientes_inbox(limite: int):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(adapt_placeholders("SELECT id, payload, intentos, proximo_intento, recibido_en FROM webhook_inbox WHERE estado = 'pendiente' ORDER BY id LIMIT ?"), (limite,))
+    filas = cursor.fetchall()
+    conn.close()
+    return filas
+
+def _contar_pendientes_inbox():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*), MIN(recibido_en) FROM webhook_inbox WHERE estado = 'pendiente'")
+    fila = cursor.fetchone()
+    conn.close()
+    return fila[0], fila[1]
+
+def _actualizar_inbox(inbox_id, estado, intentos, proximo_intento=None, error=None):
+    _actualizar_inbox_lote([(inbox_id, estado, intentos, proximo_intento, error)])
+
+def _actualizar_inbox_lote(filas):
+    """Actualiza varias filas (inbox_id, estado, intentos, proximo_intento, error) de la bandeja."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    ahora = ahora_ts()
+    cursor.executemany(adapt_placeholders('''
+        UPDATE webhook_inbox
+        SET estado = ?, intentos = ?, proximo_intento = COALESCE(?, proximo_intento), ultimo_error = ?, procesado_en = ?
+        WHERE id = ?
+    '''), [(estado, intentos, proximo_intento, error, ahora if estado != "pendiente" else None, inbox_id)
+            for inbox_id, estado, intentos, proximo_intento, error in filas])
+    conn.commit()
+    conn.close()
+
+class TrabajadorInbox:
+    """Vacía la bandeja de webhooks en orden de llegada.
+
+    - Un fallo reintenta el mismo evento con espera exponencial (bloquea los siguientes
+      para mantener el orden) y tras INBOX_MAX_INTENTOS lo pasa a 'muerto'.
+    - Los eventos inválidos (4xx) van directamente a 'muerto'.
+    - Los eventos listos consecutivos se aplican juntos en una transacción; si el lote
+      falla se aplican uno a uno para aislar el que da problemas.
+    - `pendientes` se usa para aplicar contrapresión en el endpoint.
+    - Con varios procesos sólo trabaja el que tiene el turno (webhook_inbox_lider); los
+      demás encolan y le avisan por el bus de Postgres.
+    """
+
+    def __init__(self):
+        self._despertar = asyncio.Event()
+        self._tarea = None
+        self._loop = None
+        self.origen = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self.con_turno = False
+        self.pendientes = 0
+        self.lag_segundos = 0.0
+        self.procesados = 0
+        self.reintentos = 0
+        self.muertos = 0
+        self._completados = deque(maxlen=10000)
+        self._aplicados_sin_informar = 0
+        self._ultimo_informe = ahora_ts()
+        self._lag_avisado = False
+
+    def iniciar(self):
+        if self._tarea is None or self._tarea.done():
+            self._loop = asyncio.get_running_loop()
+            self._tarea = self._loop.create_task(self._bucle())
+
+    def avisar_desde_hilo(self):
+        """Otro proceso ha encolado eventos (aviso recibido en el hilo del bus)."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._despertar.set)
+
+    def avisar(self, nuevos: int = 1):
+        """Indica que hay eventos nuevos en la bandeja."""
+        self.pendientes += nuevos
+        self._despertar.set()
+
+    def saturado(self) -> bool:
+        return self.pendientes >= INBOX_MAX_PENDIENTES
+
+    def eventos_por_minuto(self) -> int:
+        limite = ahora_ts() - 60
+        return sum(1 for ts in self._completados if ts >= limite)
+
+    def estadisticas(self):
+        return {
+            "pendientes": self.pendientes,
+            "lag_segundos": round(self.lag_segundos, 3),
+            "eventos_por_minuto": self.eventos_por_minuto(),
+            "procesados": self.procesados,
+            "reintentos": self.reintentos,
+            "muertos": self.muertos,
+            "con_turno": int(self.con_turno),
+        }
+
+    async def _bucle(self):
+        while True:
+            espera = 30.0
+            try:
+                espera = await self._vaciar()
+            except Exception as e:
+                print(f"❌ Error en el trabajador de la bandeja de webhooks: {e}")
+            # Volver antes de que caduque el turno para renovarlo
+            espera = min(espera, INBOX_TURNO_SEGUNDOS / 2)
+            self._despertar.clear()
+            try:
+                await asyncio.wait_for(self._despertar.wait(), timeout=espera)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _vaciar(self) -> float:
+        """Procesa lo que haya listo; devuelve cuántos segundos esperar antes de volver a mirar."""
+        if interruptor_postgres.abierto:
+            return 30.0
+        while True:
+            con_turno = await asyncio.to_thread(_renovar_turno_inbox, self.origen)
+            if con_turno != self.con_turno:
+                self.con_turno = con_turno
+                print("📥 Este proceso vacía la bandeja de webhooks" if con_turno else "📥 Otro proceso tiene el turno de la bandeja de webhooks")
+            if not con_turno:
+                self.pendientes, _ = await asyncio.to_thread(_contar_pendientes_inbox)
+                return 30.0
+            filas = await asyncio.to_thread(_leer_pendientes_inbox, INBOX_LOTE)
+            self.pendientes, mas_antiguo = await asyncio.to_thread(_contar_pendientes_inbox)
+            self.lag_segundos = ahora_ts() - mas_antiguo if mas_antiguo else 0.0
+            self._informar()
+            if not filas:
+                return 30.0
+            ahora = ahora_ts()
+            listos = list(itertools.takewhile(lambda fila: fila[3] <= ahora, filas))
+            if len(listos) > 1 and await self._procesar_lote(listos):
+                self._aplicados_sin_informar += len(listos)
+            else:
+                for inbox_id, payload_crudo, intentos, _, _ in listos:
+                    espera = await self._procesar(inbox_id, payload_crudo, intentos)
+                    if espera is not None:
+                        return espera
+                    self._aplicados_sin_informar += 1
+            if len(listos) < len(filas):
+                # El primero de la cola está esperando su reintento
+                return max(0.0, filas[len(listos)][3] - ahora_ts())
+
+    def _informar(self):
+        """Resumen periódico del ritmo de la bandeja y aviso si el lag cruza INBOX_LAG_AVISO."""
+        if (self.lag_segundos > INBOX_LAG_AVISO) != self._lag_avisado:
+            self._lag_avisado = not self._lag_avisado
+            if self._lag_avisado:
+                print(f"⚠️ Bandeja de webhooks con {self.lag_segundos:.0f} s de retraso ({self.pendientes} pendientes)")
+            else:
+                print(f"📥 Bandeja de webhooks recuperada: {self.lag_segundos:.0f} s de retraso")
+        ahora = ahora_ts()
+        if ahora - self._ultimo_informe >= INBOX_INFORME_SEGUNDOS:
+            if self._aplicados_sin_informar:
+                print(f"📥 Bandeja de webhooks: {self._aplicados_sin_informar} eventos aplicados en {ahora - self._ultimo_informe:.0f} s, "
+                      f"{self.eventos_por_minuto()} eventos/min, {self.pendientes} pendientes, {self.lag_segundos:.1f} s de retraso")
+            self._aplicados_sin_informar = 0
+            self._ultimo_informe = ahora
+
+    @metricas.medido("webhook", "inbox_lote")
+    async def _procesar_lote(self, filas) -> bool:
+        """Aplica varios eventos en una sola transacción. Devuelve False si hay que ir uno a uno."""
+        try:
+            payloads = [json.loads(payload_crudo) for _, payload_crudo, _, _, _ in filas]
+            resultados = await asyncio.to_thread(procesar_eventos_webhook, payloads)
+        except Exception as e:
+            print(f"⚠️ Lote de {len(filas)} eventos de la bandeja falló ({e}); se aplican uno a uno")
+            return False
+        actualizaciones = []
+        for (inbox_id, _, intentos, _, _), (cuerpo, estado) in zip(filas, resultados):
+            if 400 <= estado < 500 and estado != 409:
+                actualizaciones.append((inbox_id, "muerto", intentos + 1, None, json.dumps(cuerpo)))
+            else:
+                actualizaciones.append((inbox_id, "procesado", intentos + 1, None, None))
+        await asyncio.to_thread(_actualizar_inbox_lote, actualizaciones)
+        for cuerpo, estado in resultados:
+            self._registrar_resultado(cuerpo, estado)
+        return True
+
+    @metricas.medido("webhook", "inbox_evento")
+    async def _procesar(self, inbox_id, payload_crudo, intentos):
+        """Aplica un evento. Devuelve la espera hasta el reintento si falló, o None."""
+        try:
+            cuerpo, estado = await asyncio.to_thread(procesar_evento_webhook, json.loads(payload_crudo))
+        except Exception as e:
+            intentos += 1
+            if intentos < INBOX_MAX_INTENTOS:
+                self.reintentos += 1
+                espera = min(2 ** intentos, 300)
+                print(f"⚠️ Evento {inbox_id} de la bandeja falló ({e}); reintento {intentos} en {espera}s")
+                await asyncio.to_thread(_actualizar_inbox, inbox_id, "pendiente", intentos, ahora_ts() + espera, str(e))
+                return espera
+            print(f"☠️ Evento {inbox_id} de la bandeja descartado tras {intentos} intentos: {e}")
+            cuerpo, estado = {"error": str(e)}, 500
+            await asyncio.to_thread(_actualizar_inbox, inbox_id, "muerto", intentos, None, str(e))
+        else:
+            intentos += 1
+            if 400 <= estado < 500 and estado != 409:
+                await asyncio.to_thread(_actualizar_inbox, inbox_id, "muerto", intentos, None, json.dumps(cuerpo))
+            else:
+                await asyncio.to_thread(_actualizar_inbox, inbox_id, "procesado", intentos)
+        self._registrar_resultado(cuerpo, estado)
+        return None
+
+    def _registrar_resultado(self, cuerpo, estado):
+        if estado >= 400 and estado != 409:
+            self.muertos += 1
+        else:
+            self.procesados += 1
+        self._completados.append(ahora_ts())
+        self.pendientes = max(0, self.pendientes - 1)
+        if estado == 200 and cuerpo.get("status") == "ok":
+            # lanzar anuncio auto: limpiar canal y publicar lista (agrupando ráfagas)
+            disparador_anuncio.disparar(cuerpo["guild_id"])
+
+trabajador_inbox = TrabajadorInbox()
+
+# -----------------
+# DEDUPLICACIÓN DE EVENTOS
+# -----------------
+# Días que se recuerdan los event_id; un reenvío más antiguo se trataría como evento nuevo
+WEBHOOK_RETENCION_DIAS = float(os.getenv("WEBHOOK_RETENCION_DIAS", "30"))
+WEBHOOK_FILTRO_CAPACIDAD = int(os.getenv("WEBHOOK_FILTRO_CAPACIDAD", "200000"))
+WEBHOOK_FILTRO_TASA_FP = 0.01
+PURGA_LOTE = 5000
+
+class DeduplicadorEventos:
+    """Filtro de Bloom en memoria delante de webhook_events y webhook_inbox.
+
+    - Si el filtro no ha visto un event_id, es nuevo seguro y no hace falta consultar la DB.
+    - Si lo ha visto puede ser un falso positivo, así que se confirma en la DB.
+    - Los eventos encolados por otros procesos no están en el filtro: la restricción UNIQUE
+      de la bandeja y la comprobación al aplicar siguen evitando los duplicados.
+    - Se reconstruye desde la DB al arrancar y tras cada purga.
+    """
+
+    def __init__(self, capacidad, tasa_fp):
+        self.bits_totales = max(8, int(-capacidad * math.log(tasa_fp) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.bits_totales / capacidad * math.log(2)))
+        self._bits = bytearray((self.bits_totales + 7) // 8)
+        self._bloqueo = threading.Lock()
+        self._recientes = None
+        self.listo = False
+        self.elementos = 0
+        self.consultas = 0
+        self.descartados = 0
+        self.falsos_positivos = 0
+        self.purgados = 0
+        self.ultima_purga = None
+
+    def _posiciones(self, event_id: str):
+        resumen = hashlib.blake2b(event_id.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(resumen[:8], "little")
+        h2 = int.from_bytes(resumen[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits_totales for i in range(self.num_hashes)]
+
+    def _contiene(self, bits, event_id: str) -> bool:
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._posiciones(event_id))
+
+    def _marcar(self, bits, event_id: str):
+        for p in self._posiciones(event_id):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def candidatos(self, event_ids):
+        """Devuelve los event_id que hay que comprobar en la DB (todos si el filtro no está listo)."""
+        event_ids = list(event_ids)
+        with self._bloqueo:
+            if not self.listo:
+                return event_ids
+            self.consultas += len(event_ids)
+            candidatos = [e for e in event_ids if self._contiene(self._bits, e)]
+            self.descartados += len(event_ids) - len(candidatos)
+        return candidatos
+
+    def registrar_consulta(self, comprobados: int, encontrados: int):
+        """Anota cuántos de los candidatos comprobados en la DB resultaron no estar (falsos positivos)."""
+        if self.listo:
+            self.falsos_positivos += comprobados - encontrados
+
+    def anadir(self, event_ids):
+        with self._bloqueo:
+            for event_id in event_ids:
+                self._marcar(self._bits, event_id)
+                self.elementos += 1
+                if self._recientes is not None:
+                    self._recientes.append(event_id)
+
+    def reconstruir(self):
+        """Carga en un filtro nuevo los event_id que quedan en la DB y lo pone en uso."""
+        with self._bloqueo:
+            self._recientes = []
+        bits = bytearray(len(self._bits))
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT event_id FROM webhook_events UNION SELECT event_id FROM webhook_inbox")
+        elementos = 0
+        for (event_id,) in cursor.fetchall():
+            self._marcar(bits, event_id)
+            elementos += 1
+        conn.close()
+        with self._bloqueo:
+            # Los que se encolaron mientras se leía la DB
+            for event_id in self._recientes:
+                self._marcar(bits, event_id)
+            elementos += len(self._recientes)
+            self._bits = bits
+            self.elementos = elementos
+            self._recientes = None
+            self.listo = True
+        print(f"🧮 Filtro de eventos de webhook reconstruido con {elementos} event_id")
+
+    def purgar(self) -> int:
+        """Borra los event_id y las entradas procesadas de la bandeja más antiguos que la retención."""
+        limite = ahora_ts() - WEBHOOK_RETENCION_DIAS * 86400
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        borradas = 0
+        for tabla, condicion in (("webhook_events", "recibido_en < ?"),
+                                 ("webhook_inbox", "estado = 'procesado' AND recibido_en < ?")):
+            # Por tandas, para no bloquear las tablas mucho rato
+            while True:
+                cursor.execute(adapt_placeholders(
+                    f"DELETE FROM {tabla} WHERE event_id IN (SELECT event_id FROM {tabla} WHERE {condicion} LIMIT {PURGA_LOTE})"
+                ), (limite,))
+                tanda = cursor.rowcount
+                conn.commit()
+                borradas += tanda
+                if tanda < PURGA_LOTE:
+                    break
+        conn.close()
+        self.purgados += borradas
+        self.ultima_purga = ahora_ts()
+        if borradas:
+            print(f"🧹 Purgados {borradas} eventos de webhook con más de {WEBHOOK_RETENCION_DIAS:g} días")
+        self.reconstruir()
+        return borradas
+
+    def estadisticas(self):
+        nuevos = self.descartados + self.falsos_positivos
+        return {
+            "listo": self.listo,
+            "elementos": self.elementos,
+            "capacidad": WEBHOOK_FILTRO_CAPACIDAD,
+            "consultas": self.consultas,
+            "descartados_sin_db": self.descartados,
+            "falsos_positivos": self.falsos_positivos,
+            "tasa_falsos_positivos": round(self.falsos_positivos / nuevos, 4) if nuevos else 0.0,
+            "purgados": self.purgados,
+            "ultima_purga": self.ultima_purga,
+        }
+
+deduplicador_eventos = DeduplicadorEventos(WEBHOOK_FILTRO_CAPACIDAD, WEBHOOK_FILTRO_TASA_FP)
 
 # =========================
 # SISTEMA DE BÚSQUEDA AVANZADA
 # =========================
-# Cargar sistema de búsqueda de objetos
-try:
-    with open('mega_lista_objetos_completa.json', 'r', encoding='utf-8') as f:
-        sistema_busqueda = json.load(f)
-    print(f"Sistema de búsqueda cargado con {len(sistema_busqueda)} objetos")
-except FileNotFoundError:
-    sistema_busqueda = {}
-    print("⚠️ Sistema de búsqueda no encontrado. Usando sistema básico.")
+# Catálogo de objetos: se carga la primera vez que se necesita (o en segundo plano
+# durante el arranque), no al importar el módulo. Se rellena en su sitio, así que las
+# referencias a sistema_busqueda siguen siendo válidas.
+sistema_busqueda: Dict[str, Dict[str, Any]] = {}
+_catalogo_cargado = False
+_bloqueo_catalogo = threading.Lock()
+
+def asegurar_catalogo() -> Dict[str, Dict[str, Any]]:
+    """Carga el catálogo si aún no está cargado y lo devuelve."""
+    global _catalogo_cargado
+    if _catalogo_cargado:
+        return sistema_busqueda
+    with _bloqueo_catalogo:
+        if not _catalogo_cargado:
+            try:
+                with open('mega_lista_objetos_completa.json', 'r', encoding='utf-8') as f:
+                    sistema_busqueda.update(json.load(f))
+                print(f"Sistema de búsqueda cargado con {len(sistema_busqueda)} objetos")
+            except FileNotFoundError:
+                print("⚠️ Sistema de búsqueda no encontrado. Usando sistema básico.")
+            _catalogo_cargado = True
+    return sistema_busqueda
 
 def buscar_objetos(termino_busqueda, limite=25):
     """Busca objetos que coincidan con el término de búsqueda usando búsqueda híbrida"""
+    asegurar_catalogo()
     termino = termino_busqueda.lower().strip()
     if not termino:
         return []
@@ -557,9 +2851,9 @@ def buscar_objetos(termino_busqueda, limite=25):
     
     return resultados_unicos[:limite]
 
-def buscar_objetos_inventario(termino_busqueda, user_id, limite=25):
+def buscar_objetos_inventario(termino_busqueda, guild_id, user_id, limite=25):
     """Busca objetos que coincidan con el término de búsqueda y que estén en el inventario del usuario usando búsqueda híbrida"""
-    if not sistema_busqueda:
+    if not asegurar_catalogo():
         return []
     
     termino = termino_busqueda.lower().strip()
@@ -572,7 +2866,7 @@ def buscar_objetos_inventario(termino_busqueda, user_id, limite=25):
         return []
     
     # Obtener objetos del usuario desde la base de datos
-    inventario_usuario = get_registro_usuario(user_id)
+    inventario_usuario = get_registro_usuario(guild_id, user_id)
     objetos_disponibles = [nombre for nombre, cantidad in inventario_usuario.items() if cantidad > 0]
     
     resultados_prefijo = []
@@ -635,6 +2929,7 @@ def buscar_objetos_inventario(termino_busqueda, user_id, limite=25):
 
 def obtener_categoria_objeto(nombre_objeto):
     """Obtiene la categoría de un objeto usando el sistema de búsqueda"""
+    asegurar_catalogo()
     nombre_normalizado = nombre_objeto.lower().strip()
     
     # Buscar coincidencia exacta primero
@@ -724,84 +3019,438 @@ def barra_progreso(total: int, limite: int, ancho: int = 10) -> str:
     vacios = ancho - llenos
     return "[{}{}]".format("▣"*llenos, "▢"*vacios)
 
+def formatear_historial(historial_usuario) -> str:
+    """Texto del historial agrupado por tipo de operación (almacenes, retiros, transferencias, reputación)."""
+    mensaje = ""
+    # Separar operaciones por tipo
+    añadidos = []
+    retirados = []
+    transferidos = []
+    reputacion_ganada = []
+
+    for ts, accion, item, cant, ubic, usuario_rel in historial_usuario:
+        ubic_txt = f" (Ubicación: {ubic})" if ubic else ""
+        usuario_txt = f" → {usuario_rel}" if usuario_rel and accion in ["Transferido", "Recibido"] else f" ← {usuario_rel}" if usuario_rel else ""
+
+        if accion == "Añadido":
+            añadidos.append(f"[{ts}] ✅ {item} ({cant}){ubic_txt}")
+        elif accion == "Retirado":
+            retirados.append(f"[{ts}] ❌ {item} ({abs(cant)}){ubic_txt}")
+        elif accion == "Transferido":
+            transferidos.append(f"[{ts}] 🔄 Enviado: {item} ({abs(cant)}){ubic_txt}{usuario_txt}")
+        elif accion == "Recibido":
+            transferidos.append(f"[{ts}] 🔄 Recibido: {item} ({abs(cant)}){ubic_txt}{usuario_txt}")
+        elif accion == "Ganó Reputación":
+            reputacion_ganada.append(f"[{ts}] 💰 +{cant:.2f} :ReputacionCorvus:")
+
+    # Construir mensaje organizado
+    if añadidos:
+        mensaje += "**📦 Almacenes:**\n"
+        for linea in añadidos:
+            mensaje += f"{linea}\n"
+        mensaje += "\n"
+
+    if retirados:
+        mensaje += "**📤 Retirados:**\n"
+        for linea in retirados:
+            mensaje += f"{linea}\n"
+        mensaje += "\n"
+
+    if transferidos:
+        mensaje += "**🔄 Transferencias:**\n"
+        for linea in transferidos:
+            mensaje += f"{linea}\n"
+        mensaje += "\n"
+
+    if reputacion_ganada:
+        mensaje += "**💰 Reputación Ganada:**\n"
+        for linea in reputacion_ganada:
+            mensaje += f"{linea}\n"
+    return mensaje
+
+def _datos_inventario(guild_id):
+    """Todo lo que necesita el botón de inventario, leído fuera del bucle de eventos:
+    inventario, categoría y límite de cada objeto y quién lo ha aportado."""
+    inventario_actual = get_inventario(guild_id)
+    categorias = {item: get_categoria(item) for item in inventario_actual}
+    limites_items = {item: obtener_limite(item) for item in inventario_actual}
+    return inventario_actual, categorias, limites_items, get_reparto_inventario(guild_id)
+
 # =========================
 # FUNCIONES DE LIMPIEZA AUTOMÁTICA
 # =========================
-async def limpiar_canal_diario():
-    """Limpia todo el canal a las 12:00 del mediodía"""
-    try:
-        # Obtener el canal desde la variable de entorno o usar un canal por defecto
-        canal_id = os.getenv("CANAL_CONTRATOS_ID")
-        if not canal_id:
-            print("⚠️ CANAL_CONTRATOS_ID no configurado. No se puede limpiar el canal.")
-            return
-        
-        canal = bot.get_channel(int(canal_id))
+# Canales de contratos, uno por servidor: CANALES_CONTRATOS con los ids separados por comas.
+# CANAL_CONTRATOS_ID (la configuración de un solo servidor) se sigue aceptando como uno más.
+CANALES_CONTRATOS = [int(canal_id) for canal_id in re.split(r"[,\s]+", f"{os.getenv('CANALES_CONTRATOS', '')},{os.getenv('CANAL_CONTRATOS_ID', '')}") if canal_id]
+
+def canales_contratos(guilds=None):
+    """{guild_id: canal} de los canales de contratos configurados (sólo de `guilds` si se indican)."""
+    canales = {}
+    for canal_id in CANALES_CONTRATOS:
+        canal = bot.get_channel(canal_id)
         if not canal:
             print(f"❌ No se pudo encontrar el canal con ID: {canal_id}")
-            return
+            continue
+        if guilds and canal.guild.id not in guilds:
+            continue
+        if canal.guild.id in canales:
+            print(f"⚠️ El servidor {canal.guild.id} tiene varios canales de contratos; se usa {canales[canal.guild.id].id}")
+            continue
+        canales[canal.guild.id] = canal
+    if not CANALES_CONTRATOS:
+        print("⚠️ CANALES_CONTRATOS no configurado. No hay canal de contratos.")
+    return canales
+
+async def limpiar_canal_diario(guilds=None):
+    """Limpia todo el canal de contratos de cada servidor (o sólo de `guilds`) a las 12:00 del mediodía"""
+    for guild_id, canal in canales_contratos(guilds).items():
+        try:
+            # Limpiar todos los mensajes del canal
+            deleted = await canal.purge(limit=None)
+            print(f"🧹 Canal de {guild_id} limpiado: {len(deleted)} mensajes eliminados")
+        except Exception as e:
+            print(f"❌ Error al limpiar el canal de {guild_id}: {e}")
+
+async def anunciar_contratos_diario(guilds=None):
+    """Anuncia los contratos disponibles de cada servidor (o sólo de `guilds`) en su canal a las 12:01"""
+    for guild_id, canal in canales_contratos(guilds).items():
+        try:
+            await _anunciar_contratos_en(canal, guild_id)
+        except Exception as e:
+            print(f"❌ Error al anunciar contratos en {guild_id}: {e}")
+
+async def _anunciar_contratos_en(canal, guild_id):
+    """Publica en `canal` la lista de contratos del servidor con la botonera."""
+    contratos = await asyncio.to_thread(get_contratos, guild_id)
+    
+    if not contratos:
+        mensaje = "@here\n🔄 ** ACTUALIZACIÓN DIARIA DE LOS CONTRATOS DISPONIBLES:** 🔄\n\n**📋 CONTRATOS DISPONIBLES:**\n\n❌ **No hay contratos disponibles en este momento.**\n\n---\n💼 **Total de contratos activos: 0**\n⏰ **Actualizado automáticamente a las 12:01**"
+    else:
+        mensaje = "@here\n🔄 ** ACTUALIZACIÓN DIARIA DE LOS CONTRATOS DISPONIBLES:** 🔄\n\n**📋 CONTRATOS DISPONIBLES:**\n\n"
         
-        # Limpiar todos los mensajes del canal
-        deleted = await canal.purge(limit=None)
-        print(f"🧹 Canal limpiado: {len(deleted)} mensajes eliminados")
+        for i, (nombre, enlace) in enumerate(contratos, 1):
+            mensaje += f"**{i}.** **{nombre}**\n{enlace}\n\n"
         
+        mensaje += f"---\n💼 **Total de contratos activos: {len(contratos)}**\n⏰ **Actualizado automáticamente a las 12:01**"
+    
+    # Enviar mensaje con botonera pública
+    view = BotoneraView()
+    await canal.send(mensaje, view=view)
+    print(f"📢 Anuncio diario enviado en {guild_id}: {len(contratos)} contratos")
+
+@tasks.loop(time=time(11, 30))
+@metricas.medido("tarea")
+async def tarea_limpieza_diaria():
+    """Tarea programada para limpiar el canal a las 12:30 España (11:30 UTC)"""
+    await limpiar_canal_diario()
+
+@tasks.loop(time=time(11, 31))
+@metricas.medido("tarea")
+async def tarea_anuncio_diario():
+    """Tarea programada para anunciar contratos a las 12:31 España (11:31 UTC)"""
+    await anunciar_contratos_diario()
+
+@tasks.loop(time=time(4, 0))
+@metricas.medido("tarea")
+async def tarea_archivo_historial():
+    """Tarea programada para guardar checkpoints de saldos y archivar el historial antiguo a las 5:00 España (4:00 UTC)"""
+    try:
+        await asyncio.to_thread(crear_checkpoints)
+        await asyncio.to_thread(archivar_historial)
+    except Exception as e:
+        print(f"❌ Error al archivar el historial: {e}")
+
+@tasks.loop(hours=6)
+@metricas.medido("tarea")
+async def tarea_purga_webhooks():
+    """Purga los event_id de webhooks fuera de la ventana de retención"""
+    try:
+        await asyncio.to_thread(deduplicador_eventos.purgar)
     except Exception as e:
-        print(f"❌ Error al limpiar el canal: {e}")
+        print(f"❌ Error al purgar eventos de webhook: {e}")
+
+# Cada cuántos minutos se compara el inventario en memoria con la DB
+INVENTARIO_RECONCILIAR_MINUTOS = float(os.getenv("INVENTARIO_RECONCILIAR_MINUTOS", "10"))
+
+@tasks.loop(minutes=INVENTARIO_RECONCILIAR_MINUTOS)
+@metricas.medido("tarea")
+async def tarea_reconciliar_inventario():
+    """Corrige el inventario en memoria si se ha desviado de la DB"""
+    try:
+        await asyncio.to_thread(inventario_banco.reconciliar)
+    except Exception as e:
+        print(f"❌ Error al reconciliar el inventario en memoria: {e}")
+
+# =========================
+# ARRANQUE (SETUP HOOK)
+# =========================
+# setup_hook corre antes de conectar con el gateway: lo que tarde retrasa la conexión.
+# Por eso el esquema, el filtro de eventos y el catálogo se preparan en hilos mientras
+# discord.py se conecta, y lo que necesita la DB espera a esperar_preparacion().
+_preparacion: Optional[asyncio.Task] = None
+
+def _en_subfase(nombre, funcion):
+    with metricas.arranque.subfase(nombre):
+        return funcion()
+
+async def _preparar_datos():
+    async def esquema_y_eventos():
+        # La bandeja de webhooks necesita el esquema al día antes de que llegue el primer evento
+        await asyncio.to_thread(_en_subfase, "esquema (init_database)", init_database)
+        await asyncio.to_thread(_en_subfase, "filtro de eventos de webhook", deduplicador_eventos.reconstruir)
+        trabajador_inbox.iniciar()
+        if USE_POSTGRES:
+            # Validar la instantánea antes de escuchar avisos dejaría un hueco sin invalidaciones
+            await asyncio.to_thread(bus_invalidacion.escuchando.wait, 10)
+        await asyncio.to_thread(_en_subfase, "instantánea de cachés", cargar_instantanea)
+    await asyncio.gather(esquema_y_eventos(), asyncio.to_thread(_en_subfase, "catálogo de objetos", asegurar_catalogo))
+
+def iniciar_preparacion():
+    global _preparacion
+    if _preparacion is None or (_preparacion.done() and _preparacion.exception() is not None):
+        _preparacion = asyncio.get_running_loop().create_task(_preparar_datos(), name="preparacion")
+
+async def esperar_preparacion():
+    """Espera a que el esquema esté al día. Si la preparación falló, la reintenta."""
+    if _preparacion is None:
+        return
+    if _preparacion.done() and _preparacion.exception() is not None:
+        iniciar_preparacion()
+    await asyncio.shield(_preparacion)
+
+def preparacion_lista() -> bool:
+    return _preparacion is not None and _preparacion.done() and _preparacion.exception() is None
+
+# Runner del servidor HTTP (keep-alive y webhooks) cuando KEEP_ALIVE está activo
+servidor_http: Optional[web.AppRunner] = None
+
+_cerrar_discord = bot.close
+
+async def cerrar_bot():
+    """Cierra primero el servidor HTTP, dejando terminar las peticiones en curso, y después Discord.
+
+    Sustituye a bot.close, así que la usan tanto SIGTERM como el final de bot.run.
+    """
+    global servidor_http
+    runner, servidor_http = servidor_http, None
+    if runner is not None:
+        try:
+            await runner.cleanup()
+            print("🌐 Servidor HTTP cerrado")
+        except Exception as e:
+            print(f"⚠️ Error al cerrar el servidor HTTP: {e}")
+    await _cerrar_discord()
+
+bot.close = cerrar_bot
+
+@bot.event
+async def setup_hook():
+    global servidor_http
+    metricas.arranque.marcar("login HTTP")
+    # Todos los asyncio.to_thread van a este pool, que cuenta lo que tiene en curso y en cola
+    metricas.pool_hilos.instalar(asyncio.get_running_loop())
+    iniciar_preparacion()
+    # SIGTERM (despliegue, reinicio del host) cierra como Ctrl+C: bot.run vuelve y se guarda la instantánea
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+    except (NotImplementedError, RuntimeError):
+        pass
+    # Registrar las vistas persistentes una sola vez: discord.py enruta las interacciones
+    # de mensajes antiguos por custom_id sin tener que volver a publicarlos.
+    bot.add_view(BotoneraView())
+    print("🧩 Vistas persistentes registradas")
+    metricas.monitor_bucle.iniciar()
+    if not tarea_sonda_salud.is_running():
+        tarea_sonda_salud.start()
+    bus_invalidacion.iniciar()
+
+    if os.getenv("KEEP_ALIVE"):
+        try:
+            print("🚀 Activando keep-alive...")
+            with metricas.arranque.subfase("servidor HTTP"):
+                servidor_http = await keep_alive()
+        except Exception as _e:
+            print("ℹ️ KEEP_ALIVE habilitado pero no se pudo iniciar keep_alive. Continuando sin él.")
+    metricas.arranque.marcar("setup_hook")
+
+# =========================
+# MÉTRICAS DE COMANDOS Y COLECTORES
+# =========================
+@bot.before_invoke
+async def medir_comando_inicio(ctx):
+    ctx.medicion = metricas.medir("comando", ctx.command.qualified_name).empezar()
+    # Un comando que llega justo tras conectar espera a que el esquema esté listo
+    await esperar_preparacion()
+
+@bot.after_invoke
+async def medir_comando_fin(ctx):
+    # discord.py llama a este hook también cuando el comando falla
+    medicion = getattr(ctx, "medicion", None)
+    if medicion is not None:
+        medicion.terminar(ctx.command_failed)
+
+@metricas.registrar_colector
+def metricas_estado():
+    """Cachés, inventario, bandeja y deduplicador de webhooks y anuncio de contratos, leídos sólo al exponer /metrics."""
+    lineas = ["# TYPE banco_cache_aciertos_total counter"]
+    lineas += [f'banco_cache_aciertos_total{{cache="{nombre}"}} {cache.aciertos}' for nombre, cache in CACHES.items()]
+    lineas.append("# TYPE banco_cache_fallos_total counter")
+    lineas += [f'banco_cache_fallos_total{{cache="{nombre}"}} {cache.fallos}' for nombre, cache in CACHES.items()]
+    lineas += ["# TYPE banco_inventario_divergencias_total counter", f"banco_inventario_divergencias_total {inventario_banco.divergencias}"]
+    for nombre, valor in trabajador_inbox.estadisticas().items():
+        if nombre in ("procesados", "reintentos", "muertos"):
+            lineas += [f"# TYPE banco_inbox_{nombre}_total counter", f"banco_inbox_{nombre}_total {valor}"]
+        else:
+            lineas += [f"# TYPE banco_inbox_{nombre} gauge", f"banco_inbox_{nombre} {valor}"]
+    filtro = deduplicador_eventos.estadisticas()
+    lineas += [
+        "# TYPE banco_webhook_purgados_total counter", f"banco_webhook_purgados_total {filtro['purgados']}",
+        "# TYPE banco_webhook_filtro_consultas_total counter", f"banco_webhook_filtro_consultas_total {filtro['consultas']}",
+        "# TYPE banco_webhook_filtro_descartados_total counter", f"banco_webhook_filtro_descartados_total {filtro['descartados_sin_db']}",
+        "# TYPE banco_webhook_filtro_falsos_positivos_total counter", f"banco_webhook_filtro_falsos_positivos_total {filtro['falsos_positivos']}",
+        "# TYPE banco_webhook_filtro_tasa_falsos_positivos gauge", f"banco_webhook_filtro_tasa_falsos_positivos {filtro['tasa_falsos_positivos']}",
+        "# TYPE banco_webhook_filtro_elementos gauge", f"banco_webhook_filtro_elementos {filtro['elementos']}",
+    ]
+    anuncio = disparador_anuncio.estadisticas()
+    for nombre in ("disparos", "colapsados", "ejecuciones"):
+        lineas += [f"# TYPE banco_anuncio_{nombre}_total counter", f"banco_anuncio_{nombre}_total {anuncio[nombre]}"]
+    lineas += ["# TYPE banco_anuncio_en_curso gauge", f"banco_anuncio_en_curso {int(anuncio['en_curso'])}"]
+    return lineas
 
-async def anunciar_contratos_diario():
-    """Anuncia todos los contratos disponibles a las 12:01"""
+# =========================
+# SALUD (READINESS)
+# =========================
+# /healthz/ready responde con lo último que midió la sonda en segundo plano y con
+# valores que ya están en memoria (lag del bucle, latencia del gateway, tareas):
+# atender un health check no abre conexiones ni hace consultas.
+SALUD_INTERVALO = 15
+SALUD_DB_MAX_MS = float(os.getenv("SALUD_DB_MAX_MS", "1000"))
+SALUD_LATENCIA_MAX = float(os.getenv("SALUD_LATENCIA_MAX", "5"))
+SALUD_LAG_MAX = float(os.getenv("SALUD_LAG_MAX", "1"))
+# Segundos que puede seguir habiendo trabajos esperando hilo antes de dar el pool por saturado
+SALUD_HILOS_COLA_MAX = float(os.getenv("SALUD_HILOS_COLA_MAX", "5"))
+
+sonda_db = {"ok": False, "ms": None, "motor": None, "medido_en": None, "error": None}
+
+def _sondear_db():
+    """Ida y vuelta a la DB con SELECT 1."""
+    inicio = metricas.reloj()
     try:
-        # Obtener el canal desde la variable de entorno
-        canal_id = os.getenv("CANAL_CONTRATOS_ID")
-        if not canal_id:
-            print("⚠️ CANAL_CONTRATOS_ID no configurado. No se puede anunciar contratos.")
-            return
-        
-        canal = bot.get_channel(int(canal_id))
-        if not canal:
-            print(f"❌ No se pudo encontrar el canal con ID: {canal_id}")
-            return
-        
-        # Obtener todos los contratos de la base de datos
-        contratos = get_contratos()
-        
-        if not contratos:
-            mensaje = "@here\n🔄 ** ACTUALIZACIÓN DIARIA DE LOS CONTRATOS DISPONIBLES:** 🔄\n\n**📋 CONTRATOS DISPONIBLES:**\n\n❌ **No hay contratos disponibles en este momento.**\n\n---\n💼 **Total de contratos activos: 0**\n⏰ **Actualizado automáticamente a las 12:01**"
-        else:
-            mensaje = "@here\n🔄 ** ACTUALIZACIÓN DIARIA DE LOS CONTRATOS DISPONIBLES:** 🔄\n\n**📋 CONTRATOS DISPONIBLES:**\n\n"
-            
-            for i, (nombre, enlace) in enumerate(contratos, 1):
-                mensaje += f"**{i}.** **{nombre}**\n{enlace}\n\n"
-            
-            mensaje += f"---\n💼 **Total de contratos activos: {len(contratos)}**\n⏰ **Actualizado automáticamente a las 12:01**"
-        
-        # Enviar mensaje con botonera pública
-        view = BotoneraView()
-        await canal.send(mensaje, view=view)
-        print(f"📢 Anuncio diario enviado: {len(contratos)} contratos")
-        
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        finally:
+            conn.close()
+        sonda_db.update(ok=True, error=None, motor="sqlite" if isinstance(conn, sqlite3.Connection) else "postgres")
     except Exception as e:
-        print(f"❌ Error al anunciar contratos: {e}")
+        sonda_db.update(ok=False, error=str(e))
+    sonda_db.update(ms=round((metricas.reloj() - inicio) * 1000, 1), medido_en=ahora_ts())
 
-@tasks.loop(time=time(11, 30))
-async def tarea_limpieza_diaria():
-    """Tarea programada para limpiar el canal a las 12:30 España (11:30 UTC)"""
-    await limpiar_canal_diario()
+@tasks.loop(seconds=SALUD_INTERVALO)
+async def tarea_sonda_salud():
+    await asyncio.to_thread(_sondear_db)
 
-@tasks.loop(time=time(11, 31))
-async def tarea_anuncio_diario():
-    """Tarea programada para anunciar contratos a las 12:31 España (11:31 UTC)"""
-    await anunciar_contratos_diario()
+def _estado_tarea(tarea):
+    siguiente = tarea.next_iteration
+    return {"activa": tarea.is_running(), "fallida": tarea.failed(),
+            "siguiente": siguiente.isoformat() if siguiente else None}
+
+TAREAS_PROGRAMADAS = {
+    "limpieza_diaria": tarea_limpieza_diaria,
+    "anuncio_diario": tarea_anuncio_diario,
+    "archivo_historial": tarea_archivo_historial,
+    "purga_webhooks": tarea_purga_webhooks,
+    "reconciliar_inventario": tarea_reconciliar_inventario,
+    "sonda_salud": tarea_sonda_salud,
+}
+
+def informe_salud():
+    """Estado del bot para /healthz/ready: (informe, lista de problemas)."""
+    problemas = []
+    edad_sonda = ahora_ts() - sonda_db["medido_en"] if sonda_db["medido_en"] else None
+    if not sonda_db["ok"]:
+        problemas.append(f"db: {sonda_db['error'] or 'sin sondear todavía'}")
+    elif edad_sonda is None or edad_sonda > 3 * SALUD_INTERVALO:
+        problemas.append("db: sonda sin actualizar")
+    elif sonda_db["ms"] > SALUD_DB_MAX_MS:
+        problemas.append(f"db: {sonda_db['ms']} ms")
+    if USE_POSTGRES and interruptor_postgres.abierto:
+        problemas.append("db: interruptor de Postgres abierto")
+
+    lag = metricas.monitor_bucle.percentiles((0.5, 0.99))
+    parado = metricas.monitor_bucle.segundos_sin_latir()
+    if lag[0.99] > SALUD_LAG_MAX or parado > metricas.monitor_bucle.intervalo + SALUD_LAG_MAX:
+        problemas.append(f"bucle: lag p99 {lag[0.99]:.3f} s")
+
+    latencia = bot.latency
+    conectado = bot.is_ready() and not bot.is_closed()
+    if not conectado:
+        problemas.append("gateway: desconectado")
+    elif not math.isfinite(latencia) or latencia > SALUD_LATENCIA_MAX:
+        problemas.append(f"gateway: latencia {latencia:.1f} s")
+
+    tareas = {nombre: _estado_tarea(tarea) for nombre, tarea in TAREAS_PROGRAMADAS.items()}
+    if bot.is_ready():
+        problemas += [f"tarea {nombre}: parada" for nombre, estado in tareas.items() if not estado["activa"]]
+    if not preparacion_lista():
+        problemas.append("arranque: esquema o catálogo sin preparar")
+    inbox = trabajador_inbox.estadisticas()
+    if trabajador_inbox.saturado():
+        problemas.append(f"inbox: {inbox['pendientes']} pendientes")
+    hilos = metricas.pool_hilos.estado()
+    if hilos["cola_segundos"] > SALUD_HILOS_COLA_MAX:
+        problemas.append(f"hilos: {hilos['en_cola']} trabajos en cola desde hace {hilos['cola_segundos']:.0f} s")
+
+    informe = {
+        "estado": "ok" if not problemas else "degradado",
+        "problemas": problemas,
+        "db": {**sonda_db, "edad_sonda_segundos": round(edad_sonda, 1) if edad_sonda is not None else None,
+               "interruptor": interruptor_postgres.estadisticas() if USE_POSTGRES else None},
+        "hilos": hilos,
+        "bucle": {"lag_p50": round(lag[0.5], 4), "lag_p99": round(lag[0.99], 4), "bloqueos": metricas.monitor_bucle.bloqueos},
+        "gateway": {"conectado": conectado, "latencia": round(latencia, 3) if math.isfinite(latencia) else None,
+                    "shards": {shard_id: round(lat, 3) if math.isfinite(lat) else None for shard_id, lat in bot.latencies}},
+        "tareas": tareas,
+        "inbox": inbox,
+        "arranque": {"listo": preparacion_lista(),
+                     "segundos": round(metricas.arranque.total, 3) if metricas.arranque.total is not None else None},
+    }
+    return informe, problemas
+
+async def healthz_ready(request):
+    informe, problemas = informe_salud()
+    return web.json_response(informe, status=200 if not problemas else 503)
+
+app.router.add_get("/healthz/ready", healthz_ready)
 
 # =========================
 # EVENTO BOT READY
 # =========================
 @bot.event
 async def on_ready():
-    print(f"Bot conectado como {bot.user} (id: {bot.user.id})")
-    # Inicializar la base de datos al arrancar
-    init_database()
-    print("Base de datos inicializada correctamente")
+    global _guild_por_defecto, _guild_por_defecto_decidido
+    print(f"Bot conectado como {bot.user} (id: {bot.user.id}) — {bot.shard_count} shard(s), {len(bot.guilds)} servidor(es)")
+    primera_vez = metricas.arranque.total is None
+    if primera_vez:
+        metricas.arranque.marcar("gateway hasta on_ready")
+    # El esquema se prepara una vez al arrancar (no en cada reconexión)
+    await esperar_preparacion()
+    if primera_vez:
+        metricas.arranque.marcar("esperar preparación de datos")
+        print("Base de datos inicializada correctamente")
+
+    # Sin GUILD_ID configurado y con un único servidor, ese servidor es el principal
+    # y se queda con los datos anteriores a la partición por servidor
+    if not GUILD_ID_PRINCIPAL and len(bot.guilds) == 1:
+        _guild_por_defecto = bot.guilds[0].id
+        movidas = await asyncio.to_thread(adoptar_datos_sin_servidor, _guild_por_defecto)
+        if movidas:
+            print(f"📦 {movidas} filas sin servidor asignadas a {bot.guilds[0].name} ({_guild_por_defecto})")
+    _guild_por_defecto_decidido = True
+    if not _guild_por_defecto:
+        print("⚠️ GUILD_ID no configurado y el bot está en varios servidores: los webhooks deben indicar guild_id")
     
     # Iniciar las tareas programadas
     if not tarea_limpieza_diaria.is_running():
@@ -812,6 +3461,377 @@ async def on_ready():
         tarea_anuncio_diario.start()
         print("🕐 Tarea de anuncio diario iniciada (12:01)")
 
+    if not tarea_archivo_historial.is_running():
+        tarea_archivo_historial.start()
+        print(f"🕐 Tarea de archivo del historial iniciada (más de {HISTORIAL_ARCHIVO_DIAS:g} días)")
+
+    if not tarea_purga_webhooks.is_running():
+        tarea_purga_webhooks.start()
+        print(f"🕐 Tarea de purga de webhooks iniciada (retención {WEBHOOK_RETENCION_DIAS:g} días)")
+
+    if not tarea_reconciliar_inventario.is_running():
+        tarea_reconciliar_inventario.start()
+        print(f"🕐 Tarea de reconciliación del inventario en memoria iniciada (cada {INVENTARIO_RECONCILIAR_MINUTOS:g} min)")
+
+    if primera_vez:
+        metricas.arranque.marcar("on_ready")
+        metricas.arranque.terminar()
+        print(metricas.arranque.informe())
+
+# =========================
+# PIPELINE DE INTERACCIONES (DEFER INMEDIATO)
+# =========================
+# Tiempo máximo (segundos) que puede tardar el trabajo en segundo plano de una interacción
+TIMEOUT_TRABAJOS_SEGUNDOS = float(os.getenv("TIMEOUT_TRABAJOS_SEGUNDOS", "30"))
+LIMITE_MENSAJE_DISCORD = 2000
+
+# handler -> últimas muestras de tiempo hasta la primera respuesta (segundos)
+tiempos_primera_respuesta: Dict[str, deque] = {}
+# id de trabajo -> info del trabajo en segundo plano que sigue en curso
+trabajos_en_curso: Dict[int, Dict[str, Any]] = {}
+_ids_trabajos = itertools.count(1)
+
+def edad_interaccion(interaction: discord.Interaction) -> float:
+    """Segundos transcurridos desde que Discord creó la interacción (el reloj del límite de 3 s)."""
+    return max(0.0, (discord.utils.utcnow() - interaction.created_at).total_seconds())
+
+def registrar_primera_respuesta(handler: str, segundos: float):
+    muestras = tiempos_primera_respuesta.setdefault(handler, deque(maxlen=500))
+    muestras.append(segundos)
+
+def resumen_primera_respuesta() -> Dict[str, Dict[str, float]]:
+    """Resumen por handler del tiempo hasta la primera respuesta (n, p50, p99, max)."""
+    resumen = {}
+    for handler, muestras in tiempos_primera_respuesta.items():
+        if not muestras:
+            continue
+        ordenadas = sorted(muestras)
+        resumen[handler] = {
+            "n": len(ordenadas),
+            "p50": ordenadas[int(0.50 * (len(ordenadas) - 1))],
+            "p99": ordenadas[int(0.99 * (len(ordenadas) - 1))],
+            "max": ordenadas[-1],
+        }
+    return resumen
+
+def recortar_mensaje(mensaje: str) -> str:
+    """Recorta un mensaje al límite de caracteres de Discord."""
+    if len(mensaje) > LIMITE_MENSAJE_DISCORD:
+        return mensaje[:1900] + "\n\n... (mensaje truncado)"
+    return mensaje
+
+async def ejecutar_trabajo(handler: str, corrutina, timeout: float, al_tardar=None):
+    """Ejecuta una corrutina como trabajo en segundo plano registrado.
+
+    Pasado `timeout` el trabajo NO se cancela: una escritura que corre en un hilo
+    (asyncio.to_thread) no se puede interrumpir y acabaría confirmándose igualmente.
+    Se llama a `al_tardar()` (p. ej. para avisar al usuario) y se sigue esperando el
+    resultado real. Sin `al_tardar` se lanza asyncio.TimeoutError y el trabajo continúa.
+    """
+    trabajo_id = next(_ids_trabajos)
+    tarea = asyncio.create_task(corrutina, name=f"trabajo:{handler}:{trabajo_id}")
+    trabajos_en_curso[trabajo_id] = {"handler": handler, "inicio": datetime.now(), "tarea": tarea}
+    tarea.add_done_callback(lambda _: trabajos_en_curso.pop(trabajo_id, None))
+    try:
+        return await asyncio.wait_for(asyncio.shield(tarea), timeout)
+    except asyncio.TimeoutError:
+        print(f"⏳ Trabajo '{handler}' supera {timeout:g} s; sigue en curso")
+        if al_tardar is None:
+            raise
+        await al_tardar()
+        return await tarea
+
+def accion_diferida(handler: str, actualizar_mensaje: bool = False, timeout: Optional[float] = None):
+    """Decorador para callbacks de botones/modales: responde (defer) al instante y hace el trabajo después.
+
+    El callback decorado devuelve el texto final, o una tupla (texto, vista). El resultado se
+    publica con una única edición de la respuesta original; si no se indica vista, se adjunta
+    el menú principal. Con actualizar_mensaje=True se edita el propio mensaje del componente
+    (útil para vistas efímeras como la selección de objetos).
+    """
+    def decorador(func):
+        @functools.wraps(func)
+        async def envoltura(self, interaction: discord.Interaction, *args):
+            if not interaction.response.is_done():
+                if actualizar_mensaje:
+                    await interaction.response.defer()
+                else:
+                    await interaction.response.defer(ephemeral=True, thinking=True)
+            registrar_primera_respuesta(handler, edad_interaccion(interaction))
+
+            async def avisar_demora():
+                # La operación puede acabar aplicándose: que nadie la repita a ciegas
+                try:
+                    await interaction.edit_original_response(content="⏳ La operación está tardando más de lo normal y sigue en curso. Te mostraré aquí el resultado; no la repitas.")
+                except discord.HTTPException as e:
+                    print(f"❌ No se pudo avisar de la demora de '{handler}': {e}")
+
+            try:
+                await esperar_preparacion()
+                resultado = await ejecutar_trabajo(handler, func(self, interaction, *args), timeout or TIMEOUT_TRABAJOS_SEGUNDOS, avisar_demora)
+            except BaseDatosNoDisponible:
+                resultado = "🔌 La base de datos no está disponible ahora mismo. Inténtalo en unos minutos."
+            except Exception as e:
+                print(f"❌ Error en '{handler}': {e}")
+                resultado = "❌ Ha ocurrido un error procesando la acción. Inténtalo de nuevo."
+
+            mensaje, view = resultado if isinstance(resultado, tuple) else (resultado, None)
+            if view is None:
+                view = BotoneraView()
+            try:
+                await interaction.edit_original_response(content=recortar_mensaje(mensaje), view=view)
+            except discord.HTTPException as e:
+                print(f"❌ No se pudo editar la respuesta de '{handler}': {e}")
+        return envoltura
+    return decorador
+
+# =========================
+# OPERACIONES DEL BANCO
+# =========================
+# Mapear categorías del sistema de búsqueda a categorías del bot (autocorrección)
+MAPEO_CATEGORIAS = {
+    'ARMAS': 'Armas',
+    'MUNICION': 'Armas',      # sin tilde
+    'MUNICIÓN': 'Armas',      # con tilde
+    'CONSUMIBLES': 'Consumibles',
+    'MINERALES': 'Minerales y materiales',
+    'ARMADURA': 'Armaduras',  # singular
+    'ARMADURAS': 'Armaduras', # plural
+    'MEDICINA': 'Medicinas',  # singular
+    'MEDICINAS': 'Medicinas', # plural
+    'ROPA': 'Otros',
+    'OTROS': 'Otros'
+}
+
+def mapear_categoria(categoria) -> str:
+    """Traduce la categoría del sistema de búsqueda a la categoría del bot ('Otros' si no se conoce)."""
+    return MAPEO_CATEGORIAS.get((categoria or '').strip().upper(), 'Otros')
+
+# Serializa las operaciones de lectura-modificación-escritura del banco dentro del proceso
+# (los trabajos corren en hilos y el servidor de webhooks en otro)
+bloqueo_banco = threading.Lock()
+
+def aplicar_deposito(guild_id, usuario, objeto, cantidad) -> str:
+    """Añade `cantidad` del objeto al banco del servidor a nombre del usuario y devuelve el mensaje de resultado."""
+    # Como un depósito múltiple de un solo objeto: límite, banco, registro, reputación e
+    # historial en una transacción y con sumas sobre la tabla (otros procesos pueden escribir)
+    resultados, ganado, reputacion_total = aplicar_depositos_lote(guild_id, usuario.id, [(objeto, cantidad)])
+    resultado = resultados[0]
+    nombre, anadido = resultado['nombre'], resultado['añadido']
+    if anadido <= 0:
+        return f"❌ El almacén para {nombre} está lleno. No se ha añadido nada."
+
+    mensaje = f"✅ {usuario.mention} añadió {anadido} de {nombre} ({resultado['categoria']}).\nGanaste **{ganado:.2f}** :ReputacionCorvus:. Total: **{reputacion_total:.2f}**"
+    if anadido < cantidad:
+        mensaje += f"\n⚠️ Solo se pudieron añadir {anadido} debido al límite de almacenamiento."
+    return mensaje
+
+def aplicar_retiro(guild_id, usuario, objeto, cantidad) -> str:
+    """Retira `cantidad` del objeto del banco del servidor a nombre del usuario y devuelve el mensaje de resultado."""
+    nombre = objeto['nombre']
+    # Un objeto que nunca ha pasado por el banco no tiene id: no hay nada que retirar
+    if mapa_items.id(nombre, confiar_en_fallos=False) is None:
+        return "❌ No tienes suficiente cantidad o el objeto no existe."
+    with bloqueo_banco:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            if not _retirar_en_cursor(cursor, guild_id, usuario.id, nombre, cantidad):
+                conn.rollback()
+                return "❌ No tienes suficiente cantidad o el objeto no existe."
+            confirmar_cambios(conn, cursor, [("inventario", guild_id)])
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    return f"✅ Retiraste {cantidad} de {nombre}."
+
+def _retirar_en_cursor(cursor, guild_id, user_id, nombre, cantidad) -> bool:
+    """Resta `cantidad` del registro del usuario y del banco. Devuelve False (y hay que deshacer) si no le llega."""
+    # La comprobación es el propio resultado de la resta: la fila queda bloqueada hasta el commit
+    restante = _sumar_registro_usuario_en_cursor(cursor, guild_id, user_id, {nombre: -cantidad})[nombre]
+    if restante < 0:
+        return False
+    if restante == 0:
+        cursor.execute(adapt_placeholders("DELETE FROM registro_usuarios WHERE guild_id = ? AND user_id = ? AND item_id = ?"),
+                       (guild_id, user_id, mapa_items.ids_en_cursor(cursor, [nombre])[nombre]))
+    _sumar_inventario_en_cursor(cursor, guild_id, {nombre: -cantidad})
+    _add_historial_en_cursor(cursor, guild_id, [(user_id, "Retirado", nombre, -cantidad, None, None)])
+    return True
+
+# -----------------
+# DEPÓSITO MÚLTIPLE
+# -----------------
+MAX_LINEAS_DEPOSITO_MULTIPLE = 50
+
+def _marcadores(n: int) -> str:
+    """Lista de placeholders '?, ?, ...' para cláusulas IN."""
+    return ", ".join("?" * n)
+
+def _filas_valores(filas: int, columnas: int) -> str:
+    """Placeholders '(?, ?), (?, ?), ...' para un INSERT de varias filas."""
+    return ", ".join([f"({_marcadores(columnas)})"] * filas)
+
+def parsear_deposito_multiple(texto: str):
+    """Convierte líneas 'objeto, cantidad' en [(nombre, cantidad)], sumando repetidos.
+
+    Devuelve también las líneas que no se pudieron interpretar.
+    """
+    entradas: Dict[str, list] = {}
+    errores = []
+    for linea in texto.splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        nombre, separador, cantidad_texto = linea.rpartition(",")
+        if not separador:
+            # Admitir también "objeto cantidad"
+            nombre, _, cantidad_texto = linea.rpartition(" ")
+        nombre = nombre.strip()
+        cantidad_texto = cantidad_texto.strip()
+        if not nombre or not es_entero_positivo(cantidad_texto):
+            errores.append(linea)
+            continue
+        clave = nombre.lower()
+        if clave in entradas:
+            entradas[clave][1] += int(cantidad_texto)
+        else:
+            entradas[clave] = [nombre, int(cantidad_texto)]
+    return [tuple(e) for e in entradas.values()], errores
+
+def resolver_objetos_catalogo(nombres):
+    """Resuelve nombres exactos (sin distinguir mayúsculas) contra el catálogo y las categorías estáticas.
+
+    Devuelve {nombre_escrito: objeto} con el mismo formato que buscar_objetos; los que no
+    aparecen no se pudieron resolver.
+    """
+    asegurar_catalogo()
+    estaticos = {item: cat for cat, items in categorias.items() for item in items}
+    resueltos = {}
+    for nombre in nombres:
+        clave = nombre.lower().strip()
+        datos = sistema_busqueda.get(clave)
+        if datos:
+            resueltos[nombre] = {'nombre': datos['nombre_original'], 'categoria': datos['categoria']}
+        elif clave in estaticos:
+            resueltos[nombre] = {'nombre': clave, 'categoria': estaticos[clave]}
+    return resueltos
+
+def aplicar_depositos_lote(guild_id, user_id, entradas):
+    """Aplica varios depósitos [(objeto, cantidad)] de un usuario en una sola transacción.
+
+    Respeta los límites por categoría igual que el depósito manual. Devuelve
+    (resultados, reputación ganada, reputación total).
+    """
+    with bloqueo_banco:
+        mapa_items.asegurar([objeto['nombre'] for objeto, _ in entradas] + ["Reputación"])
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            resultado = _aplicar_depositos_en_cursor(cursor, guild_id, user_id, entradas)
+            resultados = resultado[0]
+            cambios = [("inventario", guild_id), ("ranking", guild_id)]
+            cambios += [("categorias", r['nombre'].lower()) for r in resultados]
+            confirmar_cambios(conn, cursor, cambios)
+            return resultado
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+def _aplicar_depositos_en_cursor(cursor, guild_id, user_id, entradas):
+    cursor.execute(adapt_placeholders("SELECT puntos FROM reputacion WHERE guild_id = ? AND user_id = ?"), (guild_id, user_id))
+    fila = cursor.fetchone()
+    reputacion_actual = fila[0] if fila else 0
+
+    resultados = _depositar_en_cursor(cursor, guild_id, user_id, entradas)
+    filas_historial = []
+    ganado_total = 0
+    for resultado in resultados:
+        resultado['ganado'] = 0
+        if resultado['añadido'] <= 0:
+            continue
+        ganado = calcular_reputacion(resultado['categoria'], resultado['añadido'])
+        resultado['ganado'] = ganado
+        ganado_total += ganado
+        filas_historial.append((user_id, "Añadido", resultado['nombre'], resultado['añadido'], None, None))
+        filas_historial.append((user_id, "Ganó Reputación", "Reputación", ganado, None, None))
+
+    if filas_historial:
+        _add_historial_en_cursor(cursor, guild_id, filas_historial)
+    if ganado_total:
+        _sumar_reputacion_en_cursor(cursor, guild_id, user_id, ganado_total)
+    return resultados, ganado_total, reputacion_actual + ganado_total
+
+def _depositar_en_cursor(cursor, guild_id, user_id, entradas):
+    """Añade [(objeto, cantidad)] al banco y al registro del usuario respetando los límites por categoría.
+
+    Lee el estado de todos los objetos de una vez y escribe con un upsert de varias filas por tabla.
+    Devuelve por cada entrada un dict con nombre, categoria, solicitado y añadido.
+    """
+    nombres = list({objeto['nombre'] for objeto, _ in entradas})
+    ids = mapa_items.ids_en_cursor(cursor, nombres)
+    nombre_de = {item_id: nombre for nombre, item_id in ids.items()}
+
+    # Leer de una vez el estado de todos los objetos implicados
+    cursor.execute(adapt_placeholders(f"SELECT item_id, cantidad FROM inventario WHERE guild_id = ? AND item_id IN ({_marcadores(len(ids))})"), [guild_id] + list(ids.values()))
+    inventario_actual = {nombre_de[item_id]: cantidad for item_id, cantidad in cursor.fetchall()}
+    cursor.execute(adapt_placeholders(f"SELECT item_id, categoria FROM item_categoria WHERE item_id IN ({_marcadores(len(ids))})"), list(ids.values()))
+    categorias_db = {nombre_de[item_id]: categoria for item_id, categoria in cursor.fetchall()}
+
+    resultados = []
+    anadidos: Dict[str, int] = {}
+    for objeto, cantidad in entradas:
+        nombre = objeto['nombre']
+        categoria = categorias_db.get(nombre) or _categoria_estatica(nombre.lower())
+        categoria_bot = mapear_categoria(objeto['categoria'])
+        if (not categoria or categoria == 'Otros') and categoria_bot != 'Otros':
+            _set_categoria_en_cursor(cursor, ids[nombre], categoria_bot)
+            categorias_db[nombre] = categoria = categoria_bot
+
+        cantidad_actual = inventario_actual.get(nombre, 0)
+        cantidad_posible = max(0, min(cantidad, get_limite_por_categoria(categoria) - cantidad_actual))
+        resultados.append({'nombre': nombre, 'categoria': categoria, 'solicitado': cantidad, 'añadido': cantidad_posible})
+        if cantidad_posible:
+            inventario_actual[nombre] = cantidad_actual + cantidad_posible
+            anadidos[nombre] = anadidos.get(nombre, 0) + cantidad_posible
+
+    _sumar_inventario_en_cursor(cursor, guild_id, anadidos)
+    _sumar_registro_usuario_en_cursor(cursor, guild_id, user_id, anadidos)
+    return resultados
+
+def procesar_deposito_multiple(guild_id, usuario, texto: str) -> str:
+    """Interpreta, resuelve y aplica un depósito múltiple; devuelve un único resumen."""
+    entradas, errores = parsear_deposito_multiple(texto)
+    if len(entradas) > MAX_LINEAS_DEPOSITO_MULTIPLE:
+        return f"❌ Máximo {MAX_LINEAS_DEPOSITO_MULTIPLE} objetos por depósito múltiple."
+
+    resueltos = resolver_objetos_catalogo([nombre for nombre, _ in entradas])
+    no_encontrados = [nombre for nombre, _ in entradas if nombre not in resueltos]
+    a_depositar = [(resueltos[nombre], cantidad) for nombre, cantidad in entradas if nombre in resueltos]
+
+    mensaje = f"**📦 Depósito múltiple de {usuario.mention}**\n\n"
+    if a_depositar:
+        resultados, ganado, total = aplicar_depositos_lote(guild_id, usuario.id, a_depositar)
+        for r in resultados:
+            if r['añadido'] <= 0:
+                mensaje += f"❌ {r['nombre']}: almacén lleno, no se ha añadido nada.\n"
+            elif r['añadido'] < r['solicitado']:
+                mensaje += f"⚠️ {r['nombre']}: +{r['añadido']} de {r['solicitado']} (límite de almacenamiento)\n"
+            else:
+                mensaje += f"✅ {r['nombre']}: +{r['añadido']} ({r['categoria']})\n"
+        mensaje += f"\nGanaste **{ganado:.2f}** :ReputacionCorvus:. Total: **{total:.2f}**\n"
+    else:
+        mensaje += "❌ No se ha añadido nada.\n"
+
+    if no_encontrados:
+        mensaje += "\n🔍 **No encontrados en el catálogo:** " + ", ".join(no_encontrados) + "\n"
+    if errores:
+        mensaje += "\n⚠️ **Líneas no válidas** (usa `objeto, cantidad`): " + ", ".join(errores) + "\n"
+    return mensaje
+
 # =========================
 # MODALES PARA INPUTS PRIVADOS
 # =========================
@@ -826,6 +3846,7 @@ class CantidadModal(discord.ui.Modal, title="Cantidad"):
             max_length=10
         )
         self.add_item(self.cantidad_input)
+        metricas.instrumentar(self)
 
     async def on_submit(self, interaction: discord.Interaction):
         cantidad_texto = self.cantidad_input.value.strip()
@@ -845,6 +3866,7 @@ class NombreModal(discord.ui.Modal, title="Nombre del objeto"):
             max_length=50
         )
         self.add_item(self.nombre_input)
+        metricas.instrumentar(self)
 
     async def on_submit(self, interaction: discord.Interaction):
         self.nombre = normalizar(self.nombre_input.value.strip())
@@ -860,6 +3882,7 @@ class UbicacionModal(discord.ui.Modal, title="Ubicación"):
             max_length=100
         )
         self.add_item(self.ubicacion_input)
+        metricas.instrumentar(self)
 
     async def on_submit(self, interaction: discord.Interaction):
         self.ubicacion = self.ubicacion_input.value.strip()
@@ -876,6 +3899,7 @@ class TransferCantidadModal(discord.ui.Modal, title="Cantidad a transferir"):
             max_length=10
         )
         self.add_item(self.cantidad_input)
+        metricas.instrumentar(self)
 
     async def on_submit(self, interaction: discord.Interaction):
         cantidad_texto = self.cantidad_input.value.strip()
@@ -895,6 +3919,7 @@ class TransferNombreModal(discord.ui.Modal, title="Nombre del objeto"):
             max_length=50
         )
         self.add_item(self.nombre_input)
+        metricas.instrumentar(self)
 
     async def on_submit(self, interaction: discord.Interaction):
         self.nombre = normalizar(self.nombre_input.value.strip())
@@ -910,6 +3935,7 @@ class ReputacionCantidadModal(discord.ui.Modal, title="Cantidad de reputación")
             max_length=15
         )
         self.add_item(self.cantidad_input)
+        metricas.instrumentar(self)
 
     async def on_submit(self, interaction: discord.Interaction):
         cantidad_texto = self.cantidad_input.value.strip()
@@ -922,6 +3948,66 @@ class ReputacionCantidadModal(discord.ui.Modal, title="Cantidad de reputación")
 # =========================
 # MODAL DE BÚSQUEDA DE OBJETOS
 # =========================
+class SeleccionObjetoView(discord.ui.View):
+    """Botones para confirmar el objeto encontrado; el resultado reemplaza este mismo mensaje."""
+    def __init__(self, resultados, cantidad, tipo):
+        super().__init__(timeout=60)
+        self.resultados = resultados
+        self.cantidad = cantidad
+        self.tipo = tipo
+        self.used = False
+
+        # Crear botones para cada resultado (máximo 25)
+        for i, resultado in enumerate(resultados[:25]):
+            label = resultado['nombre'][:80]  # Limitar longitud
+            if len(resultado['nombre']) > 80:
+                label += "..."
+
+            button = discord.ui.Button(
+                label=f"{i+1}. {label}",
+                style=discord.ButtonStyle.secondary,
+                custom_id=f"select_{i}"
+            )
+
+            # Crear callback específico para este botón con closure correcto
+            def make_callback(obj):
+                async def button_callback(interaction):
+                    await self.seleccionar_objeto(interaction, obj)
+                return button_callback
+
+            button.callback = make_callback(resultado)
+            self.add_item(button)
+        metricas.instrumentar(self)
+
+    async def seleccionar_objeto(self, interaction, objeto):
+        if self.used:
+            await interaction.response.send_message("Esta selección ya fue usada. Inicia de nuevo el proceso.", ephemeral=True)
+            return
+        self.used = True
+        self.stop()
+        await self.procesar_objeto(interaction, objeto)
+
+    @accion_diferida("seleccion_objeto", actualizar_mensaje=True)
+    async def procesar_objeto(self, interaction, objeto):
+        if self.tipo == "añadir":
+            return await asyncio.to_thread(aplicar_deposito, guild_de(interaction), interaction.user, objeto, self.cantidad)
+        return await asyncio.to_thread(aplicar_retiro, guild_de(interaction), interaction.user, objeto, self.cantidad)
+
+def mensaje_seleccion(termino_busqueda, resultados, tipo) -> str:
+    """Construye el mensaje con la lista de resultados de búsqueda."""
+    mensaje = f"🔍 **Resultados para '{termino_busqueda}'** ({len(resultados)} encontrados):\n\n"
+    for i, resultado in enumerate(resultados[:25], 1):
+        if tipo == "retirar" and 'cantidad' in resultado:
+            mensaje += f"**{i}.** {resultado['nombre']} ({resultado['categoria']}) - Disponible: {resultado['cantidad']}\n"
+        else:
+            mensaje += f"**{i}.** {resultado['nombre']} ({resultado['categoria']})\n"
+
+    if len(resultados) > 25:
+        mensaje += f"\n... y {len(resultados) - 25} más. Usa un término más específico."
+
+    mensaje += f"\n\nSelecciona el objeto que quieres {tipo}:"
+    return mensaje
+
 class BusquedaObjetoModal(discord.ui.Modal, title="Buscar Objeto"):
     def __init__(self, tipo="añadir"):
         super().__init__()
@@ -940,295 +4026,62 @@ class BusquedaObjetoModal(discord.ui.Modal, title="Buscar Objeto"):
         )
         self.add_item(self.cantidad_input)
         self.add_item(self.busqueda_input)
+        metricas.instrumentar(self)
 
+    @accion_diferida("busqueda_objeto")
     async def on_submit(self, interaction: discord.Interaction):
         # Validar cantidad
         cantidad_texto = self.cantidad_input.value.strip()
         if not es_entero_positivo(cantidad_texto):
-            await interaction.response.send_message("❌ Cantidad inválida. Usa solo números enteros positivos.", ephemeral=True)
-            return
+            return "❌ Cantidad inválida. Usa solo números enteros positivos."
         cantidad = int(cantidad_texto)
-        
-        # Buscar objetos
+
+        # Buscar objetos (el recorrido del catálogo va fuera del loop del bot)
         termino_busqueda = self.busqueda_input.value.strip()
         if self.tipo == "retirar":
-            resultados = buscar_objetos_inventario(termino_busqueda, interaction.user.id, 25)
+            resultados = await asyncio.to_thread(buscar_objetos_inventario, termino_busqueda, guild_de(interaction), interaction.user.id, 25)
         else:
-            resultados = buscar_objetos(termino_busqueda, 25)
-        
+            resultados = await asyncio.to_thread(buscar_objetos, termino_busqueda, 25)
+
         if not resultados:
-            await interaction.response.send_message(f"❌ No se encontraron objetos que coincidan con '{termino_busqueda}'. Verifica el nombre o intenta con un término más general.", ephemeral=True)
-            return
-        
+            return f"❌ No se encontraron objetos que coincidan con '{termino_busqueda}'. Verifica el nombre o intenta con un término más general."
+
         # Siempre mostrar selección para que el usuario confirme
-        await self.mostrar_seleccion(interaction, resultados, cantidad)
-    
-    async def mostrar_seleccion(self, interaction, resultados, cantidad):
-        # Obtener el término de búsqueda del input
-        termino_busqueda = self.busqueda_input.value.strip()
-        
-        class SeleccionObjetoView(discord.ui.View):
-            def __init__(self, resultados, cantidad, tipo):
-                super().__init__(timeout=60)
-                self.resultados = resultados
-                self.cantidad = cantidad
-                self.tipo = tipo
-                self.used = False
-                
-                # Crear botones para cada resultado (máximo 25)
-                for i, resultado in enumerate(resultados[:25]):
-                    label = resultado['nombre'][:80]  # Limitar longitud
-                    if len(resultado['nombre']) > 80:
-                        label += "..."
-                    
-                    button = discord.ui.Button(
-                        label=f"{i+1}. {label}",
-                        style=discord.ButtonStyle.secondary,
-                        custom_id=f"select_{i}"
-                    )
-                    
-                    # Crear callback específico para este botón con closure correcto
-                    def make_callback(obj):
-                        async def button_callback(interaction):
-                            await self.seleccionar_objeto(interaction, obj)
-                        return button_callback
-                    
-                    button.callback = make_callback(resultado)
-                    self.add_item(button)
-            
-            async def seleccionar_objeto(self, interaction, objeto):
-                if self.used:
-                    await interaction.response.send_message("Esta selección ya fue usada. Inicia de nuevo el proceso.", ephemeral=True)
-                    return
-                self.used = True
-                
-                # Eliminar el mensaje de resultados inmediatamente
-                try:
-                    await interaction.message.delete()
-                except Exception:
-                    pass
-                
-                # Responder a la interacción para evitar timeout
-                await interaction.response.defer(ephemeral=True)
-                
-                await self.procesar_objeto(interaction, objeto, self.cantidad)
-            
-            async def procesar_objeto(self, interaction, objeto, cantidad):
-                if self.tipo == "añadir":
-                    await self.procesar_añadir(interaction, objeto, cantidad)
-                else:
-                    await self.procesar_retirar(interaction, objeto, cantidad)
-            
-            async def procesar_añadir(self, interaction, objeto, cantidad):
-                nombre = objeto['nombre']
-                categoria = objeto['categoria']
-                
-                # Verificar si el objeto ya existe en categorías
-                categoria_existente = get_categoria(nombre)
-                
-                # Si no existe, usar la categoría del sistema de búsqueda
-                # Mapear categorías del sistema de búsqueda a categorías del bot (autocorrección)
-                mapeo_categorias = {
-                    'ARMAS': 'Armas',
-                    'MUNICION': 'Armas',      # sin tilde
-                    'MUNICIÓN': 'Armas',      # con tilde
-                    'CONSUMIBLES': 'Consumibles',
-                    'MINERALES': 'Minerales y materiales',
-                    'ARMADURA': 'Armaduras',  # singular
-                    'ARMADURAS': 'Armaduras', # plural
-                    'MEDICINA': 'Medicinas',  # singular
-                    'MEDICINAS': 'Medicinas', # plural
-                    'ROPA': 'Otros',
-                    'OTROS': 'Otros'
-                }
-                categoria_key = (categoria or '').strip().upper()
-                categoria_bot = mapeo_categorias.get(categoria_key, 'Otros')
-                if (not categoria_existente or categoria_existente == 'Otros') and categoria_bot != 'Otros':
-                    set_categoria(nombre, categoria_bot)
-                    categoria_existente = categoria_bot
-                
-                # Procesar añadir
-                limite = obtener_limite(nombre)
-                inventario_actual = get_inventario()
-                cantidad_actual = inventario_actual.get(nombre, 0)
-                cantidad_posible = min(cantidad, limite - cantidad_actual)
-                
-                if cantidad_posible <= 0:
-                    await interaction.followup.send(f"❌ El almacén para {nombre} está lleno. No se ha añadido nada.", ephemeral=True)
-                    return
-                
-                # Actualizar en base de datos
-                update_inventario(nombre, cantidad_actual + cantidad_posible)
-                
-                # Actualizar registro de usuario
-                registro_usuario = get_registro_usuario(interaction.user.id)
-                cantidad_usuario_actual = registro_usuario.get(nombre, 0)
-                update_registro_usuario(interaction.user.id, nombre, cantidad_usuario_actual + cantidad_posible)
-                
-                # Registrar en historial
-                add_historial(interaction.user.id, "Añadido", nombre, cantidad_posible)
-                
-                # Calcular y actualizar reputación
-                ganado = calcular_reputacion(categoria_existente, cantidad_posible)
-                reputacion_actual = get_reputacion_usuario(interaction.user.id)
-                update_reputacion(interaction.user.id, reputacion_actual + ganado)
-                add_historial(interaction.user.id, "Ganó Reputación", "Reputación", ganado)
-                
-                mensaje_respuesta = f"✅ {interaction.user.mention} añadió {cantidad_posible} de {nombre} ({categoria_existente}).\nGanaste **{ganado:.2f}** :ReputacionCorvus:. Total: **{reputacion_actual + ganado:.2f}**"
-                if cantidad_posible < cantidad:
-                    mensaje_respuesta += f"\n⚠️ Solo se pudieron añadir {cantidad_posible} debido al límite de almacenamiento."
-                
-                await interaction.followup.send(mensaje_respuesta, ephemeral=True)
-                # Mostrar botonera después de completar la acción
-                view = BotoneraView()
-                await interaction.followup.send("Selecciona una opción del menú:", view=view, ephemeral=True)
-            
-            async def procesar_retirar(self, interaction, objeto, cantidad):
-                nombre = objeto['nombre']
-                
-                # Verificar disponibilidad desde la base de datos
-                registro_usuario = get_registro_usuario(interaction.user.id)
-                inventario_actual = get_inventario()
-                
-                if nombre not in inventario_actual or registro_usuario.get(nombre, 0) < cantidad:
-                    await interaction.followup.send("❌ No tienes suficiente cantidad o el objeto no existe.", ephemeral=True)
-                    return
-                
-                # Actualizar inventario global
-                cantidad_actual_inventario = inventario_actual.get(nombre, 0)
-                update_inventario(nombre, cantidad_actual_inventario - cantidad)
-                
-                # Actualizar registro de usuario
-                cantidad_usuario_actual = registro_usuario.get(nombre, 0)
-                update_registro_usuario(interaction.user.id, nombre, cantidad_usuario_actual - cantidad)
-                
-                # Registrar en historial
-                add_historial(interaction.user.id, "Retirado", nombre, -cantidad)
-                
-                await interaction.followup.send(f"✅ Retiraste {cantidad} de {nombre}.", ephemeral=True)
-                # Mostrar botonera después de completar la acción
-                view = BotoneraView()
-                await interaction.followup.send("Selecciona una opción del menú:", view=view, ephemeral=True)
-        
         view = SeleccionObjetoView(resultados, cantidad, self.tipo)
-        
-        # Crear mensaje con los resultados
-        mensaje = f"🔍 **Resultados para '{termino_busqueda}'** ({len(resultados)} encontrados):\n\n"
-        for i, resultado in enumerate(resultados[:25], 1):
-            if self.tipo == "retirar" and 'cantidad' in resultado:
-                mensaje += f"**{i}.** {resultado['nombre']} ({resultado['categoria']}) - Disponible: {resultado['cantidad']}\n"
-            else:
-                mensaje += f"**{i}.** {resultado['nombre']} ({resultado['categoria']})\n"
-        
-        if len(resultados) > 25:
-            mensaje += f"\n... y {len(resultados) - 25} más. Usa un término más específico."
-        
-        mensaje += f"\n\nSelecciona el objeto que quieres {self.tipo}:"
-        
-        await interaction.response.send_message(mensaje, view=view, ephemeral=True)
-    
-    async def procesar_objeto(self, interaction, objeto, cantidad):
-        if self.tipo == "añadir":
-            await self.procesar_añadir(interaction, objeto, cantidad)
-        else:
-            await self.procesar_retirar(interaction, objeto, cantidad)
-    
-    async def procesar_añadir(self, interaction, objeto, cantidad):
-        nombre = objeto['nombre']
-        categoria = objeto['categoria']
-        
-        # Verificar si el objeto ya existe en categorías
-        categoria_existente = get_categoria(nombre)
-        
-        # Mapear categorías del sistema de búsqueda a categorías del bot (autocorrección)
-        mapeo_categorias = {
-            'ARMAS': 'Armas',
-            'MUNICION': 'Armas',      # sin tilde
-            'MUNICIÓN': 'Armas',      # con tilde
-            'CONSUMIBLES': 'Consumibles',
-            'MINERALES': 'Minerales y materiales',
-            'ARMADURA': 'Armaduras',  # singular
-            'ARMADURAS': 'Armaduras', # plural
-            'MEDICINA': 'Medicinas',  # singular
-            'MEDICINAS': 'Medicinas', # plural
-            'ROPA': 'Otros',
-            'OTROS': 'Otros'
-        }
-        categoria_key = (categoria or '').strip().upper()
-        categoria_bot = mapeo_categorias.get(categoria_key, 'Otros')
-        if (not categoria_existente or categoria_existente == 'Otros') and categoria_bot != 'Otros':
-            set_categoria(nombre, categoria_bot)
-            categoria_existente = categoria_bot
-        
-        # Procesar añadir
-        limite = obtener_limite(nombre)
-        inventario_actual = get_inventario()
-        cantidad_actual = inventario_actual.get(nombre, 0)
-        cantidad_posible = min(cantidad, limite - cantidad_actual)
-        
-        if cantidad_posible <= 0:
-            await interaction.response.send_message(f"❌ El almacén para {nombre} está lleno. No se ha añadido nada.", ephemeral=True)
-            return
-        
-        # Actualizar en base de datos
-        update_inventario(nombre, cantidad_actual + cantidad_posible)
-        
-        # Actualizar registro de usuario
-        registro_usuario = get_registro_usuario(interaction.user.id)
-        cantidad_usuario_actual = registro_usuario.get(nombre, 0)
-        update_registro_usuario(interaction.user.id, nombre, cantidad_usuario_actual + cantidad_posible)
-        
-        # Registrar en historial
-        add_historial(interaction.user.id, "Añadido", nombre, cantidad_posible)
-        
-        # Calcular y actualizar reputación
-        ganado = calcular_reputacion(categoria_existente, cantidad_posible)
-        reputacion_actual = get_reputacion_usuario(interaction.user.id)
-        update_reputacion(interaction.user.id, reputacion_actual + ganado)
-        add_historial(interaction.user.id, "Ganó Reputación", "Reputación", ganado)
-        
-        mensaje_respuesta = f"✅ {interaction.user.mention} añadió {cantidad_posible} de {nombre} ({categoria_existente}).\nGanaste **{ganado:.2f}** :ReputacionCorvus:. Total: **{reputacion_actual + ganado:.2f}**"
-        if cantidad_posible < cantidad:
-            mensaje_respuesta += f"\n⚠️ Solo se pudieron añadir {cantidad_posible} debido al límite de almacenamiento."
-        
-        await interaction.response.send_message(mensaje_respuesta, ephemeral=True)
-        # Mostrar botonera después de completar la acción
-        view = BotoneraView()
-        await interaction.followup.send("Selecciona una opción del menú:", view=view, ephemeral=True)
-    
-    async def procesar_retirar(self, interaction, objeto, cantidad):
-        nombre = objeto['nombre']
-        
-        # Verificar disponibilidad desde la base de datos
-        registro_usuario = get_registro_usuario(interaction.user.id)
-        inventario_actual = get_inventario()
-        
-        if nombre not in inventario_actual or registro_usuario.get(nombre, 0) < cantidad:
-            await interaction.response.send_message("❌ No tienes suficiente cantidad o el objeto no existe.", ephemeral=True)
-            return
-        
-        # Actualizar inventario global
-        cantidad_actual_inventario = inventario_actual.get(nombre, 0)
-        update_inventario(nombre, cantidad_actual_inventario - cantidad)
-        
-        # Actualizar registro de usuario
-        cantidad_usuario_actual = registro_usuario.get(nombre, 0)
-        update_registro_usuario(interaction.user.id, nombre, cantidad_usuario_actual - cantidad)
-        
-        # Registrar en historial
-        add_historial(interaction.user.id, "Retirado", nombre, -cantidad)
-        
-        await interaction.response.send_message(f"✅ Retiraste {cantidad} de {nombre}.", ephemeral=True)
-        # Mostrar botonera después de completar la acción
-        view = BotoneraView()
-        await interaction.followup.send("Selecciona una opción del menú:", view=view, ephemeral=True)
+        return mensaje_seleccion(termino_busqueda, resultados, self.tipo), view
+
+# =========================
+# MODAL DE DEPÓSITO MÚLTIPLE
+# =========================
+class DepositoMultipleModal(discord.ui.Modal, title="Depósito múltiple"):
+    def __init__(self):
+        super().__init__()
+        self.lineas_input = discord.ui.TextInput(
+            label="Objetos (uno por línea: objeto, cantidad)",
+            style=discord.TextStyle.paragraph,
+            placeholder="Agricium, 30\nGold (Raw), 12\nMedpen, 5",
+            required=True,
+            max_length=4000
+        )
+        self.add_item(self.lineas_input)
+        metricas.instrumentar(self)
+
+    @accion_diferida("deposito_multiple")
+    async def on_submit(self, interaction: discord.Interaction):
+        return await asyncio.to_thread(procesar_deposito_multiple, guild_de(interaction), interaction.user, self.lineas_input.value)
 
 # =========================
 # BOTONERA PRINCIPAL
 # =========================
 class BotoneraView(discord.ui.View):
+    """Menú principal persistente.
+
+    Todos los botones tienen custom_id estable y la vista se registra una sola vez
+    en setup_hook, así los menús ya publicados siguen funcionando tras un reinicio.
+    """
     def __init__(self):
         super().__init__(timeout=None)
+        metricas.instrumentar(self)
 
     async def volver_menu(self, interaction):
         view = BotoneraView()
@@ -1237,82 +4090,45 @@ class BotoneraView(discord.ui.View):
     # -----------------
     # AÑADIR OBJETO
     # -----------------
-    @discord.ui.button(label="Añadir", style=discord.ButtonStyle.green, row=0)
+    @discord.ui.button(label="Añadir", custom_id="banco:anadir", style=discord.ButtonStyle.green, row=0)
     async def añadir_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
         # Usar el nuevo sistema de búsqueda
         modal = BusquedaObjetoModal(tipo="añadir")
         await interaction.response.send_modal(modal)
+        registrar_primera_respuesta("anadir", edad_interaccion(interaction))
 
     # -----------------
     # RETIRAR
     # -----------------
-    @discord.ui.button(label="Retirar", style=discord.ButtonStyle.red, row=0)
+    @discord.ui.button(label="Retirar", custom_id="banco:retirar", style=discord.ButtonStyle.red, row=0)
     async def retirar_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
         # Usar el nuevo sistema de búsqueda
         modal = BusquedaObjetoModal(tipo="retirar")
         await interaction.response.send_modal(modal)
+        registrar_primera_respuesta("retirar", edad_interaccion(interaction))
+
+    # -----------------
+    # DEPÓSITO MÚLTIPLE
+    # -----------------
+    @discord.ui.button(label="Depósito múltiple", custom_id="banco:deposito_multiple", style=discord.ButtonStyle.green, row=0)
+    async def deposito_multiple_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(DepositoMultipleModal())
+        registrar_primera_respuesta("deposito_multiple_btn", edad_interaccion(interaction))
 
     # -----------------
     # HISTORIAL
     # -----------------
-    @discord.ui.button(label="Historial", style=discord.ButtonStyle.gray)
+    @discord.ui.button(label="Historial", custom_id="banco:historial", style=discord.ButtonStyle.gray)
+    @accion_diferida("historial")
     async def historial_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        historial_usuario = get_historial_usuario(interaction.user.id)
+        historial_usuario = await asyncio.to_thread(get_historial_usuario, guild_de(interaction), interaction.user.id)
         if not historial_usuario:
-            await interaction.response.send_message("No tienes historial.", ephemeral=True)
-        else:
-            mensaje="**📜 Historial de tus operaciones**\n\n"
-            
-            # Separar operaciones por tipo
-            añadidos = []
-            retirados = []
-            transferidos = []
-            reputacion_ganada = []
-            
-            for ts, accion, item, cant, ubic, usuario_rel in historial_usuario:
-                ubic_txt = f" (Ubicación: {ubic})" if ubic else ""
-                usuario_txt = f" → {usuario_rel}" if usuario_rel and accion in ["Transferido", "Recibido"] else f" ← {usuario_rel}" if usuario_rel else ""
-                
-                if accion == "Añadido":
-                    añadidos.append(f"[{ts}] ✅ {item} ({cant}){ubic_txt}")
-                elif accion == "Retirado":
-                    retirados.append(f"[{ts}] ❌ {item} ({abs(cant)}){ubic_txt}")
-                elif accion == "Transferido":
-                    transferidos.append(f"[{ts}] 🔄 Enviado: {item} ({abs(cant)}){ubic_txt}{usuario_txt}")
-                elif accion == "Recibido":
-                    transferidos.append(f"[{ts}] 🔄 Recibido: {item} ({abs(cant)}){ubic_txt}{usuario_txt}")
-                elif accion == "Ganó Reputación":
-                    reputacion_ganada.append(f"[{ts}] 💰 +{cant:.2f} :ReputacionCorvus:")
-            
-            # Construir mensaje organizado
-            if añadidos:
-                mensaje += "**📦 Almacenes:**\n"
-                for linea in añadidos:
-                    mensaje += f"{linea}\n"
-                mensaje += "\n"
-            
-            if retirados:
-                mensaje += "**📤 Retirados:**\n"
-                for linea in retirados:
-                    mensaje += f"{linea}\n"
-                mensaje += "\n"
-            
-            if transferidos:
-                mensaje += "**🔄 Transferencias:**\n"
-                for linea in transferidos:
-                    mensaje += f"{linea}\n"
-                mensaje += "\n"
-            
-            if reputacion_ganada:
-                mensaje += "**💰 Reputación Ganada:**\n"
-                for linea in reputacion_ganada:
-                    mensaje += f"{linea}\n"
-            
-            # Truncar mensaje si excede 2000 caracteres (límite de Discord)
-            if len(mensaje) > 2000:
-                mensaje = mensaje[:1900] + "\n\n... (historial truncado)"
-            await interaction.response.send_message(mensaje, ephemeral=True)
-        await self.volver_menu(interaction)
+            return "No tienes historial. Lo más antiguo está archivado: `//historial_completo`."
+        mensaje = "**📜 Historial de tus operaciones**\n\n" + formatear_historial(historial_usuario)
+        # Truncar mensaje si excede 2000 caracteres (límite de Discord)
+        if len(mensaje) > 1800:
+            mensaje = mensaje[:1750] + "\n\n... (historial truncado)"
+        return mensaje + f"\n📁 Movimientos de hace más de {HISTORIAL_ARCHIVO_DIAS:g} días: `//historial_completo`"
 
     # -----------------
     # TRANSFERIR (DESHABILITADO)
@@ -1581,25 +4397,19 @@ class BotoneraView(discord.ui.View):
     # -----------------
     # INVENTARIO
     # -----------------
-    @discord.ui.button(label="Inventario", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="Inventario", custom_id="banco:inventario", style=discord.ButtonStyle.primary)
+    @accion_diferida("inventario")
     async def inventario_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        inventario_actual = get_inventario()
+        guild_id = guild_de(interaction)
+        inventario_actual, categorias, limites_items, reparto_items = await asyncio.to_thread(_datos_inventario, guild_id)
         if not inventario_actual:
-            if interaction.response.is_done():
-                await interaction.followup.send("📦 Inventario vacío.", ephemeral=True)
-            else:
-                await interaction.response.send_message("📦 Inventario vacío.", ephemeral=True)
-            await self.volver_menu(interaction)
-            return
-        # Evitar expiración de la interacción mientras se construye el mensaje
-        if not interaction.response.is_done():
-            await interaction.response.defer(ephemeral=True)
+            return "📦 Inventario vacío."
         # Construir un mapa categoria -> [items]
         categoria_a_items_mapa = {"Consumibles": [], "Minerales y materiales": [], "Armas": [], "Armaduras": [], "Medicinas": [], "Otros": []}
         for item, cant in inventario_actual.items():
             if cant <= 0:
                 continue
-            cat = get_categoria(item) or "Otros"
+            cat = categorias[item] or "Otros"
             categoria_a_items_mapa.setdefault(cat, [])
             categoria_a_items_mapa[cat].append(item)
 
@@ -1613,72 +4423,63 @@ class BotoneraView(discord.ui.View):
             mensaje += f"**__{emoji_cat_map.get(cat,'📦')} {cat}__**\n"
             for item in items:
                 icono = emoji_cat_map.get(cat, "📦")
-                limite_item = obtener_limite(item)
+                limite_item = limites_items[item]
                 detalles = []
-                # Obtener todos los usuarios que tienen este item
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute(adapt_placeholders("SELECT user_id, cantidad FROM registro_usuarios WHERE item = ? AND cantidad > 0"), (item,))
-                usuarios_item = cursor.fetchall()
-                conn.close()
-                for uid, cant in usuarios_item:
-                    user = await bot.fetch_user(uid)
-                    detalles.append(f"{user.name} {cant}")
+                # Todos los usuarios que tienen este item
+                for uid, cant in reparto_items.get(item, []):
+                    detalles.append(f"{await nombre_usuario(uid)} {cant}")
                 barra = barra_progreso(inventario_actual[item], limite_item)
                 reparto = ", ".join(detalles)
                 if reparto:
                     mensaje += f"{icono} {item} — {inventario_actual[item]}/{limite_item} {barra} | {reparto}\n"
                 else:
                     mensaje += f"{icono} {item} — {inventario_actual[item]}/{limite_item} {barra}\n"
-        await interaction.followup.send(mensaje, ephemeral=True)
-        await self.volver_menu(interaction)
+        return mensaje
 
     # -----------------
     # RANKING
     # -----------------
-    @discord.ui.button(label="Ranking", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="Ranking", custom_id="banco:ranking", style=discord.ButtonStyle.secondary)
+    @accion_diferida("ranking")
     async def ranking_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        reputacion_todos = get_all_reputacion()
+        reputacion_todos = await asyncio.to_thread(get_all_reputacion, guild_de(interaction))
         top = sorted(reputacion_todos.items(), key=lambda x: x[1], reverse=True)
         mensaje = "**🏆 Ranking de reputación**\n"
         for i, (uid, puntos) in enumerate(top[:10],1):
-            user = await bot.fetch_user(uid)
-            mensaje+=f"{i}. {user.name} — {puntos:.2f} :ReputacionCorvus:\n"
-        await interaction.response.send_message(mensaje, ephemeral=True)
-        await self.volver_menu(interaction)
+            mensaje+=f"{i}. {await nombre_usuario(uid)} — {puntos:.2f} :ReputacionCorvus:\n"
+        return mensaje
 
     # -----------------
     # SALDO
     # -----------------
-    @discord.ui.button(label="Saldo", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="Saldo", custom_id="banco:saldo", style=discord.ButtonStyle.primary)
+    @accion_diferida("saldo")
     async def saldo_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        puntos = get_reputacion_usuario(interaction.user.id)
-        await interaction.response.send_message(f"💰 {interaction.user.mention}, tu reputación actual es: **{puntos:.2f}** :ReputacionCorvus:", ephemeral=True)
-        await self.volver_menu(interaction)
+        puntos = await asyncio.to_thread(get_reputacion_usuario, guild_de(interaction), interaction.user.id)
+        return f"💰 {interaction.user.mention}, tu reputación actual es: **{puntos:.2f}** :ReputacionCorvus:"
 
     # -----------------
     # TIENDA
     # -----------------
-    @discord.ui.button(label="Tienda", style=discord.ButtonStyle.success)
+    @discord.ui.button(label="Tienda", custom_id="banco:tienda", style=discord.ButtonStyle.success)
+    @accion_diferida("tienda")
     async def tienda_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        mensaje = "**🛒 Tienda del clan**\n\n🚀 **Próximamente**\n\nLa tienda de naves y armaduras estará disponible pronto. Podrás comprar naves con tu reputación del clan y se te añadirá a tu cuenta del juego tu Nave o Armadura para SIEMPRE."
-        await interaction.response.send_message(mensaje, ephemeral=True)
-        await self.volver_menu(interaction)
+        return "**🛒 Tienda del clan**\n\n🚀 **Próximamente**\n\nLa tienda de naves y armaduras estará disponible pronto. Podrás comprar naves con tu reputación del clan y se te añadirá a tu cuenta del juego tu Nave o Armadura para SIEMPRE."
 
     # -----------------
     # CONTRATOS
     # -----------------
-    @discord.ui.button(label="Contratos", style=discord.ButtonStyle.secondary, row=1)
+    @discord.ui.button(label="Contratos", custom_id="banco:contratos", style=discord.ButtonStyle.secondary, row=1)
+    @accion_diferida("contratos")
     async def contratos_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        contratos = get_contratos()
+        contratos = await asyncio.to_thread(get_contratos, guild_de(interaction))
         if not contratos:
             mensaje = "**📋 Contratos disponibles:**\n\n❌ No hay contratos disponibles en este momento."
         else:
             mensaje = "**📋 Contratos disponibles:**\n\n"
             for i, (nombre, enlace) in enumerate(contratos, 1):
                 mensaje += f"**{i}.** **{nombre}**\n{enlace}\n\n"
-        await interaction.response.send_message(mensaje, ephemeral=True)
-        await self.volver_menu(interaction)
+        return mensaje
 
 # =========================
 # COMANDO PARA MOSTRAR BOTONERA
@@ -1714,7 +4515,7 @@ async def contratos(ctx, *, args):
             return
         
         # Añadir el contrato a la base de datos
-        add_contrato(nombre, enlace)
+        add_contrato(guild_de(ctx), nombre, enlace)
         
         # Crear mensaje de anuncio con emojis
         mensaje_anuncio = f"** ATENCIÓN SE HAN PUBLICADO NUEVOS EVENTOS Y CONTRATOS:**\n\n**{nombre.upper()}**\n{enlace}"
@@ -1728,6 +4529,121 @@ async def contratos(ctx, *, args):
     except Exception as e:
         await ctx.send(f"❌ **Error al procesar el contrato:** {str(e)}", ephemeral=True)
 
+@bot.command(name="actividad")
+async def actividad(ctx, dias: int = 7):
+    """
+    Resumen de actividad del banco: //actividad (días)
+    Ejemplo: //actividad 30
+    """
+    dias = max(1, min(dias, 365))
+    guild_id = guild_de(ctx)
+    depositos = await asyncio.to_thread(get_depositos_por_dia, guild_id, dias)
+    top = await asyncio.to_thread(get_top_contribuyentes, guild_id, dias, 5)
+
+    mensaje = f"**📈 Actividad del banco — últimos {dias} días**\n\n"
+    if not depositos:
+        mensaje += "No hubo depósitos en este periodo.\n"
+    else:
+        totales: Dict[str, float] = {}
+        for dia, items in itertools.groupby(depositos, key=lambda fila: fila[0]):
+            items = list(items)
+            for _, item, total in items:
+                totales[item] = totales.get(item, 0) + total
+            resumen = ", ".join(f"{item} {total:g}" for _, item, total in items[:5])
+            if len(items) > 5:
+                resumen += f" (+{len(items) - 5} más)"
+            mensaje += f"📅 {datetime.strptime(dia, '%Y-%m-%d').strftime('%d/%m')}: {resumen}\n"
+        mas_depositados = sorted(totales.items(), key=lambda x: x[1], reverse=True)[:5]
+        mensaje += "\n**📦 Más depositados:** " + ", ".join(f"{item} {total:g}" for item, total in mas_depositados) + "\n"
+    if top:
+        mensaje += "\n**🏅 Mayores contribuyentes:**\n"
+        for i, (uid, reputacion, objetos) in enumerate(top, 1):
+            mensaje += f"{i}. {await nombre_usuario(uid)} — {reputacion:.2f} :ReputacionCorvus: ({objetos:g} objetos)\n"
+    await ctx.send(recortar_mensaje(mensaje))
+
+@bot.command(name="resumen_mensual")
+async def resumen_mensual(ctx):
+    """
+    Totales mensuales de tus movimientos, incluidos los ya archivados: //resumen_mensual
+    """
+    filas = await asyncio.to_thread(get_resumen_mensual, guild_de(ctx), ctx.author.id)
+    if not filas:
+        await ctx.send("No tienes historial.")
+        return
+    mensaje = f"**🗓️ Resumen mensual de {ctx.author.mention}**\n"
+    for mes, movimientos_mes in itertools.groupby(filas, key=lambda fila: fila[0]):
+        anadido = retirado = reputacion = 0
+        for _, accion, item, total, _ in movimientos_mes:
+            if accion == "Añadido":
+                anadido += total
+            elif accion == "Retirado":
+                retirado += abs(total)
+            elif accion == "Ganó Reputación":
+                reputacion += total
+        mensaje += f"\n**{mes}** — 📦 {anadido:g} añadidos, 📤 {retirado:g} retirados, 💰 +{reputacion:.2f} :ReputacionCorvus:"
+    await ctx.send(recortar_mensaje(mensaje))
+
+@bot.command(name="historial_completo")
+async def historial_completo(ctx):
+    """
+    Todo tu historial, incluidos los movimientos ya archivados: //historial_completo
+    """
+    historial_usuario = await asyncio.to_thread(get_historial_usuario, guild_de(ctx), ctx.author.id, True)
+    if not historial_usuario:
+        await ctx.send("No tienes historial.")
+        return
+    mensaje = f"**📜 Historial completo de {ctx.author.mention}** ({len(historial_usuario)} movimientos)\n\n" + formatear_historial(historial_usuario)
+    if len(mensaje) <= LIMITE_MENSAJE_DISCORD:
+        await ctx.send(mensaje)
+        return
+    # No cabe en un mensaje: se adjunta entero como texto
+    archivo = discord.File(io.BytesIO(mensaje.encode("utf-8")), filename="historial.txt")
+    await ctx.send(f"**📜 Historial completo de {ctx.author.mention}** ({len(historial_usuario)} movimientos), adjunto:", file=archivo)
+
+@bot.command(name="banco_en")
+async def banco_en(ctx, fecha: str):
+    """
+    Inventario del banco al final de un día: //banco_en (dd/mm/aaaa)
+    Ejemplo: //banco_en 01/10/2025
+    """
+    try:
+        dia = datetime.strptime(fecha, "%d/%m/%Y")
+    except ValueError:
+        await ctx.send("❌ **Fecha inválida.** Usa el formato `dd/mm/aaaa`.")
+        return
+    # El día es el de ZONA_HORARIA, igual que en los resúmenes por día y por mes
+    fin_del_dia = dia.replace(hour=23, minute=59, second=59, tzinfo=ZONA_HORARIA)
+    saldos = await asyncio.to_thread(saldos_en_fecha, guild_de(ctx), fin_del_dia)
+    inventario = sorted(((item, cant) for item, cant in saldos["inventario"].items() if cant > 0), key=lambda x: x[0].lower())
+    if not inventario:
+        await ctx.send(f"📦 El banco estaba vacío el {fecha}.")
+        return
+    mensaje = f"**📦 Banco del clan el {fecha}**\n\n"
+    mensaje += "\n".join(f"• {item} — {cant:g}" for item, cant in inventario)
+    await ctx.send(recortar_mensaje(mensaje))
+
+@bot.command(name="verificar_saldos")
+@commands.has_permissions(administrator=True)
+async def verificar_saldos_cmd(ctx):
+    """
+    Comprueba que inventario, registros y reputación cuadran con el historial: //verificar_saldos
+    """
+    diferencias = await asyncio.to_thread(verificar_saldos, guild_de(ctx))
+    if not diferencias:
+        await ctx.send("✅ **Los saldos cuadran con el historial.**")
+        return
+    mensaje = f"⚠️ **{len(diferencias)} saldos no cuadran con el historial:**\n"
+    for tabla, clave, esperado, actual in diferencias[:20]:
+        mensaje += f"• {tabla} {clave}: historial {esperado:g}, tabla {actual:g}\n"
+    await ctx.send(recortar_mensaje(mensaje))
+
+@verificar_saldos_cmd.error
+async def verificar_saldos_cmd_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ Sólo los administradores pueden verificar los saldos.")
+        return
+    print(f"❌ Error en verificar_saldos: {error}")
+
 @bot.command(name="borrar_contrato")
 async def borrar_contrato(ctx, *, nombre):
     """
@@ -1736,7 +4652,7 @@ async def borrar_contrato(ctx, *, nombre):
     """
     try:
         # Intentar eliminar el contrato
-        eliminado = delete_contrato(nombre)
+        eliminado = delete_contrato(guild_de(ctx), nombre)
         
         if eliminado:
             await ctx.send(f"✅ **Contrato eliminado exitosamente:**\n**{nombre}**", ephemeral=True)
@@ -1753,7 +4669,7 @@ async def borrar_todos_contratos(ctx):
     """
     try:
         # Eliminar todos los contratos
-        eliminados = delete_all_contratos()
+        eliminados = delete_all_contratos(guild_de(ctx))
         
         if eliminados > 0:
             await ctx.send(f"✅ **Se eliminaron {eliminados} contratos exitosamente.**", ephemeral=True)
@@ -1767,17 +4683,13 @@ async def borrar_todos_contratos(ctx):
 async def anuncio_contratos(ctx):
     """Anuncia todos los contratos disponibles en el canal de contratos"""
     try:
-        canal_id = os.getenv("CANAL_CONTRATOS_ID")
-        if not canal_id:
-            await ctx.send("❌ Canal de contratos no configurado.")
-            return
-        
-        canal = bot.get_channel(int(canal_id))
+        guild_id = guild_de(ctx)
+        canal = canales_contratos({guild_id}).get(guild_id)
         if not canal:
-            await ctx.send(f"❌ No se pudo encontrar el canal con ID: {canal_id}")
+            await ctx.send("❌ Canal de contratos no configurado para este servidor.")
             return
         
-        contratos = get_contratos()
+        contratos = get_contratos(guild_id)
         
         if not contratos:
             mensaje = "🔄 ** ACTUALIZACIÓN DE LOS CONTRATOS DISPONIBLES:** 🔄\n\n**📋 CONTRATOS DISPONIBLES:**\n\n❌ **No hay contratos disponibles en este momento.**\n\n---\n💼 **Total de contratos activos: 0**\n⏰ **Actualizado manualmente**"
@@ -1801,7 +4713,7 @@ async def anuncio_contratos(ctx):
 async def anuncio_contratos_privado(ctx):
     """Envía la lista de contratos por mensaje privado"""
     try:
-        contratos = get_contratos()
+        contratos = get_contratos(guild_de(ctx))
         
         if not contratos:
             mensaje = "🔄 ** CONTRATOS DISPONIBLES:** 🔄\n\n**📋 CONTRATOS DISPONIBLES:**\n\n❌ **No hay contratos disponibles en este momento.**\n\n---\n💼 **Total de contratos activos: 0**"
@@ -1820,11 +4732,16 @@ async def anuncio_contratos_privado(ctx):
     except Exception as e:
         await ctx.send(f"❌ Error al enviar mensaje privado: {e}")
  
-if os.getenv("KEEP_ALIVE"):
+metricas.arranque.marcar("cargar bot.py")
+
+if __name__ == "__main__":
+    bot.run(TOKEN)
+    # Cierre ordenado: las cachés calientes para el próximo arranque
+    try:
+        guardar_instantanea()
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar la instantánea de cachés: {e}")
     try:
-        from keep_alive import keep_alive
-        print("🚀 Activando keep-alive...")
-        keep_alive()
-    except Exception as _e:
-        print("ℹ️ KEEP_ALIVE habilitado pero no se pudo iniciar keep_alive. Continuando sin él.")
-bot.run(TOKEN)
+        _soltar_turno_inbox(trabajador_inbox.origen)
+    except Exception as e:
+        print(f"⚠️ No se pudo liberar el turno de la bandeja de webhooks: {e}")
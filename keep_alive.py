@@ -1,19 +1,20 @@
 import os
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 
-app = Flask(__name__)
+# Servidor HTTP asíncrono: corre en el loop del bot, admite conexiones keep-alive
+# y atiende peticiones concurrentes.
+app = web.Application()
 
-@app.get("/")
-def home():
-    return "OK"
+async def home(request):
+    return web.Response(text="OK")
 
-def _run():
+app.router.add_get("/", home)
+
+async def keep_alive():
     port = int(os.environ.get("PORT", "3000"))
+    # Al cerrar, runner.cleanup() espera como mucho shutdown_timeout a las peticiones en curso
+    runner = web.AppRunner(app, keepalive_timeout=75, shutdown_timeout=float(os.environ.get("HTTP_CIERRE_SEGUNDOS", "10")))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
     print(f"🌐 Keep-alive escuchando en 0.0.0.0:{port}")
-    app.run(host="0.0.0.0", port=port)
-
-def keep_alive():
-    Thread(target=_run, daemon=True).start()
-
-
+    return runner
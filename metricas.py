@@ -0,0 +1,549 @@
+import asyncio
+import bisect
+import functools
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+import discord
+from aiohttp import web
+
+# Métricas en memoria con el formato de texto de Prometheus.
+# Registrar una medición son unas pocas sumas bajo un lock; el texto sólo se
+# construye cuando alguien pide /metrics, así que sin scrapes apenas cuesta nada.
+
+LIMITES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LIMITES_CONSULTAS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Perfilador de consultas: se registra toda consulta que tarde más de CONSULTA_LENTA_MS,
+# y toda interacción que haga más de INTERACCION_CONSULTAS_AVISO consultas o pase más de
+# INTERACCION_DB_AVISO_MS en la DB. Con EXPLAIN_CONSULTAS_LENTAS=1 se añade el plan
+# (una vez por consulta normalizada).
+CONSULTA_LENTA_MS = float(os.getenv("CONSULTA_LENTA_MS", "200"))
+INTERACCION_CONSULTAS_AVISO = int(os.getenv("INTERACCION_CONSULTAS_AVISO", "20"))
+INTERACCION_DB_AVISO_MS = float(os.getenv("INTERACCION_DB_AVISO_MS", "500"))
+EXPLAIN_CONSULTAS_LENTAS = os.getenv("EXPLAIN_CONSULTAS_LENTAS") == "1"
+
+reloj = time.perf_counter
+
+class Histograma:
+    """Histograma de cubos fijos (acumulativos sólo al exponerlos)."""
+    __slots__ = ("limites", "cubos", "suma", "cuenta")
+
+    def __init__(self, limites):
+        self.limites = limites
+        self.cubos = [0] * (len(limites) + 1)
+        self.suma = 0.0
+        self.cuenta = 0
+
+    def observar(self, valor):
+        self.cubos[bisect.bisect_left(self.limites, valor)] += 1
+        self.suma += valor
+        self.cuenta += 1
+
+    def copia(self):
+        otro = Histograma(self.limites)
+        otro.cubos = list(self.cubos)
+        otro.suma = self.suma
+        otro.cuenta = self.cuenta
+        return otro
+
+class Traza:
+    """Consultas hechas por una ejecución de un manejador."""
+    __slots__ = ("tipo", "nombre", "consultas", "segundos_db", "por_sql")
+
+    def __init__(self, tipo, nombre):
+        self.tipo = tipo
+        self.nombre = nombre
+        self.consultas = 0
+        self.segundos_db = 0.0
+        # SQL tal cual -> veces; se normaliza sólo si hay que mostrar el resumen
+        self.por_sql: Dict[str, int] = {}
+
+    def resumen(self, maximo=3) -> str:
+        repetidas: Dict[str, int] = {}
+        for sql, veces in self.por_sql.items():
+            normalizada = normalizar_sql(sql)
+            repetidas[normalizada] = repetidas.get(normalizada, 0) + veces
+        principales = sorted(repetidas.items(), key=lambda x: -x[1])[:maximo]
+        return "; ".join(f"{veces}× {sql[:120]}" for sql, veces in principales)
+
+_bloqueo = threading.Lock()
+_latencias: Dict[tuple, Histograma] = {}
+_consultas_por_manejador: Dict[tuple, Histograma] = {}
+_segundos_db_por_manejador: Dict[tuple, Histograma] = {}
+_errores: Dict[tuple, int] = {}
+_consultas_totales = 0
+_consultas_lentas = 0
+_explicadas = set()
+# Traza de la interacción en curso; asyncio.to_thread copia el contexto, así que
+# las consultas hechas en hilos cuentan para quien las lanzó
+_traza_en_curso: ContextVar[Optional[Traza]] = ContextVar("traza_en_curso", default=None)
+# Funciones que añaden métricas propias al exponer: devuelven líneas ya formateadas
+_colectores: List[Callable[[], List[str]]] = []
+
+_PATRON_CADENA = re.compile(r"'(?:[^']|'')*'")
+_PATRON_NUMERO = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_PATRON_LISTA = re.compile(r"\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))+\s*\)")
+_PATRON_FILAS = re.compile(r"(\([^()]*\))(?:\s*,\s*\([^()]*\))+")
+
+def normalizar_sql(sql: str) -> str:
+    """SQL sin literales y con las listas de marcadores plegadas, para agrupar consultas iguales."""
+    sql = " ".join(sql.split())
+    sql = _PATRON_CADENA.sub("?", sql)
+    sql = _PATRON_NUMERO.sub("?", sql)
+    sql = _PATRON_LISTA.sub("(?, …)", sql)
+    return _PATRON_FILAS.sub(r"\1, …", sql)
+
+def contar_consulta(sql: str, segundos: float, filas: int = -1) -> bool:
+    """Llamada por cada consulta a la DB, ya terminada.
+
+    Devuelve True si la consulta fue lenta y el llamador debería añadir su plan
+    (EXPLAIN activado y esa consulta aún no explicada).
+    """
+    global _consultas_totales, _consultas_lentas
+    # Sin lock a propósito: son contadores orientativos y esto va en cada consulta
+    _consultas_totales += 1
+    traza = _traza_en_curso.get()
+    if traza is not None:
+        traza.consultas += 1
+        traza.segundos_db += segundos
+        traza.por_sql[sql] = traza.por_sql.get(sql, 0) + 1
+    if segundos * 1000 < CONSULTA_LENTA_MS:
+        return False
+    _consultas_lentas += 1
+    normalizada = normalizar_sql(sql)
+    origen = f"{traza.tipo} {traza.nombre}" if traza is not None else "sin manejador"
+    filas_txt = f", {filas} filas" if filas >= 0 else ""
+    print(f"🐢 Consulta lenta ({segundos * 1000:.0f} ms{filas_txt}) en {origen}: {normalizada[:300]}")
+    if not EXPLAIN_CONSULTAS_LENTAS or normalizada in _explicadas:
+        return False
+    _explicadas.add(normalizada)
+    return True
+
+def anotar_plan(sql: str, plan: List[str]):
+    """Muestra el plan de una consulta lenta (lo obtiene el cursor, que sabe de qué motor es)."""
+    if plan:
+        print(f"🧭 Plan de {normalizar_sql(sql)[:120]}:\n   " + "\n   ".join(plan))
+
+def registrar(tipo: str, nombre: str, segundos: float, error: bool = False, consultas: Optional[int] = None, segundos_db: Optional[float] = None):
+    clave = (tipo, nombre)
+    with _bloqueo:
+        histograma = _latencias.get(clave)
+        if histograma is None:
+            histograma = _latencias[clave] = Histograma(LIMITES_SEGUNDOS)
+        histograma.observar(segundos)
+        if consultas is not None:
+            histograma = _consultas_por_manejador.get(clave)
+            if histograma is None:
+                histograma = _consultas_por_manejador[clave] = Histograma(LIMITES_CONSULTAS)
+            histograma.observar(consultas)
+        if segundos_db is not None:
+            histograma = _segundos_db_por_manejador.get(clave)
+            if histograma is None:
+                histograma = _segundos_db_por_manejador[clave] = Histograma(LIMITES_SEGUNDOS)
+            histograma.observar(segundos_db)
+        if error:
+            _errores[clave] = _errores.get(clave, 0) + 1
+
+def registrar_colector(funcion: Callable[[], List[str]]):
+    _colectores.append(funcion)
+    return funcion
+
+class medir:
+    """Mide un manejador: duración, si falló, cuántas consultas hizo y cuánto tardaron.
+
+    Se usa como `with medir("tarea", "purga"):` (también alrededor de awaits), o con
+    empezar()/terminar() cuando el inicio y el final están en hooks distintos.
+    """
+    __slots__ = ("tipo", "nombre", "_inicio", "_traza", "_token")
+
+    def __init__(self, tipo: str, nombre: str):
+        self.tipo = tipo
+        self.nombre = nombre
+
+    def empezar(self):
+        self._traza = Traza(self.tipo, self.nombre)
+        self._token = _traza_en_curso.set(self._traza)
+        self._inicio = reloj()
+        return self
+
+    def terminar(self, error: bool = False):
+        segundos = reloj() - self._inicio
+        _traza_en_curso.reset(self._token)
+        traza = self._traza
+        registrar(self.tipo, self.nombre, segundos, error, traza.consultas, traza.segundos_db)
+        if traza.consultas > INTERACCION_CONSULTAS_AVISO or traza.segundos_db * 1000 > INTERACCION_DB_AVISO_MS:
+            print(f"🔎 {self.tipo} {self.nombre}: {traza.consultas} consultas, {traza.segundos_db * 1000:.0f} ms en DB "
+                  f"de {segundos * 1000:.0f} ms — {traza.resumen()}")
+
+    def __enter__(self):
+        return self.empezar()
+
+    def __exit__(self, tipo_exc, exc, traza):
+        self.terminar(exc is not None)
+        return False
+
+def medido(tipo: str, nombre: Optional[str] = None):
+    """Decorador para corrutinas: mide cada llamada con medir()."""
+    def decorador(funcion):
+        etiqueta = nombre or funcion.__name__
+
+        @functools.wraps(funcion)
+        async def envoltura(*args, **kwargs):
+            with medir(tipo, etiqueta):
+                return await funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+def instrumentar(componente):
+    """Mide los botones de una View o el on_submit de un Modal ya construidos."""
+    clase = type(componente).__name__
+    if isinstance(componente, discord.ui.Modal):
+        componente.on_submit = medido("modal", clase)(componente.on_submit)
+        return componente
+    for item in componente.children:
+        if item.callback is None:
+            continue
+        # Los botones con decorador guardan la función original en .callback
+        funcion = getattr(item.callback, "callback", item.callback)
+        item.callback = medido("boton", f"{clase}.{funcion.__name__}")(item.callback)
+    return componente
+
+@web.middleware
+async def middleware_http(request, handler):
+    """Mide cada ruta HTTP (salvo /metrics); las respuestas 5xx cuentan como error."""
+    ruta = request.match_info.route.resource
+    nombre = ruta.canonical if ruta is not None else "desconocida"
+    if nombre == "/metrics":
+        return await handler(request)
+    medicion = medir("http", nombre).empezar()
+    error = True
+    try:
+        respuesta = await handler(request)
+        error = respuesta.status >= 500
+        return respuesta
+    except web.HTTPException as e:
+        error = e.status >= 500
+        raise
+    finally:
+        medicion.terminar(error)
+
+def _etiquetas(tipo, nombre):
+    nombre = nombre.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'tipo="{tipo}",nombre="{nombre}"'
+
+def _exponer_histograma(lineas, metrica, histogramas):
+    for (tipo, nombre), histograma in sorted(histogramas.items()):
+        acumulado = 0
+        etiquetas = _etiquetas(tipo, nombre)
+        for limite, cubo in zip(histograma.limites, histograma.cubos):
+            acumulado += cubo
+            lineas.append(f'{metrica}_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+        lineas.append(f'{metrica}_bucket{{{etiquetas},le="+Inf"}} {histograma.cuenta}')
+        lineas.append(f"{metrica}_sum{{{etiquetas}}} {histograma.suma}")
+        lineas.append(f"{metrica}_count{{{etiquetas}}} {histograma.cuenta}")
+
+def exposicion() -> str:
+    """Texto de todas las métricas en el formato de exposición de Prometheus."""
+    with _bloqueo:
+        latencias = {clave: h.copia() for clave, h in _latencias.items()}
+        consultas = {clave: h.copia() for clave, h in _consultas_por_manejador.items()}
+        segundos_db = {clave: h.copia() for clave, h in _segundos_db_por_manejador.items()}
+        errores = dict(_errores)
+    lineas = [
+        "# HELP banco_manejador_segundos Duración de botones, modales, comandos, tareas y rutas HTTP.",
+        "# TYPE banco_manejador_segundos histogram",
+    ]
+    _exponer_histograma(lineas, "banco_manejador_segundos", latencias)
+    lineas += [
+        "# HELP banco_manejador_consultas_db Consultas a la DB por ejecución de cada manejador.",
+        "# TYPE banco_manejador_consultas_db histogram",
+    ]
+    _exponer_histograma(lineas, "banco_manejador_consultas_db", consultas)
+    lineas += [
+        "# HELP banco_manejador_db_segundos Tiempo en la DB por ejecución de cada manejador.",
+        "# TYPE banco_manejador_db_segundos histogram",
+    ]
+    _exponer_histograma(lineas, "banco_manejador_db_segundos", segundos_db)
+    lineas += [
+        "# HELP banco_manejador_errores_total Ejecuciones que terminaron en excepción (o 5xx).",
+        "# TYPE banco_manejador_errores_total counter",
+    ]
+    lineas += [f"banco_manejador_errores_total{{{_etiquetas(tipo, nombre)}}} {n}" for (tipo, nombre), n in sorted(errores.items())]
+    lineas += [
+        "# HELP banco_consultas_db_total Consultas a la DB desde el arranque.",
+        "# TYPE banco_consultas_db_total counter",
+        f"banco_consultas_db_total {_consultas_totales}",
+        f"# HELP banco_consultas_lentas_total Consultas que superaron {CONSULTA_LENTA_MS:g} ms.",
+        "# TYPE banco_consultas_lentas_total counter",
+        f"banco_consultas_lentas_total {_consultas_lentas}",
+    ]
+    for colector in _colectores:
+        try:
+            lineas += colector()
+        except Exception as e:
+            print(f"⚠️ Error en un colector de métricas: {e}")
+    return "\n".join(lineas) + "\n"
+
+# Monitor del bucle de eventos: un latido en el bucle mide cuánto tarda en despertar
+# (lag) y un hilo vigía, que no depende del bucle, ve cuándo deja de latir y guarda
+# la pila del hilo del bucle para saber qué corrutina lo está bloqueando.
+BUCLE_INTERVALO = float(os.getenv("BUCLE_INTERVALO", "0.25"))
+BUCLE_BLOQUEO_UMBRAL = float(os.getenv("BUCLE_BLOQUEO_UMBRAL", "1.0"))
+LIMITES_LAG = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MonitorBucle:
+    """Lag del bucle de asyncio y detector de llamadas que lo bloquean."""
+
+    def __init__(self, intervalo=BUCLE_INTERVALO, umbral=BUCLE_BLOQUEO_UMBRAL):
+        self.intervalo = intervalo
+        self.umbral = umbral
+        self.histograma = Histograma(LIMITES_LAG)
+        # Últimos ~10 minutos de muestras, para los percentiles
+        self._muestras = deque(maxlen=max(1, int(600 / intervalo)))
+        self._ultimo_latido = reloj()
+        self._latido_capturado = None
+        self._bucle = None
+        self._hilo_bucle = None
+        self.bloqueos = 0
+        self.ultimo_bloqueo = None
+        self._tarea = None
+
+    def iniciar(self):
+        """Arranca el latido en el bucle actual y el hilo vigía (llamar desde el bucle)."""
+        if self._tarea is not None:
+            return
+        self._bucle = asyncio.get_running_loop()
+        self._hilo_bucle = threading.get_ident()
+        self._ultimo_latido = reloj()
+        self._tarea = self._bucle.create_task(self._latir(), name="monitor_bucle")
+        threading.Thread(target=self._vigilar, name="vigia_bucle", daemon=True).start()
+        registrar_colector(self._exponer)
+
+    async def _latir(self):
+        while True:
+            esperado = reloj() + self.intervalo
+            await asyncio.sleep(self.intervalo)
+            ahora = reloj()
+            lag = max(0.0, ahora - esperado)
+            self._ultimo_latido = ahora
+            with _bloqueo:
+                self.histograma.observar(lag)
+                self._muestras.append(lag)
+
+    def _vigilar(self):
+        while True:
+            time.sleep(self.intervalo / 2)
+            latido = self._ultimo_latido
+            parado = reloj() - latido - self.intervalo
+            if parado >= self.umbral and self._latido_capturado != latido:
+                self._latido_capturado = latido
+                self._capturar(parado)
+
+    def _capturar(self, parado):
+        """Guarda qué está ejecutando el bucle mientras sigue bloqueado."""
+        marco = sys._current_frames().get(self._hilo_bucle)
+        pila = "".join(traceback.format_stack(marco, limit=15)) if marco is not None else "(sin pila)"
+        tarea = None
+        try:
+            # Sólo lee el diccionario de tareas en curso del bucle; no toca el bucle
+            tarea = asyncio.current_task(self._bucle)
+        except Exception:
+            pass
+        if tarea is not None:
+            coro = tarea.get_coro()
+            origen = f"{tarea.get_name()} ({getattr(coro, '__qualname__', coro)})"
+        else:
+            origen = "un callback fuera de una tarea"
+        self.bloqueos += 1
+        self.ultimo_bloqueo = {"segundos": round(parado, 3), "origen": origen, "pila": pila}
+        print(f"🧊 Bucle de eventos bloqueado ≥{parado:.1f} s en {origen}:\n{pila}")
+
+    def segundos_sin_latir(self) -> float:
+        return reloj() - self._ultimo_latido
+
+    def percentiles(self, cuantiles=(0.5, 0.9, 0.99)) -> Dict[float, float]:
+        with _bloqueo:
+            muestras = sorted(self._muestras)
+        if not muestras:
+            return {q: 0.0 for q in cuantiles}
+        return {q: muestras[min(len(muestras) - 1, int(q * len(muestras)))] for q in cuantiles}
+
+    def _exponer(self) -> List[str]:
+        with _bloqueo:
+            histograma = self.histograma.copia()
+        lineas = ["# HELP banco_bucle_lag_segundos Retraso del bucle de eventos al despertar.",
+                  "# TYPE banco_bucle_lag_segundos histogram"]
+        acumulado = 0
+        for limite, cubo in zip(histograma.limites, histograma.cubos):
+            acumulado += cubo
+            lineas.append(f'banco_bucle_lag_segundos_bucket{{le="{limite}"}} {acumulado}')
+        lineas += [f'banco_bucle_lag_segundos_bucket{{le="+Inf"}} {histograma.cuenta}',
+                   f"banco_bucle_lag_segundos_sum {histograma.suma}",
+                   f"banco_bucle_lag_segundos_count {histograma.cuenta}",
+                   "# HELP banco_bucle_lag_reciente_segundos Percentiles del lag en los últimos minutos.",
+                   "# TYPE banco_bucle_lag_reciente_segundos gauge"]
+        lineas += [f'banco_bucle_lag_reciente_segundos{{cuantil="{q}"}} {valor}' for q, valor in self.percentiles().items()]
+        lineas += ["# TYPE banco_bucle_bloqueos_total counter", f"banco_bucle_bloqueos_total {self.bloqueos}"]
+        return lineas
+
+monitor_bucle = MonitorBucle()
+
+HILOS_MAX = int(os.getenv("HILOS_MAX", "0")) or min(32, (os.cpu_count() or 1) + 4)
+
+class PoolHilos(ThreadPoolExecutor):
+    """Pool de hilos por defecto del bucle (asyncio.to_thread) que lleva su propia ocupación."""
+
+    def __init__(self, maximo=HILOS_MAX):
+        super().__init__(max_workers=maximo, thread_name_prefix="pool_bucle")
+        self.maximo = maximo
+        self.en_curso = 0
+        self.en_cola = 0
+        self.completados = 0
+        self._cola_desde = None   # desde cuándo hay trabajos esperando hilo sin interrupción
+        self._cuenta = threading.Lock()
+        self._registrado = False
+
+    def instalar(self, bucle):
+        """Lo pone como ejecutor por defecto del bucle (llamar desde el bucle)."""
+        bucle.set_default_executor(self)
+        if not self._registrado:
+            self._registrado = True
+            registrar_colector(self._exponer)
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._cuenta:
+            self.en_cola += 1
+            if self._cola_desde is None:
+                self._cola_desde = reloj()
+        try:
+            futuro = super().submit(self._ejecutar, fn, args, kwargs)
+        except BaseException:
+            self._salir_de_cola()
+            raise
+        # Un trabajo cancelado antes de empezar no pasa nunca por _ejecutar
+        futuro.add_done_callback(lambda f: f.cancelled() and self._salir_de_cola())
+        return futuro
+
+    def _salir_de_cola(self):
+        with self._cuenta:
+            self.en_cola -= 1
+            if self.en_cola == 0:
+                self._cola_desde = None
+
+    def _ejecutar(self, fn, args, kwargs):
+        self._salir_de_cola()
+        with self._cuenta:
+            self.en_curso += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._cuenta:
+                self.en_curso -= 1
+                self.completados += 1
+
+    def segundos_en_cola(self) -> float:
+        """Cuánto lleva la cola sin vaciarse (0 si está vacía)."""
+        desde = self._cola_desde
+        return reloj() - desde if desde is not None else 0.0
+
+    def estado(self) -> Dict[str, float]:
+        return {"en_curso": self.en_curso, "max": self.maximo, "en_cola": self.en_cola,
+                "cola_segundos": round(self.segundos_en_cola(), 3), "completados": self.completados}
+
+    def _exponer(self) -> List[str]:
+        return ["# HELP banco_hilos_en_curso Trabajos de asyncio.to_thread ejecutándose.",
+                "# TYPE banco_hilos_en_curso gauge", f"banco_hilos_en_curso {self.en_curso}",
+                "# TYPE banco_hilos_max gauge", f"banco_hilos_max {self.maximo}",
+                "# HELP banco_hilos_en_cola Trabajos esperando un hilo libre.",
+                "# TYPE banco_hilos_en_cola gauge", f"banco_hilos_en_cola {self.en_cola}",
+                "# TYPE banco_hilos_cola_segundos gauge", f"banco_hilos_cola_segundos {self.segundos_en_cola()}",
+                "# TYPE banco_hilos_completados_total counter", f"banco_hilos_completados_total {self.completados}"]
+
+pool_hilos = PoolHilos()
+
+# Desglose del arranque: fases en serie (cada marca cierra la anterior) y sub-fases que
+# pueden solaparse (lo que se prepara en hilos mientras se conecta con el gateway).
+class Arranque:
+    def __init__(self):
+        self.inicio = reloj()
+        self._ultima_marca = self.inicio
+        self.fases = []
+        self.subfases = []
+        self.total = None
+
+    def empezar(self, inicio):
+        """Fija el origen (el primer instante del proceso que se pudo medir)."""
+        self.inicio = self._ultima_marca = inicio
+
+    def marcar(self, fase):
+        """Cierra la fase en serie que empezó en la marca anterior."""
+        ahora = reloj()
+        with _bloqueo:
+            self.fases.append((fase, ahora - self._ultima_marca))
+        self._ultima_marca = ahora
+
+    def subfase(self, nombre):
+        return _Subfase(self, nombre)
+
+    def terminar(self) -> bool:
+        """Da el arranque por terminado. Devuelve True sólo la primera vez."""
+        if self.total is not None:
+            return False
+        self.total = reloj() - self.inicio
+        return True
+
+    def informe(self) -> str:
+        with _bloqueo:
+            fases, subfases = list(self.fases), list(self.subfases)
+        lineas = [f"⏱️ Arranque: {self.total or reloj() - self.inicio:.2f} s hasta estar listo"]
+        lineas += [f"   {fase:<34} {segundos * 1000:9.1f} ms" for fase, segundos in fases]
+        if subfases:
+            lineas.append("   en paralelo / dentro de las anteriores:")
+            lineas += [f"   · {nombre:<32} {segundos * 1000:9.1f} ms (desde +{desde:.2f} s)" for nombre, desde, segundos in subfases]
+        return "\n".join(lineas)
+
+    def _exponer(self) -> List[str]:
+        with _bloqueo:
+            fases = list(self.fases) + [(nombre, segundos) for nombre, _, segundos in self.subfases]
+        lineas = ["# HELP banco_arranque_segundos Duración de cada fase del arranque.",
+                  "# TYPE banco_arranque_segundos gauge"]
+        lineas += [f'banco_arranque_segundos{{fase="{fase}"}} {segundos}' for fase, segundos in fases]
+        if self.total is not None:
+            lineas += ["# TYPE banco_arranque_total_segundos gauge", f"banco_arranque_total_segundos {self.total}"]
+        return lineas
+
+class _Subfase:
+    """Bloque with que mide una sub-fase del arranque."""
+
+    def __init__(self, arranque, nombre):
+        self.arranque = arranque
+        self.nombre = nombre
+
+    def __enter__(self):
+        self.inicio = reloj()
+        return self
+
+    def __exit__(self, *exc):
+        with _bloqueo:
+            self.arranque.subfases.append((self.nombre, self.inicio - self.arranque.inicio, reloj() - self.inicio))
+        return False
+
+arranque = Arranque()
+registrar_colector(arranque._exponer)
+
+async def ruta_metricas(request):
+    return web.Response(body=exposicion().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def montar(app: web.Application):
+    """Añade /metrics y el middleware de medición a la app HTTP (antes de arrancarla)."""
+    app.middlewares.append(middleware_http)
+    app.router.add_get("/metrics", ruta_metricas)